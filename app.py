@@ -1,21 +1,65 @@
 import streamlit as st
 import anthropic
+import httpx
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
+import atexit
+import csv
+import gzip
+import hashlib
+import io
 import json
+import math
+import random
 import re
+import sqlite3
+import struct
+import threading
 import time
 import traceback
+import uuid
+import zipfile
+import zlib
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from dataclasses import dataclass, field, replace
 from dotenv import load_dotenv, set_key
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
 # バージョン情報
 VERSION = "2.2.2"  # 生成履歴の永続化機能追加版
 PROMPT_VERSION = "2.0"  # プロンプトバージョン（最適化版：639行→415行に削減）
 
+# 形式は前後編のみに固定（プロンプトv2.0に対応）
+STORY_FORMAT = "前後編2話完結（前編5〜7ページ・後編5〜7ページ）"
+
+# トーン/雰囲気の選択肢
+TONE_OPTIONS = [
+    "甘々・胸キュン全開",
+    "切ない・号泣系",
+    "コメディ・笑える恋愛",
+    "ドロドロ・三角関係",
+    "純愛・初恋系",
+    "大人の恋愛・切実",
+    "すれ違い・じれったい",
+    "逆転・スカッと系"
+]
+
+DEFAULT_VIEWPOINT = "主人公目線（デフォルト）"
+
 # ============================================================================
 # 文字数カウント関数
 # ============================================================================
 
+# 文字数に数えない記号・括弧・空白
+COUNT_EXCLUDED_PATTERN = re.compile(r'[※「」『』■\(\)（）…！？!?〜～\s]')
+
 def count_characters(text):
     """
     シナリオの文字数を正確にカウント
@@ -33,768 +77,4581 @@ def count_characters(text):
     text = text.replace('\n', '').replace('\r', '')
 
     # 除外する記号・括弧を削除
-    text = re.sub(r'[※「」『』■\(\)（）…！？!?〜～\s]', '', text)
+    text = COUNT_EXCLUDED_PATTERN.sub('', text)
 
     # 残った文字数をカウント
     return len(text)
 
-# ページ設定
-st.set_page_config(
-    page_title="恋愛漫画シナリオ生成ツールv2 | 愛カツ",
-    page_icon="💙",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
+# ============================================================================
+# シナリオ構造の解析
+# ============================================================================
 
-# カスタムCSS（最小限）
-st.markdown("""
-<style>
-    /* メインヘッダー */
-    .main-header {
-        font-size: 2.5rem;
-        font-weight: bold;
-        color: #333;
-        text-align: center;
-        margin-bottom: 1rem;
-        padding: 1rem;
-    }
-    
-    /* サブヘッダー */
-    .sub-header {
-        font-size: 1.2rem;
-        color: #666;
-        text-align: center;
-        margin-bottom: 2rem;
-    }
-    
-    /* バージョン表示 */
-    .version-badge {
-        display: inline-block;
-        background: #f0f0f0;
-        color: #333;
-        font-size: 0.9rem;
-        font-weight: normal;
-        padding: 0.3rem 0.8rem;
-        border-radius: 5px;
-        margin-left: 1rem;
-        vertical-align: middle;
-    }
-    
-    /* 出力セクション */
-    .output-section {
-        background: #f9f9f9;
-        padding: 1rem;
-        margin-top: 1rem;
-        border: 1px solid #e0e0e0;
-    }
-</style>
-""", unsafe_allow_html=True)
+# 前後編の文字数上限
+HALF_CHAR_LIMIT = 500
+TOTAL_CHAR_LIMIT = 1000
+RECOMMENDED_MIN_TOTAL_CHARS = 800
+
+# 後編末尾の文字数表記（直前の区切り線を含む）
+# 例：`文字数：前編482文字 / 後編518文字 / 合計1000文字`、`【文字数確認】`
+SCENARIO_FOOTER_PATTERN = re.compile(r"(?:\n[ \t]*[-ー─ｰ]{3,}[ \t]*)*\s*\n[ \t*`【]*文字数(?:[：:]|確認)")
+# 区切り線（前編の末尾などに入る ---- や ーーーー）
+SEPARATOR_LINE_PATTERN = re.compile(r"^[ \t]*[-ー─ｰ]{3,}[ \t]*$")
+# 話者付きのセリフ行（例：A子「こんにちは」※笑顔、D美『もしもし』）
+SPEAKER_LINE_PATTERN = re.compile(r"^([^\s「『※（(]{1,12})([「『].*)$")
+# 登場人物の行（例：A子：主人公、妊娠中の妻）
+CHARACTER_LINE_PATTERN = re.compile(r"^[-・\s]*([^：:\s]{1,20})[：:]\s*(.+)$")
+# 文字数表記から申告値を取り出す
+FOOTER_COUNT_PATTERN = re.compile(r"(前編|後編|合計)[：:]?\s*約?(\d+)\s*文字")
+
+@dataclass(frozen=True)
+class ScenarioScene:
+    """※の演出指示で始まる1シーン（おおむね1ページ=ひとつの感情変化）"""
+    direction: str
+    lines: tuple
+    speaker_lines: tuple
+    char_count: int
+
+@dataclass(frozen=True)
+class ScenarioHalf:
+    """前編または後編"""
+    name: str
+    title: str
+    text: str
+    scenes: tuple
+    char_count: int
+
+    @property
+    def speaker_lines(self):
+        return tuple(line for scene in self.scenes for line in scene.speaker_lines)
+
+    @property
+    def is_over_limit(self):
+        return self.char_count > HALF_CHAR_LIMIT
+
+@dataclass(frozen=True)
+class ScenarioDocument:
+    """
+    解析済みのシナリオ
 
-# プロンプトバージョン管理関数
-def save_prompt_version(version, description=""):
-    """現在のプロンプトを新しいバージョンとして保存"""
-    versions_dir = os.path.join(os.path.dirname(__file__), "prompts", "versions")
-    os.makedirs(versions_dir, exist_ok=True)
+    冒頭（【登場人物】など）・前編・後編・末尾の文字数表記に分け、
+    前編/後編はさらにシーンとセリフ行に分ける。文字数は解析時に一度だけ数える。
+    """
+    text: str
+    head: str
+    characters: tuple
+    zenpen: ScenarioHalf = None
+    kohen: ScenarioHalf = None
+    footer: str = ""
+
+    @property
+    def has_halves(self):
+        return self.zenpen is not None and self.kohen is not None
+
+    @property
+    def zenpen_count(self):
+        return self.zenpen.char_count if self.zenpen else 0
+
+    @property
+    def kohen_count(self):
+        return self.kohen.char_count if self.kohen else 0
+
+    @property
+    def total_count(self):
+        return self.zenpen_count + self.kohen_count
+
+    @property
+    def is_within_limit(self):
+        return (
+            self.zenpen_count <= HALF_CHAR_LIMIT
+            and self.kohen_count <= HALF_CHAR_LIMIT
+            and self.total_count <= TOTAL_CHAR_LIMIT
+        )
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    version_filename = f"v{version}_{timestamp}.md"
-    version_path = os.path.join(versions_dir, version_filename)
+    @property
+    def scenes(self):
+        return tuple(scene for half in (self.zenpen, self.kohen) if half for scene in half.scenes)
+
+    @property
+    def declared_counts(self):
+        """末尾の文字数表記に書かれた申告値（{"前編": 482, ...}、表記がなければ空）"""
+        return {name: int(count) for name, count in FOOTER_COUNT_PATTERN.findall(self.footer)}
+
+def _parse_scenes(body):
+    """前編/後編の本文を、空行区切りで※から始まるブロックごとのシーンに分割"""
+    scenes = []
+    current = []
+
+    def flush():
+        lines = [line for line in current if line.strip() and not SEPARATOR_LINE_PATTERN.match(line)]
+        if not lines:
+            return
+        direction = "\n".join(line for line in lines if line.lstrip().startswith("※"))
+        speaker_lines = []
+        for line in lines:
+            match = SPEAKER_LINE_PATTERN.match(line.strip())
+            if match:
+                speaker_lines.append((match.group(1), match.group(2)))
+        scenes.append(ScenarioScene(
+            direction=direction,
+            lines=tuple(lines),
+            speaker_lines=tuple(speaker_lines),
+            char_count=count_characters("".join(lines)),
+        ))
+
+    for block in re.split(r"\n\s*\n", body):
+        block_lines = block.strip("\n").split("\n")
+        # ※で始まらないブロックは直前のシーンの続きとして扱う
+        if current and block_lines[0].lstrip().startswith("※"):
+            flush()
+            current = []
+        current.extend(block_lines)
+    flush()
+    return tuple(scenes)
+
+def _parse_half(name, body):
+    # 見出しと同じ行にタイトルがある場合（例：■後編『〜』）
+    first_line, _, rest = body.partition("\n")
+    title = first_line.strip()
+    if title.startswith("※"):
+        title = ""
+    # 区切り線は本文ではないため数えない
+    counted_text = "\n".join(line for line in body.split("\n") if not SEPARATOR_LINE_PATTERN.match(line))
+    return ScenarioHalf(
+        name=name,
+        title=title,
+        text=body,
+        scenes=_parse_scenes(rest if title else body),
+        char_count=count_characters(counted_text),
+    )
 
-    # 現在のプロンプトをコピー
-    current_prompt_path = os.path.join(os.path.dirname(__file__), "prompts", "恋愛漫画マスタープロンプト.md")
-    with open(current_prompt_path, "r", encoding="utf-8") as f:
-        prompt_content = f.read()
+def build_scenario_document(scenario_text):
+    """
+    シナリオを解析する（キャッシュなし。受信途中のテキストにも使える）
 
-    # バージョン情報を先頭に追加
-    version_info = f"""# プロンプトバージョン: v{version}
-# 保存日時: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-# 説明: {description if description else "バージョン保存"}
+    ■前編/■後編 がない場合は前編/後編をNoneにする
+    """
+    head, marker, rest = scenario_text.partition("■前編")
+    if not marker:
+        head, rest = scenario_text, ""
+
+    characters = []
+    if "【登場人物】" in head:
+        for line in head.split("【登場人物】", 1)[1].split("\n"):
+            match = CHARACTER_LINE_PATTERN.match(line.strip())
+            if match:
+                characters.append((match.group(1), match.group(2)))
+            elif characters and not line.strip():
+                break
+
+    zenpen = kohen = None
+    footer = ""
+    if marker:
+        zenpen_text, marker, kohen_text = rest.partition("■後編")
+        match = SCENARIO_FOOTER_PATTERN.search(kohen_text if marker else zenpen_text)
+        if match and marker:
+            kohen_text, footer = kohen_text[:match.start()], kohen_text[match.start():]
+        elif match:
+            zenpen_text, footer = zenpen_text[:match.start()], zenpen_text[match.start():]
+        zenpen = _parse_half("前編", zenpen_text)
+        if marker:
+            kohen = _parse_half("後編", kohen_text)
+
+    return ScenarioDocument(
+        text=scenario_text,
+        head=head,
+        characters=tuple(characters),
+        zenpen=zenpen,
+        kohen=kohen,
+        footer=footer,
+    )
 
----
+@st.cache_resource(max_entries=512, show_spinner=False)
+def parse_scenario(scenario_text):
+    """
+    シナリオを解析する（内容のハッシュでメモ化し、同じシナリオは再実行でも再解析しない）
 
-{prompt_content}
-"""
+    Returns:
+        ScenarioDocument
+    """
+    return build_scenario_document(scenario_text)
+
+def join_scenario_halves(head, zenpen_text, kohen_text):
+    """前編/後編を結合し、実測の文字数表記を付け直す"""
+    zenpen_count = count_characters(zenpen_text)
+    kohen_count = count_characters(kohen_text)
+    return (
+        f"{head}■前編{zenpen_text}■後編{kohen_text.rstrip()}\n\n"
+        f"文字数：前編{zenpen_count}文字 / 後編{kohen_count}文字 / 合計{zenpen_count + kohen_count}文字\n"
+    )
 
-    with open(version_path, "w", encoding="utf-8") as f:
-        f.write(version_info)
+# ============================================================================
+# Anthropicクライアント管理（接続プールの共有）
+# ============================================================================
 
-    return version_filename
+def _client_pool_settings():
+    """
+    接続プール・タイムアウト設定を環境変数から取得
+
+    環境変数（未設定時はデフォルト値）:
+    - ANTHROPIC_MAX_CONNECTIONS: 最大同時接続数（20）
+    - ANTHROPIC_MAX_KEEPALIVE: キープアライブする接続数（10）
+    - ANTHROPIC_KEEPALIVE_EXPIRY: アイドル接続の保持秒数（120）
+    - ANTHROPIC_TIMEOUT: リクエスト全体のタイムアウト秒数（180）
+    - ANTHROPIC_CONNECT_TIMEOUT: 接続確立のタイムアウト秒数（10）
+    """
+    return {
+        "max_connections": int(os.getenv("ANTHROPIC_MAX_CONNECTIONS", "20")),
+        "max_keepalive_connections": int(os.getenv("ANTHROPIC_MAX_KEEPALIVE", "10")),
+        "keepalive_expiry": float(os.getenv("ANTHROPIC_KEEPALIVE_EXPIRY", "120")),
+        "timeout": float(os.getenv("ANTHROPIC_TIMEOUT", "180")),
+        "connect_timeout": float(os.getenv("ANTHROPIC_CONNECT_TIMEOUT", "10")),
+    }
 
-def get_available_prompt_versions():
-    """利用可能なプロンプトバージョン一覧を取得"""
-    versions_dir = os.path.join(os.path.dirname(__file__), "prompts", "versions")
-    if not os.path.exists(versions_dir):
-        return []
+@st.cache_resource
+def _client_registry():
+    """
+    プロセス全体で共有するクライアントレジストリ
 
-    version_files = [f for f in os.listdir(versions_dir) if f.endswith('.md')]
-    version_files.sort(reverse=True)  # 新しい順
-    return version_files
+    Streamlitは再実行のたびにスクリプトを実行し直すため、cache_resourceで保持して
+    全セッション・全再実行で同じ接続プールを使い回す
+    """
+    registry = {"clients": {}, "lock": threading.Lock()}
+    atexit.register(_close_registry_clients, registry)
+    return registry
+
+def _close_registry_clients(registry):
+    """レジストリ内の全クライアントの接続を閉じる"""
+    with registry["lock"]:
+        clients = list(registry["clients"].values())
+        registry["clients"].clear()
+    for client in clients:
+        try:
+            client.close()
+        except Exception:
+            pass
 
-def load_prompt_version(version_filename):
-    """指定したバージョンのプロンプトを読み込む"""
-    version_path = os.path.join(os.path.dirname(__file__), "prompts", "versions", version_filename)
-    with open(version_path, "r", encoding="utf-8") as f:
-        content = f.read()
+def get_anthropic_client(api_key):
+    """
+    APIキーごとに共有されたAnthropicクライアントを取得
 
-    # バージョン情報部分を除去（---以降が実際のプロンプト）
-    if "---" in content:
-        return content.split("---", 1)[1].strip()
-    return content
+    同じAPIキー（と接続先URL）に対しては同じクライアントを返すため、
+    パイプラインの各ステージ・各セッションでキープアライブ済みの接続を再利用できる
 
-def restore_prompt_version(version_filename):
-    """指定したバージョンのプロンプトを現在のプロンプトとして復元"""
-    prompt_content = load_prompt_version(version_filename)
-    current_prompt_path = os.path.join(os.path.dirname(__file__), "prompts", "恋愛漫画マスタープロンプト.md")
+    Args:
+        api_key: Anthropic APIキー
 
-    with open(current_prompt_path, "w", encoding="utf-8") as f:
-        f.write(prompt_content)
+    Returns:
+        anthropic.Anthropic クライアント
+    """
+    base_url = os.getenv("ANTHROPIC_BASE_URL", "")
+    # APIキーそのものは辞書のキーに残さない
+    registry_key = hashlib.sha256(f"{api_key}\0{base_url}".encode("utf-8")).hexdigest()
+
+    registry = _client_registry()
+    with registry["lock"]:
+        client = registry["clients"].get(registry_key)
+        if client is None:
+            settings = _client_pool_settings()
+            http_client = anthropic.DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=settings["max_connections"],
+                    max_keepalive_connections=settings["max_keepalive_connections"],
+                    keepalive_expiry=settings["keepalive_expiry"],
+                ),
+                timeout=httpx.Timeout(settings["timeout"], connect=settings["connect_timeout"]),
+            )
+            client = anthropic.Anthropic(
+                api_key=api_key,
+                base_url=base_url or None,
+                http_client=http_client,
+                max_retries=0,  # リトライは call_messages の耐障害性レイヤーで行う
+            )
+            registry["clients"][registry_key] = client
+        return client
 
-    return True
+def close_anthropic_clients():
+    """共有クライアントの接続をすべて閉じる（APIキー変更時やシャットダウン時）"""
+    _close_registry_clients(_client_registry())
 
-# マスタープロンプトを読み込む
-def load_master_prompt():
-    prompt_path = os.path.join(os.path.dirname(__file__), "prompts", "恋愛漫画マスタープロンプト.md")
-    with open(prompt_path, "r", encoding="utf-8") as f:
-        return f.read()
+# ============================================================================
+# ストリーミング受信
+# ============================================================================
 
-# エンディングパターン検出関数
-def detect_ending_pattern(scenario_text):
+# 1ステージあたりの想定出力トークン数（進捗表示の分母）
+EXPECTED_OUTPUT_TOKENS = 2000
+
+def estimate_output_tokens(text):
     """
-    よくあるエンディングパターンを検出
-    
-    Returns:
-        (is_pattern, pattern_name): パターンに該当するか、パターン名
+    受信済みテキストから出力トークン数を概算する
+
+    日本語はおおむね1文字≒1トークンのため文字数で近似する
+    （最終的な正確な値はストリーム終了時のusageで確定する）
     """
-    # よくあるパターンのリスト
-    patterns = [
-        (r"夕暮れ.*[歩散]", "夕暮れ散歩パターン"),
-        (r"窓.*[光差し込].*[前向き|これから|スタート]", "窓からの光と前向きな言葉パターン"),
-        (r"桜.*下.*[告白|会]", "桜の下での告白パターン"),
-        (r"雨.*[抱き合|抱く]", "雨の中で抱き合うパターン"),
-        (r"海辺.*[シルエット|2人]", "海辺で2人のシルエットパターン"),
-        (r"コーヒー.*[再会|会]", "コーヒーショップでの再会パターン"),
-    ]
-    
-    for pattern, name in patterns:
-        if re.search(pattern, scenario_text, re.IGNORECASE | re.DOTALL):
-            return True, name
-    
-    return False, None
+    return len(text)
 
-# シナリオ自動チェック＆リライト関数
-def shorten_scenario(api_key, scenario_text, target_chars=1000):
+def stream_message_text(client, on_progress=None, stop_when=None, deadline=None, **params):
     """
-    シナリオを短縮する（文字数制限オーバー時）
-    
+    messages.stream でレスポンスを受信し、途中経過をコールバックに渡す
+
+    stop_when が真を返した時点で接続を閉じて生成を止め、受信済みの分だけを返す
+    （stop_reason は STOP_REASON_OVERRUN、出力トークン数は受信済みの文字数で概算）
+
     Args:
-        api_key: Anthropic APIキー
-        scenario_text: 短縮するシナリオ
-        target_chars: 目標文字数（デフォルト1000文字）
-    
+        client: Anthropicクライアント
+        on_progress: on_progress(text, output_tokens) 形式のコールバック（Noneなら通知しない）
+        stop_when: stop_when(受信済みテキスト) が真なら受信を打ち切る
+        deadline: time.monotonic() の期限（過ぎたら接続を閉じて APITimeoutError を送出）
+        **params: messages.stream に渡すパラメータ
+
     Returns:
-        短縮されたシナリオ
+        最終的なMessage（本文とusageを含む）
+
+    Raises:
+        anthropic.APITimeoutError: 期限までに受信し終わらなかった場合
     """
-    client = anthropic.Anthropic(api_key=api_key)
-    
-    shorten_prompt = f"""
-以下のシナリオの文字数が制限を超えています。
-面白さやストーリーの内容を維持しながら、文字数を削減してください。
+    text = ""
+    with client.messages.stream(**params) as stream:
+        # httpx のタイムアウトは読み込み1回ごとのため、少しずつ届くストリームは期限で接続を閉じて止める
+        watchdog = None
+        if deadline is not None:
+            watchdog = threading.Timer(max(0.0, deadline - time.monotonic()), stream.close)
+            watchdog.daemon = True
+            watchdog.start()
+        try:
+            for chunk in stream.text_stream:
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                text += chunk
+                if on_progress:
+                    on_progress(text, estimate_output_tokens(text))
+                if stop_when and stop_when(text):
+                    snapshot = stream.current_message_snapshot
+                    final_message = snapshot.model_copy(update={
+                        "stop_reason": STOP_REASON_OVERRUN,
+                        "usage": snapshot.usage.model_copy(update={"output_tokens": estimate_output_tokens(text)}),
+                    })
+                    break
+            else:
+                final_message = stream.get_final_message()
+        except (httpx.HTTPError, httpx.StreamError, anthropic.APIConnectionError):
+            # 期限で接続を閉じたことによる読み込みエラーはタイムアウトとして扱う
+            if deadline is None or time.monotonic() < deadline:
+                raise
+        finally:
+            if watchdog:
+                watchdog.cancel()
+        if deadline is not None and time.monotonic() >= deadline:
+            raise anthropic.APITimeoutError(request=stream.response.request)
+
+    # usageで確定した出力トークン数で最後にもう一度通知
+    if on_progress:
+        on_progress(text, final_message.usage.output_tokens)
+    return final_message
+
+def live_half_counts(text):
+    """
+    受信途中のシナリオから前編/後編の文字数を数える（未受信の側は0）
 
-【目標文字数】
-- 前編：最大500文字以内
-- 後編：最大500文字以内
-- 合計：最大{target_chars}文字以内
+    Returns:
+        (前編文字数, 後編文字数)
+    """
+    document = build_scenario_document(text)
+    return document.zenpen_count, document.kohen_count
 
-【短縮の方法】
-- 冗長な表現を削除
-- 説明過多な部分を簡潔に
-- セリフや演出指示を効果的に使用
-- 1ページ=ひとつの感情変化を維持
-- ストーリーの面白さ、キャラクターの魅力、感情の盛り上がりは維持
+# ============================================================================
+# 出力の長さの制御（max_tokens と受信の打ち切り）
+# ============================================================================
+# シナリオは前後編で1000文字に収める前提のため、max_tokens を文字数の予算から決め、
+# 予算を大きく超えた出力は受信の途中で打ち切って短縮の工程に回す
+# （どうせ短縮で捨てる分のデコードを待たない）
+
+# カウント対象の1文字あたりの出力トークン数の目安（改行・※・かぎ括弧などのカウント外の文字を含む）
+TOKENS_PER_COUNTED_CHAR = 1.8
+# 予算に対する max_tokens の余裕（通常の出力が max_tokens で切れないようにする）
+MAX_TOKENS_HEADROOM = 2.0
+# 本文以外（【登場人物】・見出し・後編タイトル）の出力トークン数
+SCENARIO_OVERHEAD_TOKENS = 600
+SHORTEN_OVERHEAD_TOKENS = 200
+
+# 後編がこの文字数を超えたら受信を打ち切る（上限の1.5倍）
+# 前編は打ち切らない（後編がまだ書かれていないため。長さは max_tokens で抑える）
+STREAM_OVERRUN_CHARS = HALF_CHAR_LIMIT * 3 // 2
+
+# 文字数表記の行が始まったら生成を止める（表記は complete_scenario_footer が実測値で付け直す）
+FOOTER_STOP_SEQUENCES = ["\n文字数：", "\n文字数:", "\n**文字数**", "\n【文字数確認】"]
+
+# stop_when で受信を打ち切った応答の stop_reason
+STOP_REASON_OVERRUN = "overrun"
+# 途中で切れた出力の末尾に付ける印（短縮の工程で結末まで書き切るよう依頼する）
+TRUNCATION_NOTE = "※（文字数の超過が大きいため、ここで出力を打ち切り）"
+# 途中で切れた本文を短縮するとき、目標文字数をこれだけ超えたら受信を打ち切る
+TRUNCATED_SHORTEN_MARGIN = 50
+
+def strip_truncation_note(text):
+    """
+    TRUNCATION_NOTE と、その直前の書きかけの行を取り除く
 
-【元のシナリオ】
-{scenario_text}
+    Returns:
+        (印を外した本文, 途中で切れていたか)
+    """
+    head, note, tail = text.partition(TRUNCATION_NOTE)
+    if not note:
+        return text, False
+    lines = head.rstrip("\n").split("\n")
+    return "\n".join(lines[:-1]).rstrip("\n") + "\n" + tail, True
 
-【重要】
-- 文字数を削減する際、内容の質を落とさないこと
-- 簡潔かつインパクトのある表現に変更すること
-- シナリオ本文の最後に、実際の文字数を明記すること（例：`文字数：前編482文字 / 後編518文字 / 合計1000文字`）
-- 出力はリライトしたシナリオのみ（分析や評価コメントは不要）
-"""
-    
-    try:
-        message = client.messages.create(
-            model="claude-haiku-3-5-20250313",
-            max_tokens=8000,
-            temperature=0.3,  # 短縮は低温度で確実に
-            messages=[
-                {"role": "user", "content": shorten_prompt}
-            ]
-        )
-        return message.content[0].text
-    except Exception as e:
-        return scenario_text  # エラー時は元のシナリオを返す
+def output_token_budget(char_budget, overhead_tokens=SCENARIO_OVERHEAD_TOKENS):
+    """
+    文字数の予算から max_tokens を求める
 
-def enforce_char_limit(api_key, scenario_text, max_retries=3):
+    例：前後編（1000文字）なら 1000 × 1.8 × 2.0 + 600 = 4200
     """
-    文字数制限を強制する（オーバー時は自動短縮）
-    
-    Args:
-        api_key: Anthropic APIキー
-        scenario_text: チェックするシナリオ
-        max_retries: 最大リトライ回数
-    
-    Returns:
-        文字数制限内に収まったシナリオ
-    """
-    # 前編と後編を分割
-    if "■前編" in scenario_text:
-        scenario_only = scenario_text.split("■前編", 1)[1] if "■前編" in scenario_text else scenario_text
-        if "■後編" in scenario_only:
-            parts = scenario_only.split("■後編")
-            zenpen_text = parts[0]
-            kohen_text = parts[1] if len(parts) > 1 else ""
-            
-            zenpen_count = count_characters(zenpen_text)
-            kohen_count = count_characters(kohen_text)
-            total_count = zenpen_count + kohen_count
-            
-            # 文字数チェック
-            if zenpen_count <= 500 and kohen_count <= 500 and total_count <= 1000:
-                return scenario_text  # 制限内ならそのまま返す
-            
-            # オーバーしている場合、短縮を試行
-            for i in range(max_retries):
-                scenario_text = shorten_scenario(api_key, scenario_text, target_chars=1000)
-                
-                # 再チェック
-                if "■前編" in scenario_text:
-                    scenario_only = scenario_text.split("■前編", 1)[1] if "■前編" in scenario_text else scenario_text
-                    if "■後編" in scenario_only:
-                        parts = scenario_only.split("■後編")
-                        zenpen_text = parts[0]
-                        kohen_text = parts[1] if len(parts) > 1 else ""
-                        
-                        zenpen_count = count_characters(zenpen_text)
-                        kohen_count = count_characters(kohen_text)
-                        total_count = zenpen_count + kohen_count
-                        
-                        if zenpen_count <= 500 and kohen_count <= 500 and total_count <= 1000:
-                            return scenario_text  # 制限内になったら返す
-    
-    return scenario_text  # 最大リトライ回数に達した場合も返す
+    return int(char_budget * TOKENS_PER_COUNTED_CHAR * MAX_TOKENS_HEADROOM) + overhead_tokens
 
-def check_and_fix_scenario(api_key, scenario_draft, viewpoint="主人公目線（デフォルト）"):
+def scenario_overrun(text):
+    """受信途中のシナリオの後編が STREAM_OVERRUN_CHARS を超えたか（stop_when 用）"""
+    _, marker, kohen_text = text.partition("■後編")
+    return bool(marker) and count_characters(kohen_text) > STREAM_OVERRUN_CHARS
+
+def complete_scenario_footer(scenario_text):
     """
-    生成されたシナリオを自動でチェックし、品質向上のためにリライトする
-    
-    Args:
-        api_key: Anthropic APIキー
-        scenario_draft: リライト前のシナリオ
-        viewpoint: 視点の選択（リライト時にも視点を維持するため）
+    文字数表記の手前で止めた出力に、実測の文字数表記を付け直す
+
+    前編/後編がそろっていない場合や、表記が既にある場合はそのまま返す
     """
-    client = anthropic.Anthropic(api_key=api_key)
-    
-    # パターン検出
-    is_pattern, pattern_name = detect_ending_pattern(scenario_draft)
-    
-    # 視点維持の指示
-    viewpoint_maintain = ""
-    if viewpoint != "主人公目線（デフォルト）":
-        viewpoint_maintain = f"""
-【視点の維持】
-リライト時も、「{viewpoint}」の視点を維持してください。
-視点が変わらないよう、注意してください。
-"""
+    document = build_scenario_document(scenario_text)
+    if not document.has_halves or document.footer:
+        return scenario_text
+    # 表記の直前に入れた区切り線は本文ではないため落とす
+    lines = document.kohen.text.rstrip().split("\n")
+    while len(lines) > 1 and (not lines[-1].strip() or SEPARATOR_LINE_PATTERN.match(lines[-1])):
+        lines.pop()
+    return join_scenario_halves(document.head, document.zenpen.text, "\n".join(lines))
 
-    # パターン検出時の追加指示
-    pattern_warning = ""
-    if is_pattern:
-        pattern_warning = f"""
-⚠️ **パターン検出**: エンディングに「{pattern_name}」が検出されました。
-以下の点を必ず守ってリライトしてください：
-- このパターンを避け、バリエーションのあるエンディングに変更する
-- ただし、面白さ・感動・共感ポイントは維持する
-- 感情の回収、印象に残る要素、未来への示唆を含める
-- 日常の何気ないシーンで、自然な会話や行動で締める
-"""
+# ============================================================================
+# ファイル保存（原子的な書き込みとファイルロック）
+# ============================================================================
+# 複数のセッション・プロセスが同じ output/ を読み書きしても、
+# 書きかけのJSONを読んだり、同時の更新で片方が消えたりしないようにする。
+
+def _output_dir():
+    """生成結果の保存先（環境変数 SCENARIO_OUTPUT_DIR で変更可能。ベンチマーク用の合成データなど）"""
+    return os.getenv("SCENARIO_OUTPUT_DIR") or os.path.join(os.path.dirname(__file__), "output")
+
+def _write_temp_file(path, content):
+    """path と同じフォルダに一時ファイルを書き、ディスクに反映してからそのパスを返す"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    return tmp_path
+
+def _write_file_atomic(path, content):
+    """一時ファイルに書き込んでから置き換える（読み手は新旧どちらかの完全な内容だけを見る）"""
+    os.replace(_write_temp_file(path, content), path)
+
+def _create_file_exclusive(path, content):
+    """
+    書き終えたファイルを path として公開する（既にあれば FileExistsError）
 
-    rewrite_prompt = f"""
-以下のシナリオを、チェック基準に基づいて 客観的に自己評価 → 問題点抽出 → 最適な形にリライト してください。
-トーンは漫画のネーム用のシナリオとして、テンポよく、読者にとって理解しやすく、感情移入しやすい形に整えてください。
+    一時ファイルをハードリンクで公開するため、他のプロセスと同じ名前を取り合っても
+    上書きせず、読み手が空や書きかけのファイルを見ることもない
+    """
+    tmp_path = _write_temp_file(path, content)
+    try:
+        os.link(tmp_path, path)
+    finally:
+        os.remove(tmp_path)
 
-{pattern_warning}
-{viewpoint_maintain}
+def _lock_path(path):
+    """ロック用ファイルのパス（output/.locks/ にまとめ、履歴フォルダを散らかさない）"""
+    lock_dir = os.path.join(os.path.dirname(path), ".locks")
+    os.makedirs(lock_dir, exist_ok=True)
+    return os.path.join(lock_dir, f"{os.path.basename(path)}.lock")
 
-【元のシナリオ】
-{scenario_draft}
+def _is_current_lock_file(lock_file, lock_path):
+    try:
+        return os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino
+    except FileNotFoundError:
+        return False
 
-【ステップ1：問題点の抽出】※内部処理のみ、出力不要
+def _acquire_lock(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        return
+    while True:
+        try:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue  # LK_LOCK は約10秒で諦めるため取れるまで繰り返す
+
+def _release_lock(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
 
-以下のチェック基準に照らして、改善すべき点を把握：
+@contextmanager
+def file_lock(path):
+    """
+    path の読み込み〜書き込みを他のスレッド・プロセスと排他する（勧告ロック）
 
-▼ チェック基準
-1. ストーリーのつじつま
-   - 設定の矛盾はないか
-   - 行動の必然性はあるか
-   - 状況説明は明瞭か
-   - 現実味はあるか（倫理観、違法行為、NG描写）
+    ロックを取る側どうしでのみ有効。読むだけの処理は原子的な書き込みのおかげで
+    ロックなしでも壊れた内容を見ない
+    """
+    lock_path = _lock_path(path)
+    while True:
+        lock_file = open(lock_path, "a+b")
+        _acquire_lock(lock_file)
+        # 待っている間にロック用ファイルが削除されていたら（remove_locked_file）取り直す
+        if fcntl is None or _is_current_lock_file(lock_file, lock_path):
+            break
+        _release_lock(lock_file)
+        lock_file.close()
+    try:
+        yield
+    finally:
+        _release_lock(lock_file)
+        lock_file.close()
 
-2. セリフと感情の自然さ
-   - 会話の流れは自然か
-   - 年齢・性格に合った話し方か
-   - ポエム調・文学調を避けているか
-   - 共感を生む感情描写になっているか
+def remove_locked_file(path):
+    """
+    file_lock(path) の中で呼び、path とそのロック用ファイルを削除する
 
-3. 話のまとまり・伏線回収
-   - 伏線の貼り方と回収
-   - 展開テンポ
-   - ラストの納得感
+    アーカイブや削除でなくなったファイルのロック用ファイルを残さないため。
+    削除後に待っていた側は、file_lock の中で新しいロック用ファイルを作って取り直す
+    """
+    os.remove(path)
+    if fcntl is not None:  # Windowsは開いているファイルを削除できないため残す
+        try:
+            os.remove(_lock_path(path))
+        except FileNotFoundError:
+            pass
 
-4. エンディングのパターン化チェック【重要】
-   - よくあるパターン（夕暮れ散歩、窓からの光など）に該当していないか
-   - バリエーションのあるエンディングになっているか
-   - 面白さを保ちつつ、パターン化を避けられているか
+# ============================================================================
+# レスポンスキャッシュ（同一リクエストの再実行を省略）
+# ============================================================================
 
-5. テーマ/ネタへの忠実性【超重要】
-   - 入力されたテーマ/ネタに記載されている内容のみを使用しているか
-   - テーマに記載されていない設定・情報・要素（警察、裁判所、会社、学校など）を追加していないか
-   - テーマから大きく逸脱した展開になっていないか
+CACHE_OFF = "off"          # キャッシュを使わない
+CACHE_ON = "on"            # キャッシュを読み書きする
+CACHE_REFRESH = "refresh"  # キャッシュを読まずに再生成し、結果で上書きする
 
-6. 文字数と簡潔性【超重要】
-   - 前編：500文字以内、後編：500文字以内、合計：1000文字以内に収まっているか
-   - 物語を不必要に膨らませていないか
-   - 簡潔でインパクトのある展開になっているか
+def _response_cache_dir():
+    return os.path.join(_output_dir(), "cache")
 
-7. 追加基準
-   - 冒頭5コマで「何の話か」理解できるか
-   - 主人公の魅力が一言で言えるか
-   - 感情のアップダウンが設計されているか
-   - ラストに読後の"ご褒美"があるか
+def _response_cache_settings():
+    """
+    キャッシュの上限設定を環境変数から取得
 
-【ステップ2：シナリオの完全リライト版を生成】
+    - RESPONSE_CACHE_MAX_MB: キャッシュ全体の最大サイズ（200MB）
+    - RESPONSE_CACHE_MAX_AGE_DAYS: エントリの最大保持日数（30日）
+    """
+    return {
+        "max_bytes": int(float(os.getenv("RESPONSE_CACHE_MAX_MB", "200")) * 1024 * 1024),
+        "max_age_sec": float(os.getenv("RESPONSE_CACHE_MAX_AGE_DAYS", "30")) * 86400,
+    }
 
-以下の条件を守って、最適化したシナリオを出力してください。
+@st.cache_resource
+def _response_cache_counters():
+    """プロセス全体のヒット/ミス件数"""
+    return {"lock": threading.Lock(), "hits": 0, "misses": 0, "writes": 0, "evictions": 0}
 
-▼ リライト条件
-- 1話10〜14Pのショート漫画を想定（前後編形式）
-- テンポの良いネーム用シナリオ
-- **【最重要】前後編でそれぞれ完結しつつ、後編を絶対に読みたくなる構造**
-  - 前編 = 問題提示 + 小解決（満足度60%）
-  - 後編 = 真相 + 本質的解決（満足度100%）
-  - 前編ラストに必ず「強烈な引き」を入れる（裏の事実／新キャラ登場／本当の問題／味方の違和感／深刻な予兆）
-  - 前編最後に後編タイトルを表示（例：`後編『〜』`）
-- **1ページ=ひとつの感情変化**を基本にする
-- キャラの行動と感情が自然
-- 読者（30〜45歳女性）が共感
-- セリフは短く、説明過多を避ける
-- ナレーション/モノローグ/描写のメリハリ
-- クライマックスに向けて段階的に盛り上げる
-- 伏線は自然に回収
-- **エンディングのパターン化回避【重要】**：
-  - よくあるパターン（夕暮れ散歩、窓からの光と前向きな言葉、桜の下での告白など）は絶対に避ける
-  - 面白さ・感動・共感を保ちつつ、バリエーションのあるエンディングにする
-  - 日常の何気ないシーンで、感情の回収、共感ポイント、インパクト、未来への示唆を含める
-  - ポエム調・文学調は避け、自然な会話や行動で締める
-- 後編ラストは爽快感・解放感（ポエム調禁止）
-- NG描写（鬱・殺人・宗教・差別・過度な暴力）なし
-- **文字数制限【より厳格に】**：
-  - 前編：最大500文字以内（推奨400〜500文字）
-  - 後編：最大500文字以内（推奨400〜500文字）
-  - 合計：最大1000文字以内（推奨800〜1000文字）
-  - 絶対に上限を超えないこと
-  - 物語を膨らませすぎず、簡潔でインパクトのある展開を心がけること
-- カウント方法：改行、※、「」、『』、■、（）、…、！、？、〜、スペースを除く
-- **制限内で面白さ最大化**：冗長な表現を削り、簡潔かつインパクトのある表現に
-- **テーマ/ネタへの忠実性【最重要】**：
-  - 入力されたテーマ/ネタに記載されている内容のみを使用すること
-  - テーマに記載されていない設定・情報・要素（警察、裁判所、会社、学校、病院など）は一切追加しない
-  - テーマから大きく逸脱した展開は絶対に避けること
+def _count_cache_event(name, amount=1):
+    counters = _response_cache_counters()
+    with counters["lock"]:
+        counters[name] += amount
 
-【重要】出力はリライトしたシナリオのみ。分析や評価コメントは不要です。
-元のシナリオのフォーマット（【登場人物】から始まる形式）を維持してください。
-"""
+def response_cache_key(params, variant=0):
+    """
+    リクエスト内容からキャッシュキーを作成
 
+    モデル・温度・最大トークン数・停止シーケンス・システムプロンプト本文・ユーザープロンプトを
+    正規化したJSONのSHA-256をキーにする（プロンプトが1文字でも変われば別キー）。
+    同じリクエストで複数の候補を作る場合は variant（候補番号）ごとに別キーにする
+    """
+    material = {k: params.get(k) for k in ("model", "temperature", "max_tokens", "stop_sequences", "system", "messages")}
+    if variant:
+        material["variant"] = variant
+    payload = json.dumps(material, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def response_cache_get(key):
+    """キャッシュを取得（期限切れ・未登録ならNone）。ヒット時は最終利用時刻を更新する"""
+    path = os.path.join(_response_cache_dir(), f"{key}.json")
+    try:
+        if time.time() - os.path.getmtime(path) > _response_cache_settings()["max_age_sec"]:
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+        os.utime(path)  # LRU用に最終利用時刻を更新
+        return entry["text"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def response_cache_put(key, text, model=""):
+    """キャッシュを保存し、上限を超えていれば古いものから削除する"""
+    cache_dir = _response_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{key}.json")
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"model": model, "created_at": datetime.now().isoformat(), "text": text}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    _count_cache_event("writes")
+    evict_response_cache()
+
+def _list_response_cache_entries():
+    """(最終利用時刻, サイズ, パス) のリストを返す"""
+    cache_dir = _response_cache_dir()
+    if not os.path.exists(cache_dir):
+        return []
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".json"):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    return entries
+
+def evict_response_cache():
+    """
+    期限切れのエントリと、サイズ上限を超えた分を最終利用時刻が古い順に削除（LRU）
+
+    Returns:
+        削除した件数
+    """
+    settings = _response_cache_settings()
+    entries = sorted(_list_response_cache_entries())
+    total_bytes = sum(size for _, size, _ in entries)
+    now = time.time()
+
+    evicted = 0
+    for mtime, size, path in entries:
+        if now - mtime <= settings["max_age_sec"] and total_bytes <= settings["max_bytes"]:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_bytes -= size
+        evicted += 1
+
+    if evicted:
+        _count_cache_event("evictions", evicted)
+    return evicted
+
+def get_response_cache_stats():
+    """キャッシュの件数・サイズとヒット/ミス件数を取得"""
+    entries = _list_response_cache_entries()
+    counters = _response_cache_counters()
+    with counters["lock"]:
+        stats = {k: counters[k] for k in ("hits", "misses", "writes", "evictions")}
+    stats["entries"] = len(entries)
+    stats["total_bytes"] = sum(size for _, size, _ in entries)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+def clear_response_cache():
+    """キャッシュをすべて削除"""
+    for _, _, path in _list_response_cache_entries():
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# ============================================================================
+# トークン使用量の集計（プロンプトキャッシュの効果確認用）
+# ============================================================================
+
+USAGE_FIELDS = ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+
+@st.cache_resource
+def _api_usage_counters():
+    """プロセス全体のステージ別トークン使用量"""
+    return {"lock": threading.Lock(), "stages": {}}
+
+def record_api_usage(stage, usage):
+    """
+    APIレスポンスのusageをステージ別に加算する
+
+    Args:
+        stage: "draft" / "rewrite" / "shorten" など
+        usage: レスポンスのusage（キャッシュ関連の項目が無い場合は0として扱う）
+    """
+    counters = _api_usage_counters()
+    with counters["lock"]:
+        totals = counters["stages"].setdefault(stage or "other", dict.fromkeys(("calls",) + USAGE_FIELDS, 0))
+        totals["calls"] += 1
+        for field in USAGE_FIELDS:
+            totals[field] += getattr(usage, field, 0) or 0
+
+def get_api_usage_stats():
+    """
+    ステージ別のトークン使用量とプロンプトキャッシュのヒット率を取得
+
+    ヒット率は入力トークン全体（通常入力＋キャッシュ作成＋キャッシュ読み込み）に
+    占めるキャッシュ読み込みの割合
+
+    Returns:
+        {ステージ名: {calls, input_tokens, ..., cache_hit_rate}}
+    """
+    counters = _api_usage_counters()
+    with counters["lock"]:
+        stats = {stage: dict(totals) for stage, totals in counters["stages"].items()}
+    for totals in stats.values():
+        prompt_tokens = totals["input_tokens"] + totals["cache_creation_input_tokens"] + totals["cache_read_input_tokens"]
+        totals["cache_hit_rate"] = totals["cache_read_input_tokens"] / prompt_tokens if prompt_tokens else 0.0
+    return stats
+
+# ============================================================================
+# 呼び出しごとの計測（所要時間・トークン数・リトライ回数・コスト）
+# ============================================================================
+
+# モデル別の料金（USD / 100万トークン）。モデル名の前方一致で引く
+MODEL_PRICING = {
+    "claude-sonnet-4-5": {"input": 3.00, "output": 15.00, "cache_write": 3.75, "cache_read": 0.30},
+    "claude-haiku-3-5": {"input": 0.80, "output": 4.00, "cache_write": 1.00, "cache_read": 0.08},
+}
+
+def estimate_cost_usd(model, usage):
+    """
+    トークン数から料金を概算する（料金表にないモデルは0）
+
+    Args:
+        model: モデル名
+        usage: USAGE_FIELDS をキーに持つ辞書
+    """
+    pricing = next((p for prefix, p in MODEL_PRICING.items() if model.startswith(prefix)), None)
+    if pricing is None:
+        return 0.0
+    return (
+        usage["input_tokens"] * pricing["input"]
+        + usage["output_tokens"] * pricing["output"]
+        + usage["cache_creation_input_tokens"] * pricing["cache_write"]
+        + usage["cache_read_input_tokens"] * pricing["cache_read"]
+    ) / 1_000_000
+
+def _record_call_metric(metrics, stage, model, started_at, started, usage=None, retries=0, response_cached=False, error="", stop_reason=""):
+    """
+    API呼び出し1回分の計測値を metrics（リスト）に追加する（Noneなら何もしない）
+
+    並列の短縮処理からも呼ばれるが、list.append はスレッドセーフなのでロックは不要
+    """
+    if metrics is None:
+        return
+    tokens = {field: getattr(usage, field, 0) or 0 for field in USAGE_FIELDS}
+    metrics.append({
+        "stage": stage or "other",
+        "model": model,
+        "started_at": started_at,
+        "wall_sec": round(time.perf_counter() - started, 3),
+        **tokens,
+        "retries": retries,
+        "response_cached": response_cached,
+        "cost_usd": round(estimate_cost_usd(model, tokens), 6),
+        "error": error,
+        "stop_reason": stop_reason,
+    })
+
+# ============================================================================
+# API呼び出しの耐障害性（期限・リトライ・ヘッジ・フォールバック）
+# ============================================================================
+
+# ステージの表示名
+STAGE_LABELS = {"draft": "初稿生成", "rewrite": "リライト", "shorten": "文字数の短縮"}
+
+# 失敗の種類ごとの対処方法
+ERROR_HINTS = {
+    "rate_limit": "APIの利用制限に達しました。しばらく待ってから再試行するか、同時実行数を減らしてください",
+    "overloaded": "APIが混雑しています。しばらく待ってから再試行してください",
+    "server": "API側でエラーが発生しました。しばらく待ってから再試行してください",
+    "timeout": "期限内に応答がありませんでした。しばらく待ってから再試行してください",
+    "connection": "インターネット接続を確認してください",
+    "auth": "APIキーが正しいか、クレジット残高があるか確認してください",
+    "bad_request": "リクエスト内容に問題があります。入力内容やプロンプトを確認してください",
+    "unknown": "エラーが続く場合は、開発者にお問い合わせください",
+}
+
+class ScenarioGenerationError(Exception):
+    """
+    API呼び出しがリトライ・フォールバックを尽くしても失敗したことを表すエラー
+
+    Attributes:
+        stage: 失敗したステージ（"draft" / "rewrite" / "shorten"）
+        kind: 失敗の種類（ERROR_HINTS のキー）
+        model: 最後に試したモデル
+        attempts: 試行回数（フォールバック先も含む）
+        status_code: HTTPステータス（応答がなかった場合はNone）
+    """
+
+    def __init__(self, stage, kind, message, model="", attempts=0, status_code=None):
+        super().__init__(message)
+        self.stage = stage
+        self.kind = kind
+        self.message = message
+        self.model = model
+        self.attempts = attempts
+        self.status_code = status_code
+
+    @property
+    def stage_label(self):
+        return STAGE_LABELS.get(self.stage, self.stage or "API呼び出し")
+
+    @property
+    def hint(self):
+        return ERROR_HINTS.get(self.kind, ERROR_HINTS["unknown"])
+
+    def __str__(self):
+        return f"{self.stage_label}に失敗しました（{self.kind}、{self.attempts}回試行）: {self.message}"
+
+# ステージごとの既定の期限（秒）
+STAGE_DEADLINES = {"draft": 240, "rewrite": 150, "shorten": 90}
+
+def stage_policy(stage):
+    """
+    ステージごとの期限・リトライ・フォールバック設定を環境変数から取得
+
+    環境変数（<STAGE> は DRAFT / REWRITE / SHORTEN）:
+    - ANTHROPIC_DEADLINE_<STAGE>: ステージ全体の期限秒数（初稿240 / リライト150 / 短縮90）
+    - ANTHROPIC_FALLBACK_MODEL_<STAGE>: リトライを使い切ったときに切り替えるモデル（未設定なら切り替えない）
+    - ANTHROPIC_MAX_ATTEMPTS: モデルごとの最大試行回数（3）
+    - ANTHROPIC_BACKOFF_BASE / ANTHROPIC_BACKOFF_MAX: 待ち時間の基準秒数と上限（1 / 20）
+    - ANTHROPIC_HEDGE: "1" なら、応答がそのステージのp95を超えたときに同じリクエストをもう1本送る
+    """
+    key = (stage or "other").upper()
+    return {
+        "deadline_sec": float(os.getenv(f"ANTHROPIC_DEADLINE_{key}", str(STAGE_DEADLINES.get(stage, 180)))),
+        "fallback_model": os.getenv(f"ANTHROPIC_FALLBACK_MODEL_{key}", ""),
+        "max_attempts": max(1, int(os.getenv("ANTHROPIC_MAX_ATTEMPTS", "3"))),
+        "backoff_base": float(os.getenv("ANTHROPIC_BACKOFF_BASE", "1")),
+        "backoff_max": float(os.getenv("ANTHROPIC_BACKOFF_MAX", "20")),
+        "hedge": os.getenv("ANTHROPIC_HEDGE", "") == "1",
+    }
+
+def classify_api_error(error):
+    """
+    例外を失敗の種類に分類する
+
+    Returns:
+        (kind, リトライしてよいか, HTTPステータス, サーバー指定の待ち秒数)
+    """
+    if isinstance(error, anthropic.APITimeoutError):
+        return "timeout", True, None, None
+    if isinstance(error, anthropic.APIConnectionError):
+        return "connection", True, None, None
+    if not isinstance(error, anthropic.APIStatusError):
+        return "unknown", False, None, None
+
+    status_code = error.status_code
+    retry_after = None
+    headers = error.response.headers if error.response is not None else {}
+    try:
+        if headers.get("retry-after-ms"):
+            retry_after = float(headers["retry-after-ms"]) / 1000
+        elif headers.get("retry-after"):
+            retry_after = float(headers["retry-after"])
+    except ValueError:
+        pass
+
+    if status_code == 429:
+        return "rate_limit", True, status_code, retry_after
+    if status_code == 529:
+        return "overloaded", True, status_code, retry_after
+    if status_code >= 500 or status_code in (408, 409):
+        return "server", True, status_code, retry_after
+    if status_code in (401, 403):
+        return "auth", False, status_code, None
+    return "bad_request", False, status_code, None
+
+def backoff_delay(attempt, policy, retry_after=None):
+    """
+    次の試行までの待ち秒数（指数バックオフ＋フルジッター）
+
+    サーバーが retry-after を指定していればそれに従う（上限は backoff_max）
+    """
+    if retry_after is not None:
+        return min(retry_after, policy["backoff_max"])
+    return random.uniform(0, min(policy["backoff_max"], policy["backoff_base"] * (2 ** attempt)))
+
+@st.cache_resource
+def _stage_latency_window():
+    """ステージごとの直近の所要時間（ヘッジの判定に使うp95の元データ）"""
+    return {"lock": threading.Lock(), "samples": {}}
+
+def record_stage_latency(stage, seconds):
+    window = _stage_latency_window()
+    with window["lock"]:
+        window["samples"].setdefault(stage, deque(maxlen=200)).append(seconds)
+
+def stage_latency_p95(stage, min_samples=20):
+    """直近の成功した呼び出しのp95（サンプルが少ないうちはNone）"""
+    window = _stage_latency_window()
+    with window["lock"]:
+        samples = sorted(window["samples"].get(stage, ()))
+    if len(samples) < min_samples:
+        return None
+    return _percentile(samples, 0.95)
+
+def _percentile(sorted_values, ratio):
+    """昇順のリストから最近傍順位法でパーセンタイル値を取る"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, math.ceil(ratio * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+@st.cache_resource
+def _hedge_executor():
+    """ヘッジ用の予備リクエストを送るスレッドプール（プロセス全体で共有）"""
+    executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+    atexit.register(executor.shutdown, wait=False)
+    return executor
+
+def _send_message(client, on_progress, params, stop_when=None, deadline=None):
+    """
+    1回分のリクエストを送る（ストリーミング時は途中経過をコールバックに渡す。打ち切りの判定にもストリーミングを使う）
+
+    ストリーミング時は deadline（time.monotonic() の期限）を過ぎたら接続を閉じて APITimeoutError を送出する
+    """
+    if on_progress or stop_when:
+        return stream_message_text(client, on_progress, stop_when=stop_when, deadline=deadline, **params)
+    return client.messages.create(**params)
+
+def _send_hedged(client, hedge_after, params, stop_when=None, deadline=None):
+    """
+    hedge_after 秒以内に応答がなければ同じリクエストをもう1本送り、先に成功した方を使う
+
+    遅い方の応答は待たずに捨てる（その分のトークンは課金される）
+    """
+    executor = _hedge_executor()
+    primary = executor.submit(_send_message, client, None, params, stop_when, deadline)
+    done, _ = wait([primary], timeout=hedge_after)
+    if done:
+        return primary.result()
+
+    pending = {primary, executor.submit(_send_message, client, None, params, stop_when, deadline)}
+    first_error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            first_error = first_error or future.exception()
+    raise first_error
+
+def send_with_resilience(api_key, stage, params, on_progress=None, stop_when=None):
+    """
+    期限内でリトライ・ヘッジ・フォールバックを行いながらリクエストを送る
+
+    - 429/529/5xx/接続エラー/タイムアウトは指数バックオフ＋ジッターで再試行
+    - 再試行を使い切ったらフォールバック先のモデルで同じ手順を繰り返す
+    - ヘッジは途中経過を表示しない呼び出しだけ（表示が混ざるため）
+
+    Returns:
+        (Message, リトライ回数)
+
+    Raises:
+        ScenarioGenerationError: 期限切れ、リトライ不可のエラー、または全試行の失敗
+    """
+    policy = stage_policy(stage)
+    deadline = time.monotonic() + policy["deadline_sec"]
+    models = [params.get("model", "")]
+    if policy["fallback_model"] and policy["fallback_model"] not in models:
+        models.append(policy["fallback_model"])
+
+    client = get_anthropic_client(api_key)
+    connect_timeout = _client_pool_settings()["connect_timeout"]
+    attempts = 0
+    last_error = None
+    for model in models:
+        attempt_params = dict(params, model=model)
+        for attempt in range(policy["max_attempts"]):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            attempts += 1
+            attempt_client = client.with_options(timeout=httpx.Timeout(remaining, connect=min(connect_timeout, remaining)))
+            hedge_after = stage_latency_p95(stage) if policy["hedge"] and not on_progress else None
+
+            started = time.perf_counter()
+            try:
+                if hedge_after:
+                    message = _send_hedged(attempt_client, hedge_after, attempt_params, stop_when, deadline)
+                else:
+                    message = _send_message(attempt_client, on_progress, attempt_params, stop_when, deadline)
+            except Exception as e:
+                kind, retryable, status_code, retry_after = classify_api_error(e)
+                last_error = ScenarioGenerationError(stage, kind, str(e), model=model, attempts=attempts, status_code=status_code)
+                if not retryable:
+                    raise last_error from e
+                if attempt + 1 < policy["max_attempts"]:
+                    delay = backoff_delay(attempt, policy, retry_after)
+                    if time.monotonic() + delay >= deadline:
+                        break
+                    time.sleep(delay)
+                continue
+
+            record_stage_latency(stage, time.perf_counter() - started)
+            return message, attempts - 1
+
+    if last_error is None or time.monotonic() >= deadline:
+        raise ScenarioGenerationError(
+            stage, "timeout",
+            f"期限（{policy['deadline_sec']:g}秒）内に完了しませんでした" + (f": {last_error.message}" if last_error else ""),
+            model=models[-1], attempts=attempts, status_code=last_error.status_code if last_error else None,
+        )
+    raise last_error
+
+# ============================================================================
+# Messages API呼び出し
+# ============================================================================
+
+def call_messages(api_key, on_progress=None, cache_mode=CACHE_OFF, stage="", metrics=None, cache_variant=0, stop_when=None, **params):
+    """
+    Messages APIを呼び出して応答テキストを返す
+
+    共有クライアント・ストリーミング表示・レスポンスキャッシュをまとめて扱う。
+    パイプラインの各ステージはこの関数を経由してAPIを呼び出す。
+
+    Args:
+        api_key: Anthropic APIキー
+        on_progress: 指定時はストリーミングで受信し on_progress(text, output_tokens) を呼ぶ
+        cache_mode: CACHE_OFF / CACHE_ON / CACHE_REFRESH
+        stage: トークン使用量の集計に使うステージ名
+        metrics: 指定時は呼び出しごとの計測値（辞書）を追加するリスト
+        cache_variant: 同じリクエストの何番目の候補か（レスポンスキャッシュを候補ごとに分ける）
+        stop_when: 指定時はストリーミングで受信し、stop_when(受信済みテキスト) が真なら打ち切る
+        **params: messages.create に渡すパラメータ
+
+    Returns:
+        応答テキスト（打ち切り・max_tokens で途中で切れた場合は末尾に TRUNCATION_NOTE を付ける）
+
+    Raises:
+        ScenarioGenerationError: リトライ・フォールバックを尽くしても失敗した場合
+    """
+    model = params.get("model", "")
+    started_at = datetime.now().isoformat()
+    started = time.perf_counter()
+    cache_key = response_cache_key(params, cache_variant) if cache_mode != CACHE_OFF else None
+
+    if cache_mode == CACHE_ON:
+        cached_text = response_cache_get(cache_key)
+        if cached_text is not None:
+            _count_cache_event("hits")
+            if on_progress:
+                on_progress(cached_text, estimate_output_tokens(cached_text))
+            _record_call_metric(metrics, stage, model, started_at, started, response_cached=True)
+            return cached_text
+        _count_cache_event("misses")
+
+    try:
+        message, retries = send_with_resilience(api_key, stage, params, on_progress=on_progress, stop_when=stop_when)
+    except ScenarioGenerationError as e:
+        _record_call_metric(metrics, stage, e.model or model, started_at, started, retries=max(0, e.attempts - 1), error=e.kind)
+        raise
+    record_api_usage(stage, message.usage)
+    # フォールバックした場合は実際に応答したモデルで記録する
+    _record_call_metric(
+        metrics, stage, message.model or model, started_at, started,
+        usage=message.usage, retries=retries, stop_reason=message.stop_reason or ""
+    )
+    text = message.content[0].text if message.content else ""
+    if message.stop_reason in (STOP_REASON_OVERRUN, "max_tokens"):
+        # 途中で切れた応答はキャッシュしない（やり直しで同じ結果を返さないため）
+        return text.rstrip() + "\n" + TRUNCATION_NOTE + "\n"
+
+    if cache_key:
+        response_cache_put(cache_key, text, model=model)
+    return text
+
+# ============================================================================
+# プロンプト管理（メモリキャッシュとバージョン保存）
+# ============================================================================
+
+MASTER_PROMPT_FILENAME = "恋愛漫画マスタープロンプト.md"
+VIEWPOINT_PROMPT_FILENAME = "視点変更プロンプト.md"
+
+@dataclass(frozen=True)
+class PromptAsset:
+    """読み込み済みのプロンプト（内容とそのハッシュ）"""
+    path: str
+    content: str
+    sha256: str
+
+def _prompts_dir():
+    return os.path.join(os.path.dirname(__file__), "prompts")
+
+def _prompt_versions_dir():
+    return os.path.join(_prompts_dir(), "versions")
+
+def _prompt_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+@st.cache_resource
+def _prompt_registry():
+    """プロセス全体で共有するプロンプトのキャッシュ（パス → (ファイル状態, PromptAsset)）"""
+    return {"lock": threading.Lock(), "assets": {}, "versions": (None, [])}
+
+def _file_signature(path):
+    """ファイルが書き換えられたかを判定するための (inode, 更新時刻, サイズ)"""
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def get_prompt_asset(path):
+    """
+    プロンプトファイルを読み込む（変更がなければメモリ上のキャッシュを返す）
+
+    inode・更新時刻・サイズが変わった場合だけ読み直す。
+    restore_prompt_version はファイルを丸ごと置き換えるため、書きかけの内容を読むことはない。
+    """
+    registry = _prompt_registry()
+    signature = _file_signature(path)
+    with registry["lock"]:
+        cached = registry["assets"].get(path)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+    asset = PromptAsset(path=path, content=content, sha256=_prompt_hash(content))
+    with registry["lock"]:
+        registry["assets"][path] = (signature, asset)
+    return asset
+
+def get_master_prompt_asset():
+    """現在のマスタープロンプトを取得（生成時に使ったハッシュを記録するため）"""
+    return get_prompt_asset(os.path.join(_prompts_dir(), MASTER_PROMPT_FILENAME))
+
+def _load_prompt_version_manifest():
+    """バージョン一覧（index.json）を読み込む"""
+    manifest_path = os.path.join(_prompt_versions_dir(), "index.json")
+    if not os.path.exists(manifest_path):
+        return []
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _legacy_prompt_body(content):
+    """以前の形式（バージョン情報付きの全文コピー）から本文を取り出す（---以降が実際のプロンプト）"""
+    if "---" in content:
+        return content.split("---", 1)[1].strip()
+    return content
+
+def _find_legacy_prompt_version(content):
+    """
+    以前の形式のバージョンファイルから、本文が content と同じもののファイル名を探す（なければ空）
+
+    以前の形式の本文は前後の空白を除いて保存されているため、両方とも除いたハッシュで比べる
+    """
+    sha256 = _prompt_hash(content.strip())
+    versions_dir = _prompt_versions_dir()
+    for filename in sorted(os.listdir(versions_dir)):
+        if not filename.endswith(".md"):
+            continue
+        content = get_prompt_asset(os.path.join(versions_dir, filename)).content
+        if _prompt_hash(_legacy_prompt_body(content)) == sha256:
+            return filename
+    return ""
+
+# プロンプトバージョン管理関数
+def save_prompt_version(version, description=""):
+    """
+    現在のプロンプトを新しいバージョンとして保存
+
+    本文は内容のハッシュをファイル名にして versions/objects/ に保存する。
+    同じ内容の本文（以前の形式の全文コピーを含む）が既にあれば本文は保存し直さず、
+    それを指すバージョンだけを index.json に追加する（バージョン番号と説明は毎回記録する）
+
+    Returns:
+        バージョン名（例：v2.1_20251115_131749.md）
+    """
+    versions_dir = _prompt_versions_dir()
+    objects_dir = os.path.join(versions_dir, "objects")
+    os.makedirs(objects_dir, exist_ok=True)
+
+    asset = get_master_prompt_asset()
+    manifest_path = os.path.join(versions_dir, "index.json")
+    with file_lock(manifest_path):
+        manifest = _load_prompt_version_manifest()
+        now = datetime.now()
+        version_filename = f"v{version}_{now.strftime('%Y%m%d_%H%M%S')}.md"
+        entry = {
+            "name": version_filename,
+            "version": version,
+            "saved_at": now.strftime("%Y-%m-%d %H:%M:%S"),
+            "description": description if description else "バージョン保存",
+            "sha256": asset.sha256,
+        }
+
+        # 本文の保存先: 同じ内容の既存バージョンと同じもの → 以前の形式のファイル → objects/
+        source = next((e.get("source", "") for e in manifest if e["sha256"] == asset.sha256), None)
+        if source is None:
+            source = _find_legacy_prompt_version(asset.content)
+        if source:
+            entry["source"] = source
+        else:
+            object_path = os.path.join(objects_dir, f"{asset.sha256}.md")
+            if not os.path.exists(object_path):
+                _write_file_atomic(object_path, asset.content)
+
+        manifest.append(entry)
+        _write_file_atomic(manifest_path, json.dumps(manifest, ensure_ascii=False, indent=2))
+
+    return version_filename
+
+def get_available_prompt_versions():
+    """利用可能なプロンプトバージョン一覧を取得（フォルダが変わらない限りキャッシュを返す）"""
+    versions_dir = _prompt_versions_dir()
+    if not os.path.exists(versions_dir):
+        return []
+
+    manifest_path = os.path.join(versions_dir, "index.json")
+    signature = (
+        _file_signature(versions_dir),
+        _file_signature(manifest_path) if os.path.exists(manifest_path) else None,
+    )
+    registry = _prompt_registry()
+    with registry["lock"]:
+        if registry["versions"][0] == signature:
+            return list(registry["versions"][1])
+
+    version_files = [f for f in os.listdir(versions_dir) if f.endswith('.md')]
+    version_files += [entry["name"] for entry in _load_prompt_version_manifest()]
+    version_files.sort(reverse=True)  # 新しい順
+    with registry["lock"]:
+        registry["versions"] = (signature, version_files)
+    return list(version_files)
+
+def load_prompt_version(version_filename):
+    """指定したバージョンのプロンプトを読み込む"""
+    for entry in _load_prompt_version_manifest():
+        if entry["name"] == version_filename:
+            if entry.get("source"):
+                # 以前の形式のファイルと同じ内容のため、そのファイルを指している
+                version_filename = entry["source"]
+                break
+            object_path = os.path.join(_prompt_versions_dir(), "objects", f"{entry['sha256']}.md")
+            return get_prompt_asset(object_path).content
+
+    # 以前の形式（バージョン情報付きの全文コピー）
+    version_path = os.path.join(_prompt_versions_dir(), version_filename)
+    return _legacy_prompt_body(get_prompt_asset(version_path).content)
+
+def restore_prompt_version(version_filename):
+    """
+    指定したバージョンのプロンプトを現在のプロンプトとして復元
+
+    ファイルを丸ごと置き換えるため、生成中のセッションが書きかけの内容を読むことはない
+    """
+    prompt_content = load_prompt_version(version_filename)
+    _write_file_atomic(os.path.join(_prompts_dir(), MASTER_PROMPT_FILENAME), prompt_content)
+    return True
+
+# マスタープロンプトを読み込む
+def load_master_prompt():
+    return get_master_prompt_asset().content
+
+# ============================================================================
+# エンディングパターン検出（data/ending_patterns.json）
+# ============================================================================
+
+ENDING_PATTERNS_FILENAME = "ending_patterns.json"
+
+@dataclass(frozen=True)
+class EndingPatternLibrary:
+    """
+    エンディングパターン集（すべてのパターンを1つの正規表現にまとめてコンパイル済み）
+
+    パターンごとに名前付きグループ（id）で囲むため、一致したグループ名から
+    どのパターンかが分かる
+    """
+    names: dict
+    matcher: re.Pattern
+    ending_scenes: int
+    ending_chars: int
+    fallback_tail_chars: int
+
+def _data_dir():
+    return os.path.join(os.path.dirname(__file__), "data")
+
+def load_ending_pattern_library(path):
+    """
+    パターン集のデータファイルを読み込み、1つの正規表現にコンパイルする
+
+    Raises:
+        ValueError: idが名前付きグループに使えない・重複している、またはパターン内に捕捉グループがある
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    names = {}
+    alternatives = []
+    for entry in config["patterns"]:
+        pattern_id = entry["id"]
+        if not pattern_id.isidentifier() or pattern_id in names:
+            raise ValueError(f"エンディングパターンのidが不正です: {pattern_id}")
+        if re.compile(entry["pattern"]).groups:
+            raise ValueError(f"エンディングパターン {pattern_id} には (?:...) 以外のグループを使えません")
+        names[pattern_id] = entry["name"]
+        alternatives.append(f"(?P<{pattern_id}>{entry['pattern']})")
+
+    return EndingPatternLibrary(
+        names=names,
+        matcher=re.compile("|".join(alternatives), re.IGNORECASE | re.DOTALL),
+        ending_scenes=int(config.get("ending_scenes", 2)),
+        ending_chars=int(config.get("ending_chars", 200)),
+        fallback_tail_chars=int(config.get("fallback_tail_chars", 300)),
+    )
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _compiled_ending_patterns(path, signature):
+    return load_ending_pattern_library(path)
+
+def get_ending_pattern_library():
+    """パターン集を取得（データファイルが書き換えられない限りコンパイル済みのものを返す）"""
+    path = os.path.join(_data_dir(), ENDING_PATTERNS_FILENAME)
+    return _compiled_ending_patterns(path, _file_signature(path))
+
+def ending_text(scenario_text, library=None):
+    """
+    エンディングとして検出対象にする部分（後編の最後のページ）を取り出す
+
+    後編の最後の ending_scenes シーンのうち、末尾から ending_chars 文字（実測）に届くまでの行。
+    シーンの区切り（空行）がない出力でも後編全体を見ないようにする。
+    前編/後編に分けられない場合は末尾の fallback_tail_chars 文字を対象にする
+    """
+    library = library or get_ending_pattern_library()
+    document = parse_scenario(scenario_text)
+    if document.kohen is None or not document.kohen.scenes:
+        return scenario_text[-library.fallback_tail_chars:]
+
+    lines = [line for scene in document.kohen.scenes[-library.ending_scenes:] for line in scene.lines]
+    ending_lines = []
+    counted = 0
+    for line in reversed(lines):
+        ending_lines.append(line)
+        counted += count_characters(line)
+        if counted >= library.ending_chars:
+            break
+    return "\n".join(reversed(ending_lines))
+
+def find_ending_patterns(scenario_text, library=None):
+    """
+    エンディングに含まれるパターンのidを出現順に重複なく返す
+
+    Returns:
+        パターンidのリスト（該当なしなら空）
+    """
+    library = library or get_ending_pattern_library()
+    found = []
+    for match in library.matcher.finditer(ending_text(scenario_text, library)):
+        if match.lastgroup not in found:
+            found.append(match.lastgroup)
+    return found
+
+# エンディングパターン検出関数
+def detect_ending_pattern(scenario_text):
+    """
+    よくあるエンディングパターンを検出（後編の最後のページのみ）
+
+    Returns:
+        (is_pattern, pattern_name): パターンに該当するか、パターン名
+    """
+    library = get_ending_pattern_library()
+    match = library.matcher.search(ending_text(scenario_text, library))
+    if match:
+        return True, library.names[match.lastgroup]
+    return False, None
+
+def _scan_ending_chunk(texts):
+    """プロセスプール用：シナリオ本文のリストそれぞれのパターンidのリストを返す"""
+    library = get_ending_pattern_library()
+    return [find_ending_patterns(text, library) for text in texts]
+
+def scan_ending_patterns(processes=None, chunk_size=200):
+    """
+    履歴全体のエンディングパターンを集計する（プロセスプールで並列に検出）
+
+    ワーカーが app モジュールを読み込み直すため、cli.py など通常のPythonから呼ぶ。
+
+    Args:
+        processes: ワーカープロセス数（Noneなら CPU 数）
+        chunk_size: 1タスクで検出するシナリオ数
+
+    Returns:
+        {"total": 件数, "matched": 該当件数,
+         "by_pattern": {パターン名: 件数},
+         "by_tone": {トーン: {"total": 件数, "patterns": {パターン名: 件数}}},
+         "by_prompt_version": {バージョン: {"total": 件数, "patterns": {パターン名: 件数}}}}
+    """
+    report = {"total": 0, "matched": 0, "by_pattern": {}, "by_tone": {}, "by_prompt_version": {}}
+    if not os.path.exists(_history_dir()):
+        return report
+
+    conn = _connect_history_db()
+    try:
+        rows = conn.execute(
+            f"SELECT h.tone, h.prompt_version, h.result, {HISTORY_DATA_COLUMNS} FROM histories h ORDER BY h.created_at"
+        ).fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return report
+
+    # アーカイブ済みの行は本文を持たないためセグメントから読む
+    texts = [row["result"] or ((_history_row_data(row) or {}).get("result") or "") for row in rows]
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = [ids for chunk_ids in executor.map(_scan_ending_chunk, chunks) for ids in chunk_ids]
+
+    names = get_ending_pattern_library().names
+    for row, pattern_ids in zip(rows, results):
+        report["total"] += 1
+        report["matched"] += bool(pattern_ids)
+        for dimension, key in (("by_tone", row["tone"]), ("by_prompt_version", row["prompt_version"])):
+            group = report[dimension].setdefault(key or "不明", {"total": 0, "patterns": {}})
+            group["total"] += 1
+            for pattern_id in pattern_ids:
+                group["patterns"][names[pattern_id]] = group["patterns"].get(names[pattern_id], 0) + 1
+        for pattern_id in pattern_ids:
+            report["by_pattern"][names[pattern_id]] = report["by_pattern"].get(names[pattern_id], 0) + 1
+    return report
+
+# シナリオ自動チェック＆リライト関数
+# 短縮工程の固定指示（毎回同じ内容のためシステムプロンプトに置く）。
+# 数百トークンしかなく、プロンプトキャッシュの最小長（Haikuは2048トークン）に届かないため
+# cache_control は付けない（付けてもキャッシュされず、ヒット率の集計を紛らわしくするだけ）
+SHORTEN_SYSTEM_PROMPT = """
+ユーザーから渡される前後編シナリオの前編または後編を、指定された目標文字数以内に短縮してください。
+面白さやストーリーの内容を維持しながら、文字数を削減してください。
+
+【文字数のカウント方法】
+- 改行、※、「」、『』、■、（）、…、！、？、〜、スペースを除く
+
+【短縮の方法】
+- 冗長な表現を削除
+- 説明過多な部分を簡潔に
+- セリフや演出指示を効果的に使用
+- 1ページ=ひとつの感情変化を維持
+- ストーリーの面白さ、キャラクターの魅力、感情の盛り上がりは維持
+- 元のフォーマット（※の演出指示、名前「セリフ」の形式）を維持
+
+【重要】
+- 文字数を削減する際、内容の質を落とさないこと
+- 簡潔かつインパクトのある表現に変更すること
+- 出力は短縮した本文のみ（見出し、文字数表記、分析や評価コメントは不要）
+"""
+
+def shorten_scenario(api_key, half_text, half_name="後編", target_chars=HALF_CHAR_LIMIT, cache_mode=CACHE_OFF, metrics=None):
+    """
+    前編または後編の片方だけを短縮する（文字数制限オーバー時）
+    
+    Args:
+        api_key: Anthropic APIキー
+        half_text: 短縮する前編/後編の本文（■前編/■後編の見出しと文字数表記は含まない。
+            途中で切れた本文は末尾に TRUNCATION_NOTE が付いている）
+        half_name: "前編" または "後編"
+        target_chars: 目標文字数（デフォルト500文字）
+        cache_mode: レスポンスキャッシュの利用方法
+        metrics: 呼び出しの計測値を追加するリスト
+    
+    Returns:
+        短縮された本文
+
+    Raises:
+        ScenarioGenerationError: API呼び出しに失敗した場合
+    """
+    # 受信の打ち切りや max_tokens で途中で切れた本文は、結末まで書き切るよう依頼する
+    half_text, truncated = strip_truncation_note(half_text)
+    current_chars = count_characters(half_text)
+    # 元より長い結果は使わない。途中で切れた本文は目標文字数を大きく超えた時点で打ち切る
+    stop_chars = target_chars + TRUNCATED_SHORTEN_MARGIN if truncated else current_chars
+    reduction = f"（{current_chars - target_chars}文字以上削減）" if current_chars > target_chars else ""
+    truncation_notice = f"""
+【注意】
+この{half_name}は長くなりすぎたため途中で打ち切っています。短縮しながら結末まで書き切ってください。
+""" if truncated else ""
+
+    shorten_prompt = f"""
+以下は前後編シナリオの「{half_name}」です。文字数が制限を超えています。
+
+【目標文字数】
+- 現在：{current_chars}文字
+- 目標：{target_chars}文字以内{reduction}
+{truncation_notice}
+【この{half_name}で必ず残すもの】
+- {"前編ラストの「引き」と後編タイトルの表示" if half_name == "前編" else "ラストの爽快感・読後感"}
+
+【元の{half_name}】
+{half_text.strip()}
+
+出力は短縮した{half_name}の本文のみ（「■{half_name}」の見出し、文字数表記は不要）
+"""
+    
+    shortened = call_messages(
+        api_key,
+        cache_mode=cache_mode,
+        stage="shorten",
+        metrics=metrics,
+        stop_when=lambda text: count_characters(text) >= stop_chars,
+        model="claude-haiku-3-5-20250313",
+        max_tokens=output_token_budget(stop_chars, SHORTEN_OVERHEAD_TOKENS),
+        stop_sequences=FOOTER_STOP_SEQUENCES,
+        temperature=0.3,  # 短縮は低温度で確実に
+        system=SHORTEN_SYSTEM_PROMPT,
+        messages=[
+            {"role": "user", "content": shorten_prompt}
+        ]
+    )
+
+    # 指示に反して付いた見出し・文字数表記を取り除く
+    shortened = shortened.strip()
+    for marker in ("■前編", "■後編"):
+        if shortened.startswith(marker):
+            shortened = shortened[len(marker):]
+    match = SCENARIO_FOOTER_PATTERN.search("\n" + shortened)
+    if match:
+        shortened = ("\n" + shortened)[:match.start()]
+    return "\n" + shortened.strip() + "\n\n"
+
+def _shorten_half_until_fit(api_key, half_text, half_name, max_retries, cache_mode, metrics=None):
+    """
+    前編/後編の片方を上限内に収まるまで短縮する
+
+    文字数が減らなかった時点で打ち切る（同じ結果を何度も依頼しない）。
+    途中で切れた本文（TRUNCATION_NOTE 付き）は上限内でも結末まで書き切らせ、
+    書き切れて上限内に収まった結果だけを使う。リトライを使い切った場合は
+    印と書きかけの行を外した元の本文に戻す
+
+    Returns:
+        (本文, 変更したかどうか)
+    """
+    count = _parse_half(half_name, half_text).char_count
+    truncated = TRUNCATION_NOTE in half_text
+    changed = False
+    for i in range(max_retries):
+        if count <= HALF_CHAR_LIMIT and not truncated:
+            break
+        shortened = shorten_scenario(api_key, half_text, half_name, HALF_CHAR_LIMIT, cache_mode=cache_mode, metrics=metrics)
+        shortened_count = _parse_half(half_name, shortened).char_count
+        if truncated:
+            if TRUNCATION_NOTE in shortened or shortened_count > HALF_CHAR_LIMIT:
+                continue  # また途中で切れた・上限を超えた結果は使わない
+            truncated = False
+        elif shortened_count >= count:
+            break  # 縮まなければ打ち切り
+        half_text, count, changed = shortened, shortened_count, True
+
+    if truncated:
+        return strip_truncation_note(half_text)[0], True
+    return half_text, changed
+
+def enforce_char_limit(api_key, scenario_text, max_retries=3, cache_mode=CACHE_OFF, metrics=None):
+    """
+    文字数制限を強制する（オーバー時は自動短縮）
+
+    上限を超えている（または受信を打ち切って途中で切れた）前編/後編だけを短縮して元の位置に差し戻し、
+    上限内の側はそのまま残す。両方超えている場合は並列に短縮する。
+    
+    Args:
+        api_key: Anthropic APIキー
+        scenario_text: チェックするシナリオ
+        max_retries: 前編/後編それぞれの最大リトライ回数
+        cache_mode: レスポンスキャッシュの利用方法
+        metrics: 呼び出しの計測値を追加するリスト
+    
+    Returns:
+        文字数制限内に収まったシナリオ（短縮した場合は文字数表記を実測値に更新）
+
+    Raises:
+        ScenarioGenerationError: 短縮のAPI呼び出しに失敗した場合
+    """
+    document = parse_scenario(scenario_text)
+    if not document.has_halves:
+        return scenario_text
+    zenpen_text, kohen_text = document.zenpen.text, document.kohen.text
+
+    over_halves = [
+        (half.name, half.text)
+        for half in (document.zenpen, document.kohen)
+        if half.is_over_limit or TRUNCATION_NOTE in half.text
+    ]
+    if not over_halves:
+        return scenario_text  # 制限内ならそのまま返す
+
+    # オーバーしている側だけ短縮を試行
+    with ThreadPoolExecutor(max_workers=len(over_halves), thread_name_prefix="shorten") as executor:
+        futures = {
+            half_name: executor.submit(_shorten_half_until_fit, api_key, half_text, half_name, max_retries, cache_mode, metrics)
+            for half_name, half_text in over_halves
+        }
+        results = {half_name: future.result() for half_name, future in futures.items()}
+
+    if not any(changed for _, changed in results.values()):
+        return scenario_text  # 1文字も縮まなかった場合は元のまま返す
+
+    zenpen_text = results.get("前編", (zenpen_text, False))[0]
+    kohen_text = results.get("後編", (kohen_text, False))[0]
+    return join_scenario_halves(document.head, zenpen_text, kohen_text)
+
+# リライト工程の固定指示（毎回同じ内容のためシステムプロンプトに置く）。
+# messages.count_tokens で測ると約1,900トークン（1,884）で、プロンプトキャッシュの最小長
+# （Haikuは2048トークン）に届かないため、SHORTEN_SYSTEM_PROMPT と同じく cache_control は付けない
+REWRITE_SYSTEM_PROMPT = """
+ユーザーから渡されるシナリオを、チェック基準に基づいて 客観的に自己評価 → 問題点抽出 → 最適な形にリライト してください。
+トーンは漫画のネーム用のシナリオとして、テンポよく、読者にとって理解しやすく、感情移入しやすい形に整えてください。
+ユーザーの指示（パターン検出・視点の維持など）がある場合は、それも必ず守ってください。
+
+【ステップ1：問題点の抽出】※内部処理のみ、出力不要
+
+以下のチェック基準に照らして、改善すべき点を把握：
+
+▼ チェック基準
+1. ストーリーのつじつま
+   - 設定の矛盾はないか
+   - 行動の必然性はあるか
+   - 状況説明は明瞭か
+   - 現実味はあるか（倫理観、違法行為、NG描写）
+
+2. セリフと感情の自然さ
+   - 会話の流れは自然か
+   - 年齢・性格に合った話し方か
+   - ポエム調・文学調を避けているか
+   - 共感を生む感情描写になっているか
+
+3. 話のまとまり・伏線回収
+   - 伏線の貼り方と回収
+   - 展開テンポ
+   - ラストの納得感
+
+4. エンディングのパターン化チェック【重要】
+   - よくあるパターン（夕暮れ散歩、窓からの光など）に該当していないか
+   - バリエーションのあるエンディングになっているか
+   - 面白さを保ちつつ、パターン化を避けられているか
+
+5. テーマ/ネタへの忠実性【超重要】
+   - 入力されたテーマ/ネタに記載されている内容のみを使用しているか
+   - テーマに記載されていない設定・情報・要素（警察、裁判所、会社、学校など）を追加していないか
+   - テーマから大きく逸脱した展開になっていないか
+
+6. 文字数と簡潔性【超重要】
+   - 前編：500文字以内、後編：500文字以内、合計：1000文字以内に収まっているか
+   - 物語を不必要に膨らませていないか
+   - 簡潔でインパクトのある展開になっているか
+
+7. 追加基準
+   - 冒頭5コマで「何の話か」理解できるか
+   - 主人公の魅力が一言で言えるか
+   - 感情のアップダウンが設計されているか
+   - ラストに読後の"ご褒美"があるか
+
+【ステップ2：シナリオの完全リライト版を生成】
+
+以下の条件を守って、最適化したシナリオを出力してください。
+
+▼ リライト条件
+- 1話10〜14Pのショート漫画を想定（前後編形式）
+- テンポの良いネーム用シナリオ
+- **【最重要】前後編でそれぞれ完結しつつ、後編を絶対に読みたくなる構造**
+  - 前編 = 問題提示 + 小解決（満足度60%）
+  - 後編 = 真相 + 本質的解決（満足度100%）
+  - 前編ラストに必ず「強烈な引き」を入れる（裏の事実／新キャラ登場／本当の問題／味方の違和感／深刻な予兆）
+  - 前編最後に後編タイトルを表示（例：`後編『〜』`）
+- **1ページ=ひとつの感情変化**を基本にする
+- キャラの行動と感情が自然
+- 読者（30〜45歳女性）が共感
+- セリフは短く、説明過多を避ける
+- ナレーション/モノローグ/描写のメリハリ
+- クライマックスに向けて段階的に盛り上げる
+- 伏線は自然に回収
+- **エンディングのパターン化回避【重要】**：
+  - よくあるパターン（夕暮れ散歩、窓からの光と前向きな言葉、桜の下での告白など）は絶対に避ける
+  - 面白さ・感動・共感を保ちつつ、バリエーションのあるエンディングにする
+  - 日常の何気ないシーンで、感情の回収、共感ポイント、インパクト、未来への示唆を含める
+  - ポエム調・文学調は避け、自然な会話や行動で締める
+- 後編ラストは爽快感・解放感（ポエム調禁止）
+- NG描写（鬱・殺人・宗教・差別・過度な暴力）なし
+- **文字数制限【より厳格に】**：
+  - 前編：最大500文字以内（推奨400〜500文字）
+  - 後編：最大500文字以内（推奨400〜500文字）
+  - 合計：最大1000文字以内（推奨800〜1000文字）
+  - 絶対に上限を超えないこと
+  - 物語を膨らませすぎず、簡潔でインパクトのある展開を心がけること
+- カウント方法：改行、※、「」、『』、■、（）、…、！、？、〜、スペースを除く
+- **制限内で面白さ最大化**：冗長な表現を削り、簡潔かつインパクトのある表現に
+- **テーマ/ネタへの忠実性【最重要】**：
+  - 入力されたテーマ/ネタに記載されている内容のみを使用すること
+  - テーマに記載されていない設定・情報・要素（警察、裁判所、会社、学校、病院など）は一切追加しない
+  - テーマから大きく逸脱した展開は絶対に避けること
+
+【重要】出力はリライトしたシナリオのみ。分析や評価コメントは不要です。
+元のシナリオのフォーマット（【登場人物】から始まる形式）を維持してください。
+"""
+
+def check_and_fix_scenario(api_key, scenario_draft, viewpoint="主人公目線（デフォルト）", on_progress=None, cache_mode=CACHE_OFF, metrics=None):
+    """
+    生成されたシナリオを自動でチェックし、品質向上のためにリライトする
+    
+    Args:
+        api_key: Anthropic APIキー
+        scenario_draft: リライト前のシナリオ
+        viewpoint: 視点の選択（リライト時にも視点を維持するため）
+        on_progress: 指定時はストリーミングで受信し on_progress(text, output_tokens) を呼ぶ
+        cache_mode: レスポンスキャッシュの利用方法
+        metrics: 呼び出しの計測値を追加するリスト
+
+    Returns:
+        リライトして文字数制限内に収めたシナリオ
+
+    Raises:
+        ScenarioGenerationError: リライトまたは短縮のAPI呼び出しに失敗した場合
+    """
+    # 途中で切れた初稿は印と書きかけの行を外し、結末まで書き切るよう指示する
+    scenario_draft, truncated = strip_truncation_note(scenario_draft)
+    truncation_notice = """
+【注意】
+元のシナリオの後編は長くなりすぎたため途中で打ち切っています。
+後編を上限内に収めながら、結末まで書き切ってください。
+""" if truncated else ""
+
+    # パターン検出
+    is_pattern, pattern_name = detect_ending_pattern(scenario_draft)
+    
+    # 視点維持の指示
+    viewpoint_maintain = ""
+    if viewpoint != "主人公目線（デフォルト）":
+        viewpoint_maintain = f"""
+【視点の維持】
+リライト時も、「{viewpoint}」の視点を維持してください。
+視点が変わらないよう、注意してください。
+"""
+
+    # パターン検出時の追加指示
+    pattern_warning = ""
+    if is_pattern:
+        pattern_warning = f"""
+⚠️ **パターン検出**: エンディングに「{pattern_name}」が検出されました。
+以下の点を必ず守ってリライトしてください：
+- このパターンを避け、バリエーションのあるエンディングに変更する
+- ただし、面白さ・感動・共感ポイントは維持する
+- 感情の回収、印象に残る要素、未来への示唆を含める
+- 日常の何気ないシーンで、自然な会話や行動で締める
+"""
+
+    rewrite_prompt = f"""
+以下のシナリオをリライトしてください。
+
+{pattern_warning}
+{viewpoint_maintain}
+{truncation_notice}
+【元のシナリオ】
+{scenario_draft}
+"""
+
+    # リライト工程もHaikuで実施（コスト削減）
+    rewritten_scenario = call_messages(
+        api_key,
+        on_progress=on_progress,
+        cache_mode=cache_mode,
+        stage="rewrite",
+        metrics=metrics,
+        stop_when=scenario_overrun,
+        model="claude-haiku-3-5-20250313",
+        max_tokens=output_token_budget(TOTAL_CHAR_LIMIT),
+        stop_sequences=FOOTER_STOP_SEQUENCES,
+        temperature=0.5,
+        system=REWRITE_SYSTEM_PROMPT,
+        messages=[
+            {"role": "user", "content": rewrite_prompt}
+        ]
+    )
+
+    # 文字数制限の強制実行
+    return enforce_char_limit(api_key, complete_scenario_footer(rewritten_scenario), cache_mode=cache_mode, metrics=metrics)
+
+# ============================================================================
+# シナリオ生成関数
+# ============================================================================
+
+def load_viewpoint_prompt():
+    """視点変更プロンプトを読み込む"""
+    prompt_path = os.path.join(_prompts_dir(), VIEWPOINT_PROMPT_FILENAME)
+    if os.path.exists(prompt_path):
+        return get_prompt_asset(prompt_path).content
+    return ""
+
+def generate_viewpoint_instruction(viewpoint, theme):
+    """視点に応じたプロンプト指示を生成"""
+    if viewpoint == "主人公目線（デフォルト）":
+        return ""
+    
+    # カスタム視点の場合
+    if viewpoint not in ["親友・友人目線", "第三者の視点", "体験談から自動変換（親友目線推奨）"]:
+        # カスタム入力された視点
+        return f"""
+【視点変更指示：カスタム視点】
+以下のテーマ/ネタを「{viewpoint}」のストーリーに変換してください。
+
+視点変更のポイント：
+- 指定された視点「{viewpoint}」でストーリーを語る
+- その視点の人物の感情・思考・行動を中心に描写
+- その視点から見た他の人物の様子を描写
+- その視点の人物がどう感じたか、どう行動したかを明確に
+- その視点の人物と他の登場人物の関係を明確に
+- なぜその視点の人物が行動するのか、動機を明確に
+
+ストーリーの内容は維持しつつ、視点のみを変更してください。
+視点が一貫していること、自然な語り口であることを重視してください。
+"""
+    
+    # 視点変更の指示を生成
+    if viewpoint == "親友・友人目線":
+        return """
+【視点変更指示】
+以下のテーマ/ネタを「親友・友人目線」のストーリーに変換してください。
+
+視点変更のポイント：
+- 体験談の内容を、親友の視点から語られるストーリーにする
+- 語り手は親友・友人で、主人公を「彼女」「彼」などと呼ぶ
+- 親友の目線で見た主人公の様子を描写
+- 親友が主人公のために行動する動機・感情を明確に
+- 親友自身の成長や変化も描写に含める
+
+ストーリーの内容は維持しつつ、視点のみを変更してください。
+"""
+    elif viewpoint == "第三者の視点":
+        return """
+【視点変更指示】
+以下のテーマ/ネタを「第三者の視点」のストーリーに変換してください。
+
+視点変更のポイント：
+- 客観的な視点から物語を見る
+- 複数の人物の感情・行動を描く
+- ナレーション的な視点
+
+ストーリーの内容は維持しつつ、視点のみを変更してください。
+"""
+    elif viewpoint == "体験談から自動変換（親友目線推奨）":
+        # 体験談かどうかを簡易判定（「私」「僕」「自分」などの一人称が含まれているか）
+        if any(word in theme for word in ["私", "僕", "自分", "私の", "僕の"]):
+            return """
+【視点変更指示：体験談から親友目線への自動変換】
+入力されたテーマ/ネタは体験談形式です。これを「親友・友人目線」のストーリーに自動変換してください。
+
+変換のポイント：
+- 体験談の主語となっている人物を「親友」に置き換える
+- 語り手を「私（親友）」に変更する
+- 「私の親友が...」「友人が...」という形式にする
+- 体験談の内容は維持するが、語り手を友人に変更
+- 友人の目線で見た主人公の様子を描写
+- 友人が主人公のために行動する動機・感情を明確に
+
+例：
+- 体験談：「夫にモラハラされていた私が、親友の一言で離婚を決意...」
+- → 親友目線：「私の親友が夫にモラハラされていた。ある日、私が彼女に伝えた一言が...」
+
+ストーリーの内容は維持しつつ、視点のみを変更してください。
+"""
+    return ""
+
+def generate_scenario(api_key, theme, story_format, tone, additional_notes="", viewpoint="主人公目線（デフォルト）", on_progress=None, cache_mode=CACHE_OFF, prompt_asset=None, metrics=None, sample_index=0):
+    """
+    Claude APIを使用してシナリオを生成
+    
+    Args:
+        api_key: Anthropic APIキー
+        theme: テーマ/ネタ
+        story_format: ストーリー形式（前後編など）
+        tone: トーン/雰囲気
+        additional_notes: 追加の要望
+        viewpoint: 視点の選択
+        on_progress: 指定時はストリーミングで受信し on_progress(text, output_tokens) を呼ぶ
+        cache_mode: レスポンスキャッシュの利用方法
+        prompt_asset: 使用するマスタープロンプト（省略時は現在のもの）
+        metrics: 呼び出しの計測値を追加するリスト
+        sample_index: 複数の候補を作る場合の候補番号（レスポンスキャッシュを候補ごとに分ける）
+        
+    Returns:
+        生成されたシナリオのテキスト（文字数表記は実測値。後編が大きく超えた場合は途中で打ち切り、
+        末尾に TRUNCATION_NOTE を付ける）
+
+    Raises:
+        ScenarioGenerationError: API呼び出しに失敗した場合
+    """
+
+    master_prompt = (prompt_asset or get_master_prompt_asset()).content
+
+    # 視点変更の指示を生成
+    viewpoint_instruction = generate_viewpoint_instruction(viewpoint, theme)
+    
+    # ユーザー入力を構造化
+    # 文字数ガイドライン設定
+    if "前後編" in story_format:
+        char_limit = """
+【必須】文字数制限【より厳格に】：
+- **前編：最大500文字以内（推奨400〜500文字）**
+- **後編：最大500文字以内（推奨400〜500文字）**
+- **合計：最大1000文字以内（推奨800〜1000文字）**
+- **絶対に上限を超えないこと**
+- **物語を膨らませすぎず、簡潔でインパクトのある展開を心がけること**
+
+【厳密】文字数カウント方法：
+- 改行、記号（※、「」、『』、■、（）、…、！、？、〜など）、スペースを除いた純粋なテキスト文字のみカウント
+- 登場人物セクションは文字数に含めない（シナリオ本文のみカウント）
+- カウント例：
+  - `A子「こんにちは」※笑顔` → カウント「A子こんにちは笑顔」= 9文字
+  - `※夜、仕事から帰宅したA子` → カウント「夜仕事から帰宅したA子」= 12文字
+
+【重要】簡潔性と面白さのバランス：
+- 制限内で最高の面白さを実現すること
+- **冗長な表現は徹底的に削る**
+- **文字数を増やすために物語を不必要に膨らませない**
+- **簡潔でインパクトのある展開を優先すること**
+- ストーリーの面白さ、キャラクターの魅力、感情の盛り上がりを大切に
+- 簡潔かつインパクトのある表現を心がける
+
+【必須】シナリオ出力時の文字数表記：
+- シナリオ本文の最後に、必ず以下の形式で実際の文字数を明記してください
+- 例：`文字数：前編482文字 / 後編518文字 / 合計1000文字`
+- 出力前に必ず文字数を実測し、制限内に収めること
+"""
+    else:
+        char_limit = ""
+
+    user_prompt = f"""
+以下の条件で恋愛漫画のシナリオを生成してください。
+
+{viewpoint_instruction}
+
+【形式】
+{story_format}
+
+【テーマ/ネタ】
+{theme}
+
+【トーン/雰囲気】
+{tone}
+
+【追加の要望】
+{additional_notes if additional_notes else "特になし"}
+
+【最重要】テーマ/ネタに忠実であること：
+- 上記のテーマ/ネタに記載されている内容のみを使用すること
+- テーマに記載されていない設定・情報・要素（警察、裁判所、会社、学校、病院など）は一切追加しない
+- テーマから大きく逸脱した展開は絶対に避けること
+- テーマに記載されている登場人物・場所・状況のみを使用すること
+
+{char_limit}
+上記の【シナリオ生成のための統合ナレッジ】と【出力形式】に従って、バズる恋愛漫画のシナリオを生成してください。
+"""
+
+    # プロンプトキャッシュを使用してコスト削減
+    # temperature: 文字数制限など具体的な制約がある場合は低めに設定
+    # 文字数表記の手前で止め、後編が大きく超えたら受信を打ち切る（短縮は後段の工程で行う）
+    draft = call_messages(
+        api_key,
+        on_progress=on_progress,
+        cache_mode=cache_mode,
+        stage="draft",
+        metrics=metrics,
+        cache_variant=sample_index,
+        stop_when=scenario_overrun,
+        model="claude-sonnet-4-5-20250929",
+        max_tokens=output_token_budget(TOTAL_CHAR_LIMIT),
+        stop_sequences=FOOTER_STOP_SEQUENCES,
+        temperature=0.7,  # 1.0から0.7に変更（より指示に従いやすく）
+        system=[
+            {
+                "type": "text",
+                "text": master_prompt,
+                "cache_control": {"type": "ephemeral"}
+            }
+        ],
+        messages=[
+            {"role": "user", "content": user_prompt}
+        ]
+    )
+    return complete_scenario_footer(draft)
+
+# ============================================================================
+# 初稿の複数候補生成（Best-of-N）
+# ============================================================================
+
+# 初稿の候補数の上限（同時に投げるリクエスト数）
+MAX_DRAFT_CANDIDATES = 4
+
+def score_scenario_draft(scenario_text):
+    """
+    初稿をローカルで採点する（APIは呼ばない）
+
+    - 構成：【登場人物】・前編・後編がそろい、どちらにもシーンがあるか
+    - 書き切っているか：途中で打ち切っていない（TRUNCATION_NOTE がない）か
+    - 文字数：前編/後編500文字・合計1000文字以内か（超過は超過分に応じて減点）、短すぎないか
+    - エンディング：よくあるパターンに該当しないか
+
+    文字数表記は generate_scenario が実測値で付け直すため採点しない
+
+    Returns:
+        {"score": 点数, "passes": リライト不要か, "issues": 問題点のリスト,
+         "structure_ok": 前編/後編（シーンあり）と【登場人物】がそろっているか,
+         "truncated": 途中で打ち切っているか, "within_limit": 文字数制限内か,
+         "ending_pattern": 該当したエンディングパターン名（なければ空）,
+         "zenpen_chars": 前編文字数, "kohen_chars": 後編文字数}
+    """
+    document = parse_scenario(scenario_text)
+    score = 100.0
+    issues = []
+
+    if not document.has_halves:
+        score -= 60
+        issues.append("前編/後編がそろっていない")
+    if not document.characters:
+        score -= 10
+        issues.append("【登場人物】がない")
+    has_scenes = document.has_halves and bool(document.zenpen.scenes and document.kohen.scenes)
+    if document.has_halves and not has_scenes:
+        score -= 30
+        issues.append("シーンのない話がある")
+    truncated = TRUNCATION_NOTE in scenario_text
+    if truncated:
+        score -= 30
+        issues.append("途中で打ち切り")
+
+    overage = max(0, document.zenpen_count - HALF_CHAR_LIMIT) + max(0, document.kohen_count - HALF_CHAR_LIMIT)
+    if overage:
+        score -= 10 + overage * 0.2
+        issues.append(f"文字数超過（{overage}文字）")
+    elif document.has_halves and document.total_count < RECOMMENDED_MIN_TOTAL_CHARS:
+        score -= (RECOMMENDED_MIN_TOTAL_CHARS - document.total_count) * 0.05
+        issues.append(f"合計{document.total_count}文字（推奨{RECOMMENDED_MIN_TOTAL_CHARS}文字以上）")
+
+    is_pattern, pattern_name = detect_ending_pattern(scenario_text)
+    if is_pattern:
+        score -= 25
+        issues.append(f"エンディングが「{pattern_name}」")
+
+    return {
+        "score": round(score, 1),
+        "passes": (
+            has_scenes and bool(document.characters) and not truncated
+            and document.is_within_limit and not is_pattern
+        ),
+        "issues": issues,
+        "structure_ok": has_scenes and bool(document.characters),
+        "truncated": truncated,
+        "within_limit": document.is_within_limit,
+        "ending_pattern": pattern_name if is_pattern else "",
+        "zenpen_chars": document.zenpen_count,
+        "kohen_chars": document.kohen_count,
+    }
+
+def generate_best_draft(api_key, theme, story_format, tone, additional_notes="", viewpoint=DEFAULT_VIEWPOINT, candidates=3, cache_mode=CACHE_OFF, prompt_asset=None, metrics=None, on_candidate=None):
+    """
+    初稿を複数同時に生成し、ローカルの採点で最も良いものを選ぶ
+
+    全候補が同じマスタープロンプト（cache_control付きのシステムプロンプト）を使うため、
+    プロンプトキャッシュが効いていれば入力分の料金はほぼ1回分で済む。
+
+    Args:
+        candidates: 候補数（1〜MAX_DRAFT_CANDIDATES）
+        on_candidate: 候補が1つ届くたびに on_candidate(届いた数, 候補数) を呼ぶ（呼び出し元のスレッドで呼ばれる）
+        その他: generate_scenario と同じ
+
+    Returns:
+        (最良の初稿, 採点結果のリスト（点数の高い順、各要素に "index" と "text" を含む）)
+        失敗した候補は除く
+
+    Raises:
+        ScenarioGenerationError: 全候補が失敗した場合（最初の失敗を送出）
+    """
+    candidates = max(1, min(candidates, MAX_DRAFT_CANDIDATES))
+    prompt_asset = prompt_asset or get_master_prompt_asset()
+
+    results = []
+    errors = []
+    with ThreadPoolExecutor(max_workers=candidates, thread_name_prefix="draft") as executor:
+        futures = {
+            executor.submit(
+                generate_scenario, api_key, theme, story_format, tone, additional_notes, viewpoint,
+                cache_mode=cache_mode, prompt_asset=prompt_asset, metrics=metrics, sample_index=index
+            ): index
+            for index in range(candidates)
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                text = future.result()
+                results.append(dict(score_scenario_draft(text), index=futures[future], text=text))
+            except ScenarioGenerationError as e:
+                errors.append(e)
+            if on_candidate:
+                on_candidate(done, candidates)
+
+    if not results:
+        raise errors[0]
+    results.sort(key=lambda r: (r["passes"], r["score"], -r["index"]), reverse=True)
+    return results[0]["text"], results
+
+# ============================================================================
+# リライト要否の判定（ローカルのチェックでAPI呼び出しを省く）
+# ============================================================================
+# 初稿をローカルで採点し、基準を満たしていればリライトを省き、
+# 文字数の超過だけが問題なら短縮だけを行う。
+
+REWRITE_ALWAYS = "always"      # 常にリライトする
+REWRITE_ADAPTIVE = "adaptive"  # ローカルのチェックで必要な工程だけ行う
+REWRITE_NEVER = "never"        # リライトせず、文字数の超過だけ短縮する
+REWRITE_POLICIES = {
+    REWRITE_ALWAYS: "常にリライト",
+    REWRITE_ADAPTIVE: "必要なときだけ",
+    REWRITE_NEVER: "リライトしない",
+}
+
+# 判定結果（履歴の "rewrite" に保存する action）
+REWRITE_ACTION_REWRITE = "rewrite"  # リライト → 文字数制限
+REWRITE_ACTION_SHORTEN = "shorten"  # 文字数制限（超過した側の短縮）だけ
+REWRITE_ACTION_SKIP = "skip"        # 初稿をそのまま使う
+REWRITE_ACTION_LABELS = {
+    REWRITE_ACTION_REWRITE: "リライト",
+    REWRITE_ACTION_SHORTEN: "短縮のみ",
+    REWRITE_ACTION_SKIP: "省略",
+}
+
+def default_rewrite_policy():
+    """環境変数 REWRITE_POLICY（always / adaptive / never、デフォルト: adaptive）"""
+    policy = os.getenv("REWRITE_POLICY", REWRITE_ADAPTIVE)
+    return policy if policy in REWRITE_POLICIES else REWRITE_ADAPTIVE
+
+def plan_rewrite(scenario_draft, policy=REWRITE_ADAPTIVE, score=None):
+    """
+    初稿に対して行う工程を決める（APIは呼ばない）
+
+    - always: 常にリライト
+    - adaptive: 基準を満たしていれば省略、構成とエンディングに問題がなく文字数の超過か途中の打ち切りだけなら
+      短縮のみ（打ち切られた話は短縮の工程で結末まで書き切る）、それ以外はリライト
+    - never: 文字数を超過しているか途中で打ち切っていれば短縮のみ、それ以外は省略
+
+    Args:
+        score: score_scenario_draft の結果（Best-of-Nで採点済みなら渡す）
+
+    Returns:
+        {"policy", "action", "score", "issues"}（履歴の "rewrite" にそのまま保存する）
+    """
+    if policy not in REWRITE_POLICIES:
+        raise ValueError(f"未対応のリライト方針です: {policy}")
+    score = score or score_scenario_draft(scenario_draft)
+
+    if policy == REWRITE_ALWAYS:
+        action = REWRITE_ACTION_REWRITE
+    elif score["passes"]:
+        action = REWRITE_ACTION_SKIP
+    elif policy == REWRITE_NEVER or (score["structure_ok"] and not score["ending_pattern"]):
+        needs_shorten = not score["within_limit"] or score["truncated"]
+        action = REWRITE_ACTION_SHORTEN if needs_shorten else REWRITE_ACTION_SKIP
+    else:
+        action = REWRITE_ACTION_REWRITE
+    return {"policy": policy, "action": action, "score": score["score"], "issues": score["issues"]}
+
+def refine_draft(api_key, scenario_draft, plan, viewpoint=DEFAULT_VIEWPOINT, on_progress=None, cache_mode=CACHE_OFF, metrics=None):
+    """
+    plan_rewrite の判定に従って初稿を仕上げる
+
+    Returns:
+        最終的なシナリオ
+
+    Raises:
+        ScenarioGenerationError: リライトまたは短縮のAPI呼び出しに失敗した場合
+    """
+    if plan["action"] == REWRITE_ACTION_REWRITE:
+        final_scenario = check_and_fix_scenario(
+            api_key, scenario_draft, viewpoint, on_progress=on_progress, cache_mode=cache_mode, metrics=metrics
+        )
+    elif plan["action"] == REWRITE_ACTION_SHORTEN:
+        final_scenario = enforce_char_limit(api_key, scenario_draft, cache_mode=cache_mode, metrics=metrics)
+    else:
+        final_scenario = scenario_draft
+    return final_scenario
+
+def describe_rewrite_plan(plan):
+    """判定結果の表示用の文（例: 「リライト: 短縮のみ（文字数超過（32文字））」）"""
+    label = REWRITE_ACTION_LABELS.get(plan.get("action"), plan.get("action", ""))
+    issues = "、".join(plan.get("issues") or [])
+    reason = f"（{issues}）" if issues else "（基準を満たしている）"
+    return f"リライト: {label}{reason} / 方針: {REWRITE_POLICIES.get(plan.get('policy'), plan.get('policy', ''))}"
+
+# ============================================================================
+# 履歴データベース（SQLite + FTS5全文検索）
+# ============================================================================
+# 生成履歴の本体は output/ のJSONファイル。history.db はその索引で、
+# いつでもJSONファイルから作り直せる（import_history_files）。
+
+HISTORY_FILE_PATTERN = re.compile(r"^scenario_\d{8}_\d{6}(?:_\d+)?\.json$")
+
+# 検索対象の列
+HISTORY_SEARCH_COLUMNS = ("theme", "tone", "additional_notes", "result")
+
+def _history_dir():
+    return _output_dir()
+
+def _history_db_path():
+    return os.path.join(_history_dir(), "history.db")
+
+@st.cache_resource
+def _history_db_state():
+    """スキーマ作成済みかどうか・FTS5が使えるかをプロセス内で保持"""
+    return {"lock": threading.Lock(), "ready_path": None, "fts": False}
+
+def _connect_history_db():
+    """履歴データベースに接続（初回はスキーマ作成と既存JSONの取り込みを行う）"""
+    db_path = _history_db_path()
+    state = _history_db_state()
+    if state["ready_path"] != db_path or not os.path.exists(db_path):
+        with state["lock"]:
+            if state["ready_path"] != db_path or not os.path.exists(db_path):
+                _initialize_history_db(db_path, state)
+
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+# 統計の集計軸（history_statsのdimension → 集計する式）
+HISTORY_STATS_DIMENSIONS = {
+    "total": "''",
+    "tone": "{row}.tone",
+    "date": "substr({row}.created_at, 1, 10)",
+    "viewpoint": "{row}.viewpoint",
+    "prompt_version": "{row}.prompt_version",
+    "edited": "CAST({row}.is_edited AS TEXT)",
+}
+
+# 統計に関わる列（保存位置の変更など、これ以外の列の更新では集計し直さない）
+HISTORY_STATS_COLUMNS = "created_at, tone, viewpoint, prompt_version, is_edited"
+
+def _stats_keys_sql(row):
+    """トリガー内で使う (dimension, key) の VALUES 句"""
+    return ", ".join(
+        f"('{dimension}', {expression.format(row=row)})"
+        for dimension, expression in HISTORY_STATS_DIMENSIONS.items()
+    )
+
+def _migrate_history_db_v1(conn):
+    """履歴テーブルを作成"""
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS histories (
+            id TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            theme TEXT NOT NULL DEFAULT '',
+            story_format TEXT NOT NULL DEFAULT '',
+            tone TEXT NOT NULL DEFAULT '',
+            viewpoint TEXT NOT NULL DEFAULT '',
+            prompt_version TEXT NOT NULL DEFAULT '',
+            additional_notes TEXT NOT NULL DEFAULT '',
+            result TEXT NOT NULL DEFAULT '',
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_histories_created_at ON histories(created_at DESC);
+    """)
+
+def _migrate_history_db_v2(conn):
+    """
+    統計テーブルを作成
+
+    件数は histories へのINSERT/DELETE/UPDATE時にトリガーで増減させるため、
+    save_history・update_history・delete_history のたびに差分だけ更新される
+    """
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(histories)")]
+    if "is_edited" not in columns:
+        conn.execute("ALTER TABLE histories ADD COLUMN is_edited INTEGER NOT NULL DEFAULT 0")
+        for history_id, data in conn.execute("SELECT id, data FROM histories").fetchall():
+            if json.loads(data).get("is_edited"):
+                conn.execute("UPDATE histories SET is_edited = 1 WHERE id = ?", (history_id,))
+
+    conn.executescript(f"""
+        CREATE TABLE IF NOT EXISTS history_stats (
+            dimension TEXT NOT NULL,
+            key TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimension, key)
+        );
+        CREATE TRIGGER IF NOT EXISTS histories_stats_insert AFTER INSERT ON histories BEGIN
+            INSERT INTO history_stats (dimension, key, count)
+            SELECT column1, column2, 1 FROM (VALUES {_stats_keys_sql("new")}) WHERE true
+            ON CONFLICT(dimension, key) DO UPDATE SET count = count + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS histories_stats_delete AFTER DELETE ON histories BEGIN
+            UPDATE history_stats SET count = count - 1
+            WHERE (dimension, key) IN (VALUES {_stats_keys_sql("old")});
+            DELETE FROM history_stats WHERE count <= 0;
+        END;
+    """)
+    conn.executescript(_stats_update_trigger_sql())
+    _rebuild_statistics(conn)
+
+def _stats_update_trigger_sql():
+    return f"""
+        CREATE TRIGGER IF NOT EXISTS histories_stats_update AFTER UPDATE OF {HISTORY_STATS_COLUMNS} ON histories BEGIN
+            UPDATE history_stats SET count = count - 1
+            WHERE (dimension, key) IN (VALUES {_stats_keys_sql("old")});
+            INSERT INTO history_stats (dimension, key, count)
+            SELECT column1, column2, 1 FROM (VALUES {_stats_keys_sql("new")}) WHERE true
+            ON CONFLICT(dimension, key) DO UPDATE SET count = count + 1;
+            DELETE FROM history_stats WHERE count <= 0;
+        END;
+    """
+
+def _migrate_history_db_v3(conn):
+    """
+    API呼び出しの計測テーブルを作成
+
+    履歴JSONの "metrics" を1呼び出し1行に展開したもの。
+    履歴の削除時はトリガーで一緒に消える
+    """
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS call_metrics (
+            history_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            stage TEXT NOT NULL,
+            model TEXT NOT NULL DEFAULT '',
+            day TEXT NOT NULL,
+            prompt_version TEXT NOT NULL DEFAULT '',
+            wall_sec REAL NOT NULL DEFAULT 0,
+            input_tokens INTEGER NOT NULL DEFAULT 0,
+            output_tokens INTEGER NOT NULL DEFAULT 0,
+            cache_creation_input_tokens INTEGER NOT NULL DEFAULT 0,
+            cache_read_input_tokens INTEGER NOT NULL DEFAULT 0,
+            retries INTEGER NOT NULL DEFAULT 0,
+            response_cached INTEGER NOT NULL DEFAULT 0,
+            cost_usd REAL NOT NULL DEFAULT 0,
+            error TEXT NOT NULL DEFAULT '',
+            PRIMARY KEY (history_id, seq)
+        );
+        CREATE INDEX IF NOT EXISTS idx_call_metrics_stage ON call_metrics(stage, day);
+        CREATE TRIGGER IF NOT EXISTS histories_metrics_delete AFTER DELETE ON histories BEGIN
+            DELETE FROM call_metrics WHERE history_id = old.id;
+        END;
+    """)
+    for data in conn.execute("SELECT data FROM histories").fetchall():
+        _index_call_metrics(conn, json.loads(data[0]))
+
+def _migrate_history_db_v4(conn):
+    """
+    類似シナリオ検出用のMinHash署名とLSHバケットのテーブルを作成
+
+    履歴の削除時はトリガーで一緒に消える
+    """
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS history_minhash (
+            history_id TEXT PRIMARY KEY,
+            signature BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS history_lsh (
+            band INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            history_id TEXT NOT NULL,
+            PRIMARY KEY (band, bucket, history_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_history_lsh_history ON history_lsh(history_id);
+        CREATE TRIGGER IF NOT EXISTS histories_minhash_delete AFTER DELETE ON histories BEGIN
+            DELETE FROM history_minhash WHERE history_id = old.id;
+            DELETE FROM history_lsh WHERE history_id = old.id;
+        END;
+    """)
+    for history_id, result in conn.execute("SELECT id, result FROM histories").fetchall():
+        _index_similarity(conn, history_id, result)
+
+def _migrate_history_db_v5(conn):
+    """
+    アーカイブ済みの履歴の保存位置（セグメント名・オフセット・長さ）の列を追加
+
+    segment が空の行は output/ のJSONファイル（filename）にある。
+    保存位置だけの更新で統計・全文索引が作り直されないよう、更新トリガーを対象の列に絞る
+    """
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(histories)")]
+    if "segment" not in columns:
+        conn.executescript("""
+            ALTER TABLE histories ADD COLUMN segment TEXT NOT NULL DEFAULT '';
+            ALTER TABLE histories ADD COLUMN segment_offset INTEGER NOT NULL DEFAULT 0;
+            ALTER TABLE histories ADD COLUMN segment_length INTEGER NOT NULL DEFAULT 0;
+        """)
+    conn.executescript("""
+        DROP TRIGGER IF EXISTS histories_stats_update;
+        DROP TRIGGER IF EXISTS histories_fts_update;
+    """)  # 全文索引のトリガーは _ensure_history_fts が作り直す
+    conn.executescript(_stats_update_trigger_sql())
+
+def _history_char_counts(result):
+    """一覧に表示する前編・後編の実測文字数（前後編に分かれていなければ全体を前編に数える）"""
+    document = build_scenario_document(result)
+    if document.has_halves:
+        return document.zenpen_count, document.kohen_count
+    return count_characters(result), 0
+
+def _migrate_history_db_v6(conn):
+    """
+    履歴一覧（サマリー）用に前編・後編の文字数の列を追加
+
+    一覧の表示とページ送りを本文（result）や data を読まずに行うため
+    """
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(histories)")]
+    if "zenpen_chars" not in columns:
+        conn.executescript("""
+            ALTER TABLE histories ADD COLUMN zenpen_chars INTEGER NOT NULL DEFAULT 0;
+            ALTER TABLE histories ADD COLUMN kohen_chars INTEGER NOT NULL DEFAULT 0;
+        """)
+    # ページ送りのカーソル (created_at, id) の順に並べた索引に置き換える
+    conn.executescript("""
+        CREATE INDEX IF NOT EXISTS idx_histories_created_id ON histories(created_at DESC, id DESC);
+        DROP INDEX IF EXISTS idx_histories_created_at;
+    """)
+    for history_id, result in conn.execute("SELECT id, result FROM histories").fetchall():
+        conn.execute(
+            "UPDATE histories SET zenpen_chars = ?, kohen_chars = ? WHERE id = ?",
+            (*_history_char_counts(result), history_id),
+        )
+
+def _migrate_history_db_v7(conn):
+    """
+    アーカイブ済みの行から本文（result）と data を外す
+
+    アーカイブ済みの履歴の内容はセグメントだけに持ち、読むときはオフセットから読む
+    （索引とセグメントで同じ内容を二重に持たない。本文の全文索引もトリガーで外れる）
+    """
+    conn.execute("UPDATE histories SET data = '', result = '' WHERE segment != ''")
+
+# PRAGMA user_version の番号順に適用するマイグレーション
+HISTORY_DB_MIGRATIONS = [
+    _migrate_history_db_v1,
+    _migrate_history_db_v2,
+    _migrate_history_db_v3,
+    _migrate_history_db_v4,
+    _migrate_history_db_v5,
+    _migrate_history_db_v6,
+    _migrate_history_db_v7,
+]
+
+def _ensure_history_fts(conn):
+    """
+    日本語向けにtrigramトークナイザで全文索引を作る（SQLite 3.34以降）
+
+    外部コンテンツの索引は作った後のINSERTしか反映しないため、
+    既存の行がある状態で索引を新たに作ったときは rebuild で取り込む
+
+    Returns:
+        全文索引が使えるかどうか（使えない環境ではLIKE検索にフォールバック）
+    """
+    created = not conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'histories_fts'"
+    ).fetchone()
+    try:
+        conn.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS histories_fts USING fts5(
+                theme, tone, additional_notes, result,
+                content='histories', content_rowid='rowid', tokenize='trigram'
+            );
+            CREATE TRIGGER IF NOT EXISTS histories_fts_insert AFTER INSERT ON histories BEGIN
+                INSERT INTO histories_fts(rowid, theme, tone, additional_notes, result)
+                VALUES (new.rowid, new.theme, new.tone, new.additional_notes, new.result);
+            END;
+            CREATE TRIGGER IF NOT EXISTS histories_fts_delete AFTER DELETE ON histories BEGIN
+                INSERT INTO histories_fts(histories_fts, rowid, theme, tone, additional_notes, result)
+                VALUES ('delete', old.rowid, old.theme, old.tone, old.additional_notes, old.result);
+            END;
+            CREATE TRIGGER IF NOT EXISTS histories_fts_update
+            AFTER UPDATE OF theme, tone, additional_notes, result ON histories BEGIN
+                INSERT INTO histories_fts(histories_fts, rowid, theme, tone, additional_notes, result)
+                VALUES ('delete', old.rowid, old.theme, old.tone, old.additional_notes, old.result);
+                INSERT INTO histories_fts(rowid, theme, tone, additional_notes, result)
+                VALUES (new.rowid, new.theme, new.tone, new.additional_notes, new.result);
+            END;
+        """)
+        if created:
+            conn.execute("INSERT INTO histories_fts(histories_fts) VALUES ('rebuild')")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+def _initialize_history_db(db_path, state):
+    """スキーマを作成・更新し、新規作成時は既存のJSONファイルを取り込む"""
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    is_new = not os.path.exists(db_path)
+
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migrate in enumerate(HISTORY_DB_MIGRATIONS, 1):
+            if version < number:
+                with conn:
+                    migrate(conn)
+                    conn.execute(f"PRAGMA user_version = {number}")
+        state["fts"] = _ensure_history_fts(conn)
+        conn.commit()
+    finally:
+        conn.close()
+
+    state["ready_path"] = db_path
+    if is_new:
+        import_history_files()
+
+def _history_row_values(data, filename, segment=None):
+    segment_name, segment_offset, segment_length = segment or ("", 0, 0)
+    # アーカイブ済みの行は本文と data を持たない（セグメントから読む）
+    result, data_json = _history_body_columns(data, segment_name)
+    return (
+        data.get("timestamp", ""),
+        filename,
+        data.get("timestamp", ""),
+        data.get("theme", ""),
+        data.get("story_format", ""),
+        data.get("tone", ""),
+        data.get("viewpoint", ""),
+        data.get("prompt_version", ""),
+        data.get("additional_notes", ""),
+        result,
+        1 if data.get("is_edited") else 0,
+        data_json,
+        segment_name,
+        segment_offset,
+        segment_length,
+        *_history_char_counts(data.get("result", "")),
+    )
+
+def _history_body_columns(data, segment_name):
+    """索引の (result, data) 列の値（アーカイブ済みなら空）"""
+    if segment_name:
+        return "", ""
+    return data.get("result", ""), json.dumps(data, ensure_ascii=False)
+
+def _history_row_data(row):
+    """
+    data・segment・segment_offset・segment_length の列を読んだ行から履歴データを得る
+
+    アーカイブ済みの行はセグメントから読む（読めなければNone）
+    """
+    if row["data"]:
+        return json.loads(row["data"])
+    if not row["segment"]:
+        return None
+    try:
+        return _read_segment_record(row["segment"], row["segment_offset"], row["segment_length"])
+    except (OSError, ValueError):
+        return None
+
+# 履歴データを読むための列（_history_row_data に渡す）
+HISTORY_DATA_COLUMNS = "h.data, h.segment, h.segment_offset, h.segment_length"
+
+def index_history(conn, data, filename, segment=None):
+    """
+    履歴1件を索引に登録（同じidがあれば置き換え）
+
+    Args:
+        filename: output/ のJSONファイル名（アーカイブ済みなら空）
+        segment: アーカイブ済みの場合の (セグメント名, オフセット, 長さ)
+    """
+    conn.execute(
+        """
+        INSERT INTO histories (id, filename, created_at, theme, story_format, tone, viewpoint,
+                               prompt_version, additional_notes, result, is_edited, data,
+                               segment, segment_offset, segment_length, zenpen_chars, kohen_chars)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            filename=excluded.filename, created_at=excluded.created_at, theme=excluded.theme,
+            story_format=excluded.story_format, tone=excluded.tone, viewpoint=excluded.viewpoint,
+            prompt_version=excluded.prompt_version, additional_notes=excluded.additional_notes,
+            result=excluded.result, is_edited=excluded.is_edited, data=excluded.data,
+            segment=excluded.segment, segment_offset=excluded.segment_offset,
+            segment_length=excluded.segment_length, zenpen_chars=excluded.zenpen_chars,
+            kohen_chars=excluded.kohen_chars
+        """,
+        _history_row_values(data, filename, segment),
+    )
+    _index_call_metrics(conn, data)
+    _index_similarity(conn, data.get("timestamp", ""), data.get("result", ""))
+
+# call_metrics に保存する計測値の列と、記録がない場合の値
+CALL_METRIC_DEFAULTS = {
+    "stage": "other",
+    "model": "",
+    "wall_sec": 0.0,
+    **dict.fromkeys(USAGE_FIELDS, 0),
+    "retries": 0,
+    "response_cached": False,
+    "cost_usd": 0.0,
+    "error": "",
+}
+
+def _index_call_metrics(conn, data):
+    """履歴1件分の計測値を call_metrics に登録し直す"""
+    history_id = data.get("timestamp", "")
+    conn.execute("DELETE FROM call_metrics WHERE history_id = ?", (history_id,))
+    metrics = data.get("metrics") or []
+    if not metrics:
+        return
+    conn.executemany(
+        f"INSERT INTO call_metrics (history_id, seq, day, prompt_version, {', '.join(CALL_METRIC_DEFAULTS)}) "
+        f"VALUES (?, ?, ?, ?, {', '.join('?' * len(CALL_METRIC_DEFAULTS))})",
+        [
+            (
+                history_id,
+                seq,
+                (metric.get("started_at") or history_id)[:10],
+                data.get("prompt_version", ""),
+                *(metric.get(column, default) for column, default in CALL_METRIC_DEFAULTS.items()),
+            )
+            for seq, metric in enumerate(metrics)
+        ],
+    )
+
+# ============================================================================
+# 類似シナリオの検出（MinHash / LSH）
+# ============================================================================
+# 本文を文字3-gramの集合にし、64個の最小ハッシュ値（MinHash署名）で表す。
+# 3-gramのハッシュ値を下位6bitで64個のビンに振り分け、ビンごとの最小値を署名にする
+# （One Permutation Hashing。ハッシュ関数64個ぶんの計算を1回で済ませる）。
+# 署名を4個ずつ16バンドに分けてバケットに登録し、同じバケットに入った履歴だけを
+# 候補として署名で比べる（全件との総当たりをしない）。
+
+MINHASH_NUM_PERM = 64
+LSH_BANDS = 16
+LSH_ROWS = MINHASH_NUM_PERM // LSH_BANDS
+SHINGLE_SIZE = 3
+# 推定Jaccard類似度がこれ以上なら「似ている」とみなす（16バンド×4行の候補になりやすさは約0.5から）
+NEAR_DUPLICATE_THRESHOLD = 0.6
+
+# 3-gramのハッシュに使う奇数の定数（乗算シフト法）
+SHINGLE_HASH_MULTIPLIER = 0x9E3779B97F4A7C15F39CC0605CEDC835
+_SHINGLE_HASH_MASK = (1 << 128) - 1
+
+def _shingle_hashes(scenario_text):
+    """
+    前編・後編の本文（記号・空白・文字数表記を除く）の文字3-gramを64bitハッシュの集合にする
+
+    UTF-32にした本文の12バイト（3文字）をそのまま整数にし、乗算シフトでハッシュする
+    （3-gramごとにハッシュ関数を呼ぶより数倍速い）
+    """
+    document = parse_scenario(scenario_text)
+    body = document.zenpen.text + document.kohen.text if document.has_halves else scenario_text
+    encoded = COUNT_EXCLUDED_PATTERN.sub("", body).encode("utf-32-le")
+    width = SHINGLE_SIZE * 4
+    return {
+        ((int.from_bytes(encoded[i:i + width], "little") * SHINGLE_HASH_MULTIPLIER) & _SHINGLE_HASH_MASK) >> 64
+        for i in range(0, len(encoded) - width + 4, 4)
+    }
+
+def minhash_signature(scenario_text):
+    """
+    本文のMinHash署名を求める
+
+    Returns:
+        MINHASH_NUM_PERM 個の整数のタプル（本文が短すぎる場合はNone）
+    """
+    hashes = _shingle_hashes(scenario_text)
+    if not hashes:
+        return None
+
+    bins = [None] * MINHASH_NUM_PERM
+    for value in hashes:
+        index, rest = value % MINHASH_NUM_PERM, value // MINHASH_NUM_PERM
+        if bins[index] is None or rest < bins[index]:
+            bins[index] = rest
+
+    # 短い本文で空のビンが残った場合は、次の空でないビンの値で埋める
+    signature = []
+    for index, value in enumerate(bins):
+        if value is None:
+            value = next(bins[(index + step) % MINHASH_NUM_PERM] for step in range(1, MINHASH_NUM_PERM)
+                         if bins[(index + step) % MINHASH_NUM_PERM] is not None)
+        signature.append(value)
+    return tuple(signature)
+
+def estimate_similarity(signature_a, signature_b):
+    """2つの署名から文字3-gramのJaccard類似度を推定（0〜1）"""
+    return sum(a == b for a, b in zip(signature_a, signature_b)) / MINHASH_NUM_PERM
+
+def _pack_signature(signature):
+    return struct.pack(f"<{MINHASH_NUM_PERM}Q", *signature)
+
+def _unpack_signature(blob):
+    return struct.unpack(f"<{MINHASH_NUM_PERM}Q", blob)
+
+def _lsh_buckets(signature):
+    """バンドごとのバケット番号（SQLiteのINTEGERに収まる符号付き64bit）"""
+    packed = _pack_signature(signature)
+    band_size = LSH_ROWS * 8
+    return [
+        (band, int.from_bytes(
+            hashlib.blake2b(packed[band * band_size:(band + 1) * band_size], digest_size=8).digest(), "big", signed=True
+        ))
+        for band in range(LSH_BANDS)
+    ]
+
+def _index_similarity(conn, history_id, scenario_text):
+    """履歴1件の署名とバケットを登録し直す"""
+    conn.execute("DELETE FROM history_lsh WHERE history_id = ?", (history_id,))
+    signature = minhash_signature(scenario_text)
+    if signature is None:
+        conn.execute("DELETE FROM history_minhash WHERE history_id = ?", (history_id,))
+        return
+    conn.execute(
+        "INSERT INTO history_minhash (history_id, signature) VALUES (?, ?) "
+        "ON CONFLICT(history_id) DO UPDATE SET signature = excluded.signature",
+        (history_id, _pack_signature(signature)),
+    )
+    conn.executemany(
+        "INSERT OR IGNORE INTO history_lsh (band, bucket, history_id) VALUES (?, ?, ?)",
+        [(band, bucket, history_id) for band, bucket in _lsh_buckets(signature)],
+    )
+
+def find_similar_histories(scenario_text, threshold=NEAR_DUPLICATE_THRESHOLD, limit=5, exclude_id=""):
+    """
+    保存済みの履歴から、本文が似ているものを探す
+
+    同じバケットに入った履歴だけを署名で比べるため、履歴の件数にほぼ関係なく速い
+
+    Args:
+        scenario_text: 比べるシナリオ
+        threshold: 推定類似度の下限
+        limit: 最大件数
+        exclude_id: 除外する履歴id（保存済みのシナリオ自身など）
+
+    Returns:
+        [{"id", "theme", "tone", "similarity"}]（類似度の高い順）
+    """
+    signature = minhash_signature(scenario_text)
+    if signature is None or not os.path.exists(_history_dir()):
+        return []
+
+    conn = _connect_history_db()
+    try:
+        candidate_ids = set()
+        for band, bucket in _lsh_buckets(signature):
+            candidate_ids.update(
+                row[0] for row in conn.execute(
+                    "SELECT history_id FROM history_lsh WHERE band = ? AND bucket = ?", (band, bucket)
+                )
+            )
+        candidate_ids.discard(exclude_id)
+        if not candidate_ids:
+            return []
+        placeholders = ", ".join("?" * len(candidate_ids))
+        rows = conn.execute(
+            f"SELECT h.id, h.theme, h.tone, m.signature FROM history_minhash m "
+            f"JOIN histories h ON h.id = m.history_id WHERE m.history_id IN ({placeholders})",
+            tuple(candidate_ids),
+        ).fetchall()
+    finally:
+        conn.close()
+
+    similar = []
+    for row in rows:
+        similarity = estimate_similarity(signature, _unpack_signature(row["signature"]))
+        if similarity >= threshold:
+            similar.append({"id": row["id"], "theme": row["theme"], "tone": row["tone"], "similarity": round(similarity, 2)})
+    similar.sort(key=lambda item: item["similarity"], reverse=True)
+    return similar[:limit]
+
+def find_duplicate_clusters(threshold=NEAR_DUPLICATE_THRESHOLD):
+    """
+    履歴全体から、互いに似ているシナリオのまとまりを探す
+
+    同じバケットに入った組だけを署名で比べ、類似度が threshold 以上の組をつないでまとめる
+
+    Returns:
+        [{"size": 件数, "max_similarity": 組の類似度の最大値,
+          "members": [{"id", "theme", "tone", "prompt_version"}]}]（件数の多い順）
+    """
+    if not os.path.exists(_history_dir()):
+        return []
+
+    conn = _connect_history_db()
+    try:
+        signatures = {
+            history_id: _unpack_signature(blob)
+            for history_id, blob in conn.execute("SELECT history_id, signature FROM history_minhash")
+        }
+        buckets = conn.execute(
+            "SELECT group_concat(history_id, char(31)) FROM history_lsh GROUP BY band, bucket HAVING COUNT(*) > 1"
+        ).fetchall()
+        histories = {
+            row["id"]: row for row in conn.execute("SELECT id, theme, tone, prompt_version FROM histories")
+        }
+    finally:
+        conn.close()
+
+    parent = {}
+
+    def find(history_id):
+        while parent.get(history_id, history_id) != history_id:
+            history_id = parent[history_id]
+        return history_id
+
+    compared = set()
+    edges = []
+    for (members,) in buckets:
+        members = sorted(members.split(chr(31)))
+        for i, a in enumerate(members):
+            for b in members[i + 1:]:
+                if (a, b) in compared:
+                    continue
+                compared.add((a, b))
+                similarity = estimate_similarity(signatures[a], signatures[b])
+                if similarity >= threshold:
+                    edges.append((a, b, similarity))
+                    parent.setdefault(a, a)
+                    parent.setdefault(b, b)
+                    parent[find(b)] = find(a)
+
+    clusters = {}
+    for history_id in parent:
+        clusters.setdefault(find(history_id), []).append(history_id)
+    best = {}
+    for a, _, similarity in edges:
+        root = find(a)
+        best[root] = max(best.get(root, 0.0), similarity)
+
+    results = []
+    for root, member_ids in clusters.items():
+        members = [
+            {"id": history_id, "theme": histories[history_id]["theme"], "tone": histories[history_id]["tone"],
+             "prompt_version": histories[history_id]["prompt_version"]}
+            for history_id in sorted(member_ids) if history_id in histories
+        ]
+        results.append({"size": len(members), "max_similarity": round(best.get(root, 0.0), 2), "members": members})
+    results.sort(key=lambda cluster: (cluster["size"], cluster["max_similarity"]), reverse=True)
+    return results
+
+def import_history_files():
+    """
+    output/ の scenario_*.json とアーカイブのセグメントを履歴データベースに取り込む（既存のidは上書き）
+
+    同じidがJSONファイルとセグメントの両方にある場合はJSONファイル（アーカイブ後に編集されたもの）を使う
+
+    Returns:
+        取り込んだ件数
+    """
+    history_dir = _history_dir()
+    if not os.path.exists(history_dir):
+        return 0
+
+    imported = 0
+    conn = _connect_history_db()
+    try:
+        with conn:
+            for data, location in _iter_archived_records().values():
+                index_history(conn, data, "", location)
+                imported += 1
+            for filename in os.listdir(history_dir):
+                if not HISTORY_FILE_PATTERN.match(filename):
+                    continue
+                try:
+                    with open(os.path.join(history_dir, filename), "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if not isinstance(data, dict) or not data.get("timestamp"):
+                    continue
+                index_history(conn, data, filename)
+                imported += 1
+    finally:
+        conn.close()
+    bump_storage_generation()
+    return imported
+
+# 履歴一覧（サマリー）に読む列。本文（result）や data は読まない
+HISTORY_PREVIEW_CHARS = 20
+HISTORY_PAGE_SIZE = 20
+HISTORY_SUMMARY_COLUMNS = (
+    f"h.id, h.created_at, substr(h.theme, 1, {HISTORY_PREVIEW_CHARS}) AS theme_preview, "
+    "h.tone, h.viewpoint, h.zenpen_chars, h.kohen_chars"
+)
+
+def search_history_rows(conn, search_query, limit, columns=HISTORY_DATA_COLUMNS, cursor=None, only_ids=None, created_range=None, tones=None):
+    """
+    履歴を新しい順に取得（検索語は3文字以上なら全文索引、それ未満は部分一致。空なら全件）
+
+    Args:
+        columns: 読む列（histories の別名は h）
+        cursor: 前のページの最後の行の (created_at, id)。これより古い行だけを返す
+        only_ids: 指定したidの行だけに絞る（お気に入りのみの表示など）
+        created_range: 作成日時の範囲 (以上, 未満)。片方はNoneでもよい
+        tones: 指定したトーンの行だけに絞る
+    """
+    source = "histories h"
+    conditions = []
+    params = []
+    if search_query and _history_db_state()["fts"] and len(search_query) >= 3:
+        source = "histories_fts JOIN histories h ON h.rowid = histories_fts.rowid"
+        conditions.append("histories_fts MATCH ?")
+        params.append('"' + search_query.replace('"', '""') + '"')
+    elif search_query:
+        pattern = "%" + search_query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        conditions.append("(" + " OR ".join(f"h.{column} LIKE ? ESCAPE '\\'" for column in HISTORY_SEARCH_COLUMNS) + ")")
+        params.extend([pattern] * len(HISTORY_SEARCH_COLUMNS))
+    if cursor:
+        # (created_at, id) < cursor を、created_at の索引で範囲検索できる形で書く
+        conditions.append("h.created_at <= ? AND NOT (h.created_at = ? AND h.id >= ?)")
+        params.extend([cursor[0], cursor[0], cursor[1]])
+    if only_ids is not None:
+        conditions.append("h.id IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(sorted(only_ids)))
+    created_from, created_to = created_range or (None, None)
+    if created_from:
+        conditions.append("h.created_at >= ?")
+        params.append(created_from)
+    if created_to:
+        conditions.append("h.created_at < ?")
+        params.append(created_to)
+    if tones:
+        conditions.append("h.tone IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(list(tones), ensure_ascii=False))
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return conn.execute(
+        f"SELECT {columns} FROM {source} {where} ORDER BY h.created_at DESC, h.id DESC LIMIT ?",
+        (*params, limit),
+    ).fetchall()
+
+# ============================================================================
+# 読み込みキャッシュ（書き込みのたびに保存世代を進めて無効化）
+# ============================================================================
+# サイドバーは再実行のたびに統計・履歴一覧・お気に入りを読むため、
+# 保存世代が変わっていなければ前回読んだ結果を使い、ディスクを読まない。
+
+@st.cache_resource
+def _storage_generation_state():
+    """このプロセスで履歴・お気に入りを書き込んだ回数"""
+    return {"lock": threading.Lock(), "value": 0}
+
+def bump_storage_generation():
+    """書き込み後に呼び、読み込みキャッシュを無効にする"""
+    state = _storage_generation_state()
+    with state["lock"]:
+        state["value"] += 1
+
+def _file_signature_or_none(path):
+    try:
+        return _file_signature(path)
+    except OSError:
+        return None
+
+def storage_generation():
+    """
+    読み込みキャッシュのキーにする保存世代
+
+    このプロセスの書き込み回数に加えて、CLIなど別のプロセスの書き込みも拾えるよう
+    履歴データベース（WALを含む）とお気に入りファイルの状態（statのみ）を含める
+    """
+    db_path = _history_db_path()
+    return (
+        _storage_generation_state()["value"],
+        _file_signature_or_none(db_path),
+        _file_signature_or_none(f"{db_path}-wal"),
+        _file_signature_or_none(_favorites_path()),
+    )
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _load_history_page_cached(generation, limit, cursor, search_query, favorites_only):
+    return load_history_page(limit, cursor, search_query, favorites_only)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _read_history_cached(generation, timestamp):
+    return read_history(timestamp)
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def _get_statistics_cached(generation):
+    return get_statistics()
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def _get_favorites_cached(generation):
+    return get_favorites()
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _get_call_metrics_summary_cached(generation, today, group_by, days):
+    return get_call_metrics_summary(group_by, days)
+
+def load_history_page_cached(limit=20, cursor=None, search_query="", favorites_only=False):
+    """load_history_page の結果を保存世代が変わるまで使い回す（セッションをまたいで共有）"""
+    return _load_history_page_cached(storage_generation(), limit, cursor, search_query, favorites_only)
+
+def read_history_cached(timestamp):
+    """read_history の結果を保存世代が変わるまで使い回す（開いている履歴の本文）"""
+    return _read_history_cached(storage_generation(), timestamp)
+
+def get_statistics_cached():
+    """get_statistics の結果を保存世代が変わるまで使い回す"""
+    return _get_statistics_cached(storage_generation())
+
+def get_favorites_cached():
+    """get_favorites の結果を保存世代が変わるまで使い回す"""
+    return _get_favorites_cached(storage_generation())
+
+def get_call_metrics_summary_cached(group_by="stage", days=None):
+    """get_call_metrics_summary の結果を保存世代（期間指定時は日付も）が変わるまで使い回す"""
+    today = datetime.now().date().isoformat() if days else None
+    return _get_call_metrics_summary_cached(storage_generation(), today, group_by, days)
+
+# 履歴を保存
+def save_history(theme, story_format, tone, result, additional_notes="", feasibility_check="", prompt_version="", viewpoint="", prompt_hash="", metrics=None, rewrite=None):
+    history_dir = _history_dir()
+    os.makedirs(history_dir, exist_ok=True)
+
+    data = {
+        "timestamp": "",  # 索引の書き込みロックを取ってから決める
+        "revision": 1,  # 編集のたびに1つ増える（同時編集の検出用）
+        "theme": theme,
+        "story_format": story_format,
+        "tone": tone,
+        "additional_notes": additional_notes,
+        "feasibility_check": feasibility_check,
+        "prompt_version": prompt_version,  # プロンプトバージョンを追加
+        "viewpoint": viewpoint,  # 視点情報を追加
+        "prompt_hash": prompt_hash,  # 生成に使ったマスタープロンプトのSHA-256
+        "metrics": metrics or [],  # API呼び出しごとの所要時間・トークン数・コスト
+        "rewrite": rewrite or {},  # リライトの判定（plan_rewrite の結果）
+        "result": result
+    }
+
+    conn = _connect_history_db()
+    try:
+        with conn:
+            # 索引の書き込みロックを取り、他のスレッド・プロセスの保存と直列化する。
+            # その中でidを決めてファイルを公開し、索引に登録する
+            conn.execute("BEGIN IMMEDIATE")
+            created = _allocate_history_time(conn)
+            data["timestamp"] = created.isoformat(timespec="microseconds")
+            filepath = _publish_history_file(history_dir, created, data)
+            index_history(conn, data, os.path.basename(filepath))
+    finally:
+        conn.close()
+    bump_storage_generation()
+
+    return filepath
+
+def _allocate_history_time(conn):
+    """
+    まだ使われていない履歴id（作成時刻）を決める
+
+    同じマイクロ秒に保存が重なった場合は1マイクロ秒ずつずらす。
+    索引の書き込みロック中に呼ぶため、別プロセスと同じidになることはない
+    """
+    created = datetime.now()
+    while conn.execute(
+        "SELECT 1 FROM histories WHERE id = ?", (created.isoformat(timespec="microseconds"),)
+    ).fetchone():
+        created += timedelta(microseconds=1)
+    return created
+
+def _publish_history_file(history_dir, created, data):
+    """
+    履歴JSONを書き終えてから公開する（同じ秒のファイルがあれば連番を付ける）
+
+    Returns:
+        保存したファイルのパス
+    """
+    content = json.dumps(data, ensure_ascii=False, indent=2)
+    timestamp = created.strftime("%Y%m%d_%H%M%S")
+    suffix = 0
+    while True:
+        filename = f"scenario_{timestamp}.json" if suffix == 0 else f"scenario_{timestamp}_{suffix}.json"
+        filepath = os.path.join(history_dir, filename)
+        try:
+            _create_file_exclusive(filepath, content)
+            return filepath
+        except FileExistsError:
+            suffix += 1
+
+# 履歴を読み込む
+def load_history(limit=10, search_query=""):
+    """
+    履歴を新しい順に取得（履歴データベースから読み込み、JSONファイルは開かない）
+
+    Args:
+        limit: 最大件数
+        search_query: テーマ・トーン・追加の要望・シナリオ本文の検索語（空なら全件）
+    """
+    if not os.path.exists(_history_dir()):
+        return []
+
+    conn = _connect_history_db()
+    try:
+        rows = search_history_rows(conn, search_query, limit)
+    finally:
+        conn.close()
+
+    return [data for data in map(_history_row_data, rows) if data is not None]
+
+def load_history_page(limit=20, cursor=None, search_query="", favorites_only=False):
+    """
+    履歴一覧の1ページ分のサマリーを新しい順に取得（本文は読まない）
+
+    Args:
+        limit: 1ページの件数
+        cursor: 前のページが返した next_cursor（Noneなら先頭のページ）
+        search_query: load_history と同じ検索語
+        favorites_only: お気に入りだけに絞る
+
+    Returns:
+        (サマリーのリスト, next_cursor)。サマリーは
+        {"id", "timestamp", "theme_preview", "tone", "viewpoint", "favorite",
+         "zenpen_chars", "kohen_chars", "total_chars"}。続きがなければ next_cursor はNone
+    """
+    if not os.path.exists(_history_dir()):
+        return [], None
+
+    favorites = set(get_favorites())
+    conn = _connect_history_db()
+    try:
+        rows = search_history_rows(
+            conn, search_query, limit + 1, columns=HISTORY_SUMMARY_COLUMNS, cursor=cursor,
+            only_ids=favorites if favorites_only else None,
+        )
+    finally:
+        conn.close()
+
+    summaries = [
+        {
+            "id": row["id"],
+            "timestamp": row["created_at"],
+            "theme_preview": row["theme_preview"],
+            "tone": row["tone"],
+            "viewpoint": row["viewpoint"],
+            "favorite": row["id"] in favorites,
+            "zenpen_chars": row["zenpen_chars"],
+            "kohen_chars": row["kohen_chars"],
+            "total_chars": row["zenpen_chars"] + row["kohen_chars"],
+        }
+        for row in rows[:limit]
+    ]
+    next_cursor = (rows[limit - 1]["created_at"], rows[limit - 1]["id"]) if len(rows) > limit else None
+    return summaries, next_cursor
+
+# お気に入り管理
+def _favorites_path():
+    return os.path.join(_output_dir(), "favorites.json")
+
+def get_favorites():
+    """お気に入りリストを取得"""
+    favorites_file = _favorites_path()
+    if os.path.exists(favorites_file):
+        with open(favorites_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return []
+
+def save_favorites(favorites):
+    """お気に入りリストを保存（丸ごと置き換えるため、読み手が書きかけの内容を見ることはない）"""
+    os.makedirs(_output_dir(), exist_ok=True)
+    _write_file_atomic(_favorites_path(), json.dumps(favorites, ensure_ascii=False, indent=2))
+    bump_storage_generation()
+
+def _set_favorite(timestamp, favorite):
+    """
+    お気に入りの登録状態を変更する
+
+    読み込み〜保存をファイルロックで囲み、同時に別のシナリオをお気に入りにした
+    セッションの変更を上書きしないようにする
+    """
+    os.makedirs(_output_dir(), exist_ok=True)
+    with file_lock(_favorites_path()):
+        favorites = get_favorites()
+        if favorite == (timestamp in favorites):
+            return
+        if favorite:
+            favorites.append(timestamp)
+        else:
+            favorites.remove(timestamp)
+        save_favorites(favorites)
+
+def toggle_favorite(timestamp):
+    """お気に入りの追加/削除を切り替え"""
+    os.makedirs(_output_dir(), exist_ok=True)
+    with file_lock(_favorites_path()):
+        favorites = get_favorites()
+        if timestamp in favorites:
+            favorites.remove(timestamp)
+        else:
+            favorites.append(timestamp)
+        save_favorites(favorites)
+    return timestamp in favorites
+
+def is_favorite(timestamp):
+    """お気に入りかどうかを確認（保存世代が変わるまではファイルを読み直さない）"""
+    favorites = get_favorites_cached()
+    return timestamp in favorites
+
+# 統計情報を取得
+def get_statistics():
+    """
+    生成統計情報を取得
+
+    保存・編集・削除のたびに差分更新される集計テーブルを読むだけなので、
+    履歴の件数に関係なく一定の時間で返る
+    """
+    stats = {
+        "total_count": 0,
+        "by_tone": {},
+        "by_date": {},
+        "by_viewpoint": {},
+        "by_prompt_version": {},
+        "by_edited": {"edited": 0, "unedited": 0},
+    }
+    if not os.path.exists(_history_dir()):
+        return stats
+
+    conn = _connect_history_db()
+    try:
+        rows = conn.execute("SELECT dimension, key, count FROM history_stats").fetchall()
+    finally:
+        conn.close()
+
+    for dimension, key, count in rows:
+        if dimension == "total":
+            stats["total_count"] = count
+        elif dimension == "edited":
+            stats["by_edited"]["edited" if str(key) == "1" else "unedited"] = count
+        else:
+            stats[f"by_{dimension}"][key or "不明"] = count
+    return stats
+
+def _rebuild_statistics(conn):
+    """集計テーブルを履歴テーブルから作り直す"""
+    conn.execute("DELETE FROM history_stats")
+    for dimension, expression in HISTORY_STATS_DIMENSIONS.items():
+        key = expression.format(row="histories")
+        conn.execute(
+            f"INSERT INTO history_stats (dimension, key, count) "
+            f"SELECT '{dimension}', {key}, COUNT(*) FROM histories GROUP BY {key}"
+        )
+    conn.execute("DELETE FROM history_stats WHERE count <= 0")
+
+def rebuild_statistics():
+    """
+    JSONファイルを取り込み直してから統計を再集計する（集計のずれを直す）
+
+    Returns:
+        再集計後の統計情報
+    """
+    import_history_files()
+    conn = _connect_history_db()
+    try:
+        with conn:
+            _rebuild_statistics(conn)
+    finally:
+        conn.close()
+    bump_storage_generation()
+    return get_statistics()
+
+# 呼び出し計測の集計軸（引数名 → call_metrics の列）
+CALL_METRICS_GROUPS = {"stage": None, "day": "day", "prompt_version": "prompt_version"}
+
+def get_call_metrics_summary(group_by="stage", days=None):
+    """
+    ステージ別（と日別・プロンプトバージョン別）の所要時間とコストを集計
+
+    レスポンスキャッシュから返した呼び出しは所要時間の分布を歪めるため除き、件数のみ数える
+
+    Args:
+        group_by: "stage" / "day" / "prompt_version"
+        days: 直近何日分を集計するか（Noneなら全期間）
+
+    Returns:
+        [{"group", "stage", "calls", "cached_calls", "p50_sec", "p95_sec", "retries",
+          "errors", "input_tokens", "output_tokens", "cache_read_input_tokens", "cost_usd"}]
+    """
+    if group_by not in CALL_METRICS_GROUPS:
+        raise ValueError(f"group_by は {', '.join(CALL_METRICS_GROUPS)} のいずれかです")
+    if not os.path.exists(_history_dir()):
+        return []
+
+    group_column = CALL_METRICS_GROUPS[group_by] or "''"
+    conditions, args = "", ()
+    if days:
+        conditions = "WHERE day >= date('now', 'localtime', ?)"
+        args = (f"-{int(days) - 1} days",)
+
+    conn = _connect_history_db()
+    try:
+        rows = conn.execute(
+            f"""
+            SELECT {group_column} AS grp, stage, wall_sec, response_cached, retries, error,
+                   input_tokens, output_tokens, cache_read_input_tokens, cost_usd
+            FROM call_metrics {conditions}
+            ORDER BY grp DESC, stage, wall_sec
+            """,
+            args,
+        ).fetchall()
+    finally:
+        conn.close()
+
+    summary = {}
+    for row in rows:
+        item = summary.setdefault((row["grp"], row["stage"]), {
+            "group": row["grp"] or ("" if group_by == "stage" else "不明"),
+            "stage": row["stage"],
+            "calls": 0,
+            "cached_calls": 0,
+            "wall_secs": [],
+            "retries": 0,
+            "errors": 0,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "cache_read_input_tokens": 0,
+            "cost_usd": 0.0,
+        })
+        item["calls"] += 1
+        if row["response_cached"]:
+            item["cached_calls"] += 1
+        else:
+            item["wall_secs"].append(row["wall_sec"])  # wall_sec順に並んでいる
+        item["retries"] += row["retries"]
+        item["errors"] += 1 if row["error"] else 0
+        for column in ("input_tokens", "output_tokens", "cache_read_input_tokens", "cost_usd"):
+            item[column] += row[column]
+
+    results = []
+    for item in summary.values():
+        wall_secs = item.pop("wall_secs")
+        item["p50_sec"] = round(_percentile(wall_secs, 0.50), 2)
+        item["p95_sec"] = round(_percentile(wall_secs, 0.95), 2)
+        item["cost_usd"] = round(item["cost_usd"], 4)
+        results.append(item)
+    return results
+
+def _find_history_file(timestamp):
+    """
+    履歴idから保存先のファイルパスを索引で引く（ファイルを開いて探し回らない）
+
+    索引とディスクがずれていた場合は索引を修復してから引き直す。
+    アーカイブ済みの履歴はJSONファイルに戻してから返す（編集・削除の前に使う）
+
+    Returns:
+        ファイルパス（見つからなければNone）
+    """
+    for attempt in range(2):
+        conn = _connect_history_db()
+        try:
+            row = conn.execute("SELECT filename, segment FROM histories WHERE id = ?", (timestamp,)).fetchone()
+        finally:
+            conn.close()
+        if row and row["segment"]:
+            filepath = _restore_archived_history(timestamp)
+            if filepath:
+                return filepath
+            continue  # 別のセッションが先に戻した
+        if row:
+            filepath = os.path.join(_history_dir(), row["filename"])
+            if os.path.exists(filepath):
+                return filepath
+        if attempt == 0:
+            check_history_index(repair=True)
+    return None
+
+def check_history_index(repair=True, full=False):
+    """
+    索引とディスク上のJSONファイル・アーカイブの整合性を確認し、必要なら修復する
+
+    Args:
+        repair: ずれを修復するかどうか
+        full: Trueなら全ファイルとセグメントを読み直す（ファイルが外部で編集された場合など）
+
+    Returns:
+        {"missing": 索引にないファイル数, "stale": ファイルがない索引数, "reindexed": 読み直した件数}
+    """
+    history_dir = _history_dir()
+    disk_files = set()
+    if os.path.exists(history_dir):
+        disk_files = {f for f in os.listdir(history_dir) if HISTORY_FILE_PATTERN.match(f)}
+
+    conn = _connect_history_db()
+    try:
+        indexed = {
+            row["filename"]: row["id"]
+            for row in conn.execute("SELECT id, filename FROM histories WHERE segment = ''")
+        }
+        missing = sorted(disk_files - set(indexed)) if not full else sorted(disk_files)
+        stale = [history_id for filename, history_id in indexed.items() if filename not in disk_files]
+        # セグメントごと消えた（または封印で名前が変わった）アーカイブの行
+        segments = {name for _, name, _ in _list_segments()}
+        stale_archived = {
+            row["id"]
+            for row in conn.execute("SELECT id, segment FROM histories WHERE segment != ''")
+            if row["segment"] not in segments
+        }
+
+        reindexed = 0
+        if repair:
+            with conn:
+                for history_id in stale + sorted(stale_archived):
+                    conn.execute("DELETE FROM histories WHERE id = ?", (history_id,))
+                for filename in missing:
+                    try:
+                        with open(os.path.join(history_dir, filename), "r", encoding="utf-8") as f:
+                            data = json.load(f)
+                    except (OSError, ValueError):
+                        continue
+                    if isinstance(data, dict) and data.get("timestamp"):
+                        index_history(conn, data, filename)
+                        reindexed += 1
+                if full or stale_archived:
+                    file_ids = {row["id"] for row in conn.execute("SELECT id FROM histories WHERE segment = ''")}
+                    for history_id, (data, location) in _iter_archived_records().items():
+                        if history_id not in file_ids and (full or history_id in stale_archived):
+                            index_history(conn, data, "", location)
+                            reindexed += 1
+            bump_storage_generation()
+    finally:
+        conn.close()
+
+    return {
+        "missing": len(disk_files - set(indexed)),
+        "stale": len(stale) + len(stale_archived),
+        "reindexed": reindexed,
+    }
+
+# ============================================================================
+# 履歴のアーカイブ（JSONLセグメント）
+# ============================================================================
+# 古い履歴は1件1ファイルのJSONから output/archive/ のセグメントに移し、ファイル数を減らす。
+# - 追記中のセグメント（segment_NNNNNN.jsonl）: 1行1件のJSONLに追記するだけ
+# - 封印済みのセグメント（segment_NNNNNN.jsonl.gz）: 1行ずつ別のgzipメンバーに圧縮し、
+#   最後のメンバーに各行の位置（フッター索引）を置く。連結したgzipなので zcat でも読める
+# 索引（history.db）が各履歴のセグメント名・オフセット・長さを持つため、idで1件読むのはO(1)。
+# セグメントは追記のみで書き換えない。アーカイブ後に編集・削除した履歴は、
+# 編集ならJSONファイルに戻し（ファイルが優先）、削除なら deleted.jsonl に記録する。
+
+SEGMENT_FILE_PATTERN = re.compile(r"^segment_(\d{6})\.jsonl(\.gz)?$")
+DEFAULT_SEGMENT_RECORDS = 1000
+COMPACT_LOCK_BATCH = 100  # 同時に取るファイルロックの数（開くファイル数の上限に近づけない）
+SEGMENT_FORMAT_VERSION = 1
+_GZIP_MAGIC = b"\x1f\x8b\x08"
+
+def _archive_dir():
+    return os.path.join(_history_dir(), "archive")
+
+def _archive_lock_path():
+    """アーカイブ・封印・復元を直列化するロックの対象"""
+    return os.path.join(_archive_dir(), "segments")
+
+def _tombstones_path():
+    return os.path.join(_archive_dir(), "deleted.jsonl")
+
+def _list_segments():
+    """アーカイブ内のセグメントを番号順に返す [(番号, ファイル名, 封印済みか)]"""
+    if not os.path.exists(_archive_dir()):
+        return []
+    segments = []
+    for filename in os.listdir(_archive_dir()):
+        match = SEGMENT_FILE_PATTERN.match(filename)
+        if match:
+            segments.append((int(match.group(1)), filename, bool(match.group(2))))
+    return sorted(segments)
+
+def _read_segment_record(segment, offset, length):
+    """セグメントから1件を読む（封印済みならそのgzipメンバーだけを展開する）"""
+    with open(os.path.join(_archive_dir(), segment), "rb") as f:
+        f.seek(offset)
+        raw = f.read(length)
+    if segment.endswith(".gz"):
+        raw = gzip.decompress(raw)
+    return json.loads(raw)
+
+def read_segment_footer(path):
+    """
+    封印済みセグメントのフッター索引を読む（末尾から最後のgzipメンバーを探す）
+
+    Returns:
+        [(履歴id, オフセット, 長さ)]
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        tail_size = min(size, 1024 * 1024)
+        f.seek(size - tail_size)
+        tail = f.read()
+
+    start = len(tail)
+    while True:
+        start = tail.rfind(_GZIP_MAGIC, 0, start)
+        if start < 0:
+            raise ValueError(f"セグメントのフッターが見つかりません: {path}")
+        decompressor = zlib.decompressobj(wbits=31)
+        try:
+            raw = decompressor.decompress(tail[start:])
+        except zlib.error:
+            continue
+        if not decompressor.eof or decompressor.unused_data:
+            continue  # 圧縮データの途中に偶然現れたマジックナンバー
+        try:
+            footer = json.loads(raw)["footer"]
+        except (ValueError, KeyError, TypeError):
+            continue
+        return [tuple(entry) for entry in footer["records"]]
+
+def _iter_segment_records(segment):
+    """セグメントの全件を (データ, (セグメント名, オフセット, 長さ)) で順に返す（索引の再構築用）"""
+    path = os.path.join(_archive_dir(), segment)
+    if segment.endswith(".gz"):
+        with open(path, "rb") as f:
+            for _, offset, length in read_segment_footer(path):
+                f.seek(offset)
+                yield json.loads(gzip.decompress(f.read(length))), (segment, offset, length)
+        return
+
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # 追記の途中で止まった行は読まない
+            yield json.loads(line), (segment, offset, len(line))
+            offset += len(line)
+
+def _load_tombstones():
+    """アーカイブ後に削除された履歴id"""
     try:
-        # リライト工程もHaikuで実施（コスト削減）
-        message = client.messages.create(
-            model="claude-haiku-3-5-20250313",
-            max_tokens=8000,
-            temperature=0.5,
-            messages=[
-                {"role": "user", "content": rewrite_prompt}
-            ]
+        with open(_tombstones_path(), "r", encoding="utf-8") as f:
+            return {json.loads(line)["id"] for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+def _record_tombstone(history_id):
+    """削除した履歴idを記録（セグメントに残った古い内容から復活させないため）"""
+    if not _list_segments():
+        return
+    with file_lock(_tombstones_path()):
+        with open(_tombstones_path(), "a", encoding="utf-8") as f:
+            f.write(json.dumps({"id": history_id, "deleted_at": datetime.now().isoformat()}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+def _iter_archived_records():
+    """
+    アーカイブ内の有効な履歴を返す（同じidが複数あれば後から書かれたもの。削除済みは除く）
+
+    Returns:
+        {履歴id: (データ, (セグメント名, オフセット, 長さ))}
+    """
+    tombstones = _load_tombstones()
+    records = {}
+    for _, segment, _ in _list_segments():
+        for data, location in _iter_segment_records(segment):
+            history_id = data.get("timestamp", "")
+            if history_id and history_id not in tombstones:
+                records[history_id] = (data, location)
+    return records
+
+def _open_segment():
+    """
+    追記中のセグメント名と収録件数を返す（なければ次の番号で作る）
+
+    前回の追記が途中で止まっていた場合は、最後の改行まで切り詰める
+    """
+    segments = _list_segments()
+    open_segments = [name for _, name, sealed in segments if not sealed]
+    if not open_segments:
+        number = segments[-1][0] + 1 if segments else 1
+        return f"segment_{number:06d}.jsonl", 0
+
+    name = open_segments[-1]
+    path = os.path.join(_archive_dir(), name)
+    with open(path, "r+b") as f:
+        content = f.read()
+        complete = content.rfind(b"\n") + 1
+        if complete != len(content):
+            f.truncate(complete)
+    return name, content.count(b"\n")
+
+def _append_to_segment(segment, records):
+    """
+    追記中のセグメントに履歴を追記し、ディスクに反映してから位置を返す
+
+    Returns:
+        [(セグメント名, オフセット, 長さ)]（records と同じ順）
+    """
+    os.makedirs(_archive_dir(), exist_ok=True)
+    locations = []
+    with open(os.path.join(_archive_dir(), segment), "ab") as f:
+        offset = f.tell()
+        for data in records:
+            line = (json.dumps(data, ensure_ascii=False) + "\n").encode("utf-8")
+            f.write(line)
+            locations.append((segment, offset, len(line)))
+            offset += len(line)
+        f.flush()
+        os.fsync(f.fileno())
+    return locations
+
+def _seal_segment(conn, segment):
+    """
+    追記中のセグメントを1行ずつgzip圧縮し、フッター索引を付けて封印する
+
+    Returns:
+        封印後のセグメント名
+    """
+    sealed = f"{segment}.gz"
+    sealed_path = os.path.join(_archive_dir(), sealed)
+    tmp_path = f"{sealed_path}.{os.getpid()}.tmp"
+    moved = {}
+    footer = []
+    with open(tmp_path, "wb") as out:
+        for data, (_, old_offset, _) in _iter_segment_records(segment):
+            member = gzip.compress(
+                (json.dumps(data, ensure_ascii=False) + "\n").encode("utf-8"), compresslevel=9, mtime=0
+            )
+            footer.append((data.get("timestamp", ""), out.tell(), len(member)))
+            moved[old_offset] = footer[-1]
+            out.write(member)
+        out.write(gzip.compress(
+            (json.dumps({"footer": {"format": SEGMENT_FORMAT_VERSION, "records": footer}}) + "\n").encode("utf-8"),
+            mtime=0,
+        ))
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, sealed_path)
+
+    with conn:
+        conn.executemany(
+            "UPDATE histories SET segment = ?, segment_offset = ?, segment_length = ? "
+            "WHERE id = ? AND segment = ? AND segment_offset = ?",
+            [(sealed, offset, length, history_id, segment, old_offset)
+             for old_offset, (history_id, offset, length) in moved.items()],
         )
+    os.remove(os.path.join(_archive_dir(), segment))
+    return sealed
 
-        rewritten_scenario = message.content[0].text
-        
-        # 文字数制限の強制実行
-        final_scenario = enforce_char_limit(api_key, rewritten_scenario)
-        
-        return final_scenario
-    except Exception as e:
-        # エラーの場合は元のシナリオを返す
-        return scenario_draft
+def _set_history_location(conn, history_id, filename, segment, data):
+    """
+    索引の保存先を書き換える（内容は同じなので類似度などは作り直さない）
+
+    アーカイブへ移す場合は本文と data を外し、ファイルに戻す場合は data から書き戻す
+    """
+    segment_name, segment_offset, segment_length = segment
+    conn.execute(
+        "UPDATE histories SET filename = ?, segment = ?, segment_offset = ?, segment_length = ?, "
+        "result = ?, data = ? WHERE id = ?",
+        (filename, segment_name, segment_offset, segment_length,
+         *_history_body_columns(data, segment_name), history_id),
+    )
+
+def compact_history(older_than_days=30, segment_records=DEFAULT_SEGMENT_RECORDS, seal=False):
+    """
+    作成から older_than_days 日より古い履歴のJSONファイルをセグメントに移す
+
+    セグメントに追記してディスクに反映した後、1件ずつファイルロックを取り、
+    読み込んだ後に変更されていなければ索引の保存先を切り替えてからファイルを削除する
+    （移動中に編集された履歴はそのままファイルに残す）。
+
+    Args:
+        older_than_days: この日数より古い履歴を移す
+        segment_records: 1セグメントの件数（達したら封印する）
+        seal: Trueなら最後の追記中のセグメントも封印する
+
+    移した行の本文と data は索引から外し、最後に history.db を VACUUM して縮める。
+
+    Returns:
+        {"archived": 移した件数, "skipped": 移さなかった件数, "sealed": [封印したセグメント名],
+         "bytes_before": 移したファイルの合計サイズ, "segments": セグメント数,
+         "db_bytes_before" / "db_bytes_after": history.db（WALを含む）のサイズ,
+         "archive_bytes": アーカイブ（output/archive/）の合計サイズ}
+    """
+    cutoff = (datetime.now() - timedelta(days=older_than_days)).isoformat()
+    history_dir = _history_dir()
+    report = {
+        "archived": 0, "skipped": 0, "sealed": [], "bytes_before": 0, "segments": 0,
+        "db_bytes_before": 0, "db_bytes_after": 0, "archive_bytes": 0,
+    }
+    if not os.path.exists(history_dir):
+        return report
+
+    os.makedirs(_archive_dir(), exist_ok=True)
+    with file_lock(_archive_lock_path()):
+        conn = _connect_history_db()
+        report["db_bytes_before"] = _history_db_bytes()
+        try:
+            candidates = conn.execute(
+                "SELECT id, filename FROM histories WHERE segment = '' AND created_at < ? ORDER BY created_at",
+                (cutoff,),
+            ).fetchall()
+
+            segment, count = _open_segment()
+            position = 0
+            while position < len(candidates):
+                chunk = candidates[position:position + max(1, segment_records - count)]
+                position += len(chunk)
+
+                loaded = []
+                for row in chunk:
+                    path = os.path.join(history_dir, row["filename"])
+                    try:
+                        signature = _file_signature(path)
+                        with open(path, "r", encoding="utf-8") as f:
+                            data = json.load(f)
+                    except (OSError, ValueError):
+                        report["skipped"] += 1
+                        continue
+                    loaded.append((row["id"], path, signature, data))
+
+                locations = _append_to_segment(segment, [data for _, _, _, data in loaded])
+                count += len(loaded)
+
+                # 編集と同じく「ファイルのロック → 索引の書き込み」の順で、少しずつまとめて切り替える
+                pending = list(zip(loaded, locations))
+                for start in range(0, len(pending), COMPACT_LOCK_BATCH):
+                    with ExitStack() as locks:
+                        moved = []
+                        for (history_id, path, signature, data), location in pending[start:start + COMPACT_LOCK_BATCH]:
+                            locks.enter_context(file_lock(path))
+                            if _file_signature_or_none(path) != signature:
+                                report["skipped"] += 1  # 読み込んだ後に編集・削除された
+                                continue
+                            moved.append((history_id, path, signature[2], location, data))
+                        with conn:
+                            for history_id, path, _, location, data in moved:
+                                _set_history_location(conn, history_id, "", location, data)
+                        # 索引を確定してからファイルを削除する（途中で止まってもセグメントから読める）
+                        for _, path, size, _, _ in moved:
+                            remove_locked_file(path)
+                            report["archived"] += 1
+                            report["bytes_before"] += size
+
+                if count >= segment_records:
+                    report["sealed"].append(_seal_segment(conn, segment))
+                    segment, count = _open_segment()
+
+            if seal and count:
+                report["sealed"].append(_seal_segment(conn, segment))
+
+            if report["archived"]:
+                # 外した本文の分の空きページを返す（WALも切り詰める）
+                conn.execute("VACUUM")
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+        report["db_bytes_after"] = _history_db_bytes()
+
+    report["segments"] = len(_list_segments())
+    report["archive_bytes"] = sum(
+        os.path.getsize(os.path.join(_archive_dir(), name))
+        for name in os.listdir(_archive_dir()) if os.path.isfile(os.path.join(_archive_dir(), name))
+    )
+    bump_storage_generation()
+    return report
+
+def _history_db_bytes():
+    """history.db と WAL の合計サイズ"""
+    db_path = _history_db_path()
+    return sum(os.path.getsize(path) for path in (db_path, f"{db_path}-wal") if os.path.exists(path))
+
+def read_history(timestamp):
+    """
+    履歴1件の保存内容を読む（JSONファイルでもセグメントでも、索引から位置を引いてO(1)）
+
+    Returns:
+        履歴データ（見つからなければNone）
+    """
+    conn = _connect_history_db()
+    try:
+        row = conn.execute(
+            "SELECT filename, segment, segment_offset, segment_length FROM histories WHERE id = ?", (timestamp,)
+        ).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    try:
+        if row["segment"]:
+            return _read_segment_record(row["segment"], row["segment_offset"], row["segment_length"])
+        with open(os.path.join(_history_dir(), row["filename"]), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _restore_archived_history(timestamp):
+    """
+    アーカイブ済みの履歴をJSONファイルに戻す（編集・削除の前に呼ぶ）
+
+    Returns:
+        ファイルパス（アーカイブ済みでなければNone）
+    """
+    with file_lock(_archive_lock_path()):
+        conn = _connect_history_db()
+        try:
+            row = conn.execute(
+                "SELECT segment, segment_offset, segment_length FROM histories WHERE id = ?", (timestamp,)
+            ).fetchone()
+            if row is None or not row["segment"]:
+                return None
+            data = _read_segment_record(row["segment"], row["segment_offset"], row["segment_length"])
+            filepath = _publish_history_file(_history_dir(), datetime.fromisoformat(timestamp), data)
+            with conn:
+                _set_history_location(conn, timestamp, os.path.basename(filepath), ("", 0, 0), data)
+        finally:
+            conn.close()
+    return filepath
+
+class HistoryConflictError(Exception):
+    """編集を始めた後に、別のセッションが同じ履歴を更新していた"""
+
+    def __init__(self, timestamp, expected_revision, latest):
+        self.timestamp = timestamp
+        self.expected_revision = expected_revision
+        self.latest = latest  # 現在保存されている履歴データ
+        super().__init__(
+            f"履歴 {timestamp} は別のセッションで更新されています"
+            f"（編集元: 版{expected_revision} / 現在: 版{latest.get('revision', 1)}）"
+        )
+
+# シナリオを編集して保存
+def update_history(timestamp, updated_result, expected_revision=None):
+    """
+    履歴のシナリオを更新
+
+    ファイルロックの中で読み込み〜置き換え〜索引の更新を行い、版番号（revision）を1つ増やす。
+
+    Args:
+        timestamp: 履歴id
+        updated_result: 編集後のシナリオ
+        expected_revision: 編集を始めたときの版番号（指定すると、その後に別の更新があれば保存しない）
+
+    Returns:
+        保存後の履歴データ（見つからなければFalse）
+
+    Raises:
+        HistoryConflictError: expected_revision と現在の版番号が異なる
+    """
+    while True:
+        filepath = _find_history_file(timestamp)
+        if filepath is None:
+            return False
+        with file_lock(filepath):
+            try:
+                with open(filepath, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                continue  # ロックを待つ間にアーカイブ・削除された（保存先を引き直す）
+            if data.get('timestamp', '') != timestamp:
+                return False
+            data = _apply_history_edit(filepath, data, updated_result, expected_revision)
+        bump_storage_generation()
+        return data
+
+def _apply_history_edit(filepath, data, updated_result, expected_revision):
+    """update_history の本体（filepath のロックを取った状態で呼ぶ）"""
+    revision = data.get('revision', 1)
+    if expected_revision is not None and expected_revision != revision:
+        raise HistoryConflictError(data.get('timestamp', ''), expected_revision, data)
+
+    data['result'] = updated_result
+    data['updated_at'] = datetime.now().isoformat()
+    data['is_edited'] = True
+    data['revision'] = revision + 1
+    _write_file_atomic(filepath, json.dumps(data, ensure_ascii=False, indent=2))
+
+    conn = _connect_history_db()
+    try:
+        with conn:
+            index_history(conn, data, os.path.basename(filepath))
+    finally:
+        conn.close()
+    return data
+
+# 履歴を削除
+def delete_history(timestamp):
+    """指定されたtimestampの履歴を削除"""
+    filepath = _find_history_file(timestamp)
+    if filepath is None:
+        return False
+
+    # お気に入りからも削除
+    _set_favorite(timestamp, False)
+
+    # ファイルを削除（編集中の保存と重ならないようロックする）
+    with file_lock(filepath):
+        try:
+            remove_locked_file(filepath)
+        except FileNotFoundError:
+            return False  # 別のセッションが先に削除した
+        conn = _connect_history_db()
+        try:
+            with conn:
+                conn.execute("DELETE FROM histories WHERE id = ?", (timestamp,))
+        finally:
+            conn.close()
+    _record_tombstone(timestamp)
+    bump_storage_generation()
+    return True
 
 # ============================================================================
-# シナリオ生成関数
+# 一括生成（CSV/JSONLのテーマリスト）
 # ============================================================================
 
-def load_viewpoint_prompt():
-    """視点変更プロンプトを読み込む"""
-    prompt_path = os.path.join(os.path.dirname(__file__), "prompts", "視点変更プロンプト.md")
-    if os.path.exists(prompt_path):
-        with open(prompt_path, "r", encoding="utf-8") as f:
-            return f.read()
-    return ""
+BATCH_FIELDS = ["theme", "tone", "viewpoint", "additional_notes"]
 
-def generate_viewpoint_instruction(viewpoint, theme):
-    """視点に応じたプロンプト指示を生成"""
-    if viewpoint == "主人公目線（デフォルト）":
-        return ""
-    
-    # カスタム視点の場合
-    if viewpoint not in ["親友・友人目線", "第三者の視点", "体験談から自動変換（親友目線推奨）"]:
-        # カスタム入力された視点
-        return f"""
-【視点変更指示：カスタム視点】
-以下のテーマ/ネタを「{viewpoint}」のストーリーに変換してください。
+def decode_batch_file(data):
+    """
+    アップロードされたテーマリストのバイト列を文字列にする
 
-視点変更のポイント：
-- 指定された視点「{viewpoint}」でストーリーを語る
-- その視点の人物の感情・思考・行動を中心に描写
-- その視点から見た他の人物の様子を描写
-- その視点の人物がどう感じたか、どう行動したかを明確に
-- その視点の人物と他の登場人物の関係を明確に
-- なぜその視点の人物が行動するのか、動機を明確に
+    UTF-8（BOM付きを含む）を優先し、読めなければExcelで保存したShift_JIS（cp932）とみなす
 
-ストーリーの内容は維持しつつ、視点のみを変更してください。
-視点が一貫していること、自然な語り口であることを重視してください。
-"""
-    
-    # 視点変更の指示を生成
-    if viewpoint == "親友・友人目線":
-        return """
-【視点変更指示】
-以下のテーマ/ネタを「親友・友人目線」のストーリーに変換してください。
+    Raises:
+        ValueError: どちらの文字コードでも読めない場合
+    """
+    for encoding in ("utf-8-sig", "cp932"):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    raise ValueError("文字コードを判別できません（UTF-8 または Shift_JIS で保存してください）")
 
-視点変更のポイント：
-- 体験談の内容を、親友の視点から語られるストーリーにする
-- 語り手は親友・友人で、主人公を「彼女」「彼」などと呼ぶ
-- 親友の目線で見た主人公の様子を描写
-- 親友が主人公のために行動する動機・感情を明確に
-- 親友自身の成長や変化も描写に含める
+def parse_batch_rows(content, filename, errors=None):
+    """
+    一括生成用のCSV/JSONLを読み込む
 
-ストーリーの内容は維持しつつ、視点のみを変更してください。
-"""
-    elif viewpoint == "第三者の視点":
-        return """
-【視点変更指示】
-以下のテーマ/ネタを「第三者の視点」のストーリーに変換してください。
+    読めない行（JSONとして壊れている・オブジェクトでない・トーンが選択肢にない）は飛ばす。
+    errors にリストを渡すと、飛ばした行の行番号と理由が追加される
 
-視点変更のポイント：
-- 客観的な視点から物語を見る
-- 複数の人物の感情・行動を描く
-- ナレーション的な視点
+    Args:
+        content: ファイルの中身（文字列）
+        filename: ファイル名（拡張子で形式を判定）
+        errors: 飛ばした行の説明を追加するリスト（省略可）
 
-ストーリーの内容は維持しつつ、視点のみを変更してください。
-"""
-    elif viewpoint == "体験談から自動変換（親友目線推奨）":
-        # 体験談かどうかを簡易判定（「私」「僕」「自分」などの一人称が含まれているか）
-        if any(word in theme for word in ["私", "僕", "自分", "私の", "僕の"]):
-            return """
-【視点変更指示：体験談から親友目線への自動変換】
-入力されたテーマ/ネタは体験談形式です。これを「親友・友人目線」のストーリーに自動変換してください。
+    Returns:
+        {"theme", "tone", "viewpoint", "additional_notes"} の辞書のリスト
+        （themeが空の行は除外）
+    """
+    if errors is None:
+        errors = []
+
+    # (行番号, レコード) の組にする
+    records = []
+    if filename.lower().endswith(".jsonl"):
+        for line_number, line in enumerate(content.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                errors.append(f"{line_number}行目: JSONとして読めません（{e.msg}）")
+                continue
+            if not isinstance(record, dict):
+                errors.append(f"{line_number}行目: {{\"theme\": ...}} の形式ではありません")
+                continue
+            records.append((line_number, record))
+    else:
+        reader = csv.DictReader(io.StringIO(content.lstrip("\ufeff")))
+        for record in reader:
+            records.append((reader.line_num, record))
+
+    rows = []
+    for line_number, record in records:
+        row = {field: str(record.get(field) or "").strip() for field in BATCH_FIELDS}
+        if not row["theme"]:
+            continue
+        if row["tone"] and row["tone"] not in TONE_OPTIONS:
+            errors.append(f"{line_number}行目: トーン「{row['tone']}」は選択肢にありません")
+            continue
+        row["tone"] = row["tone"] or TONE_OPTIONS[0]
+        row["viewpoint"] = row["viewpoint"] or DEFAULT_VIEWPOINT
+        rows.append(row)
+    return rows
 
-変換のポイント：
-- 体験談の主語となっている人物を「親友」に置き換える
-- 語り手を「私（親友）」に変更する
-- 「私の親友が...」「友人が...」という形式にする
-- 体験談の内容は維持するが、語り手を友人に変更
-- 友人の目線で見た主人公の様子を描写
-- 友人が主人公のために行動する動機・感情を明確に
+def run_scenario_pipeline(api_key, theme, story_format, tone, additional_notes="", viewpoint=DEFAULT_VIEWPOINT, cache_mode=CACHE_OFF, prompt_asset=None, metrics=None, draft_candidates=1, rewrite_policy=REWRITE_ADAPTIVE):
+    """
+    初稿生成 → 品質チェック＆リライト → 文字数制限 の一連の処理を実行
 
-例：
-- 体験談：「夫にモラハラされていた私が、親友の一言で離婚を決意...」
-- → 親友目線：「私の親友が夫にモラハラされていた。ある日、私が彼女に伝えた一言が...」
+    metrics にリストを渡すと、各ステージのAPI呼び出しの計測値が追加される。
+    draft_candidates が2以上なら初稿を複数同時に作って最良のものを使う。
+    リライト・短縮を行うかは rewrite_policy に従って初稿の採点から決める（plan_rewrite）
 
-ストーリーの内容は維持しつつ、視点のみを変更してください。
-"""
-    return ""
+    Returns:
+        (最終的なシナリオ, リライトの判定)
 
-def generate_scenario(api_key, theme, story_format, tone, additional_notes="", viewpoint="主人公目線（デフォルト）"):
+    Raises:
+        ScenarioGenerationError: いずれかのステージのAPI呼び出しに失敗した場合
     """
-    Claude APIを使用してシナリオを生成
-    
+    if draft_candidates > 1:
+        draft_scenario, scores = generate_best_draft(
+            api_key, theme, story_format, tone, additional_notes, viewpoint,
+            candidates=draft_candidates, cache_mode=cache_mode, prompt_asset=prompt_asset, metrics=metrics
+        )
+    else:
+        draft_scenario = generate_scenario(
+            api_key, theme, story_format, tone, additional_notes, viewpoint,
+            cache_mode=cache_mode, prompt_asset=prompt_asset, metrics=metrics
+        )
+        scores = None
+    plan = plan_rewrite(draft_scenario, rewrite_policy, scores[0] if scores else None)
+    final_scenario = refine_draft(api_key, draft_scenario, plan, viewpoint, cache_mode=cache_mode, metrics=metrics)
+    return final_scenario, plan
+
+def _run_batch_row(api_key, index, row, story_format, cache_mode, draft_candidates=1, rewrite_policy=REWRITE_ADAPTIVE):
+    """一括生成の1行分を実行し、状況レポートの1行を返す"""
+    started = time.time()
+    report = {
+        "row": index,
+        "theme": row["theme"][:30],
+        "tone": row["tone"],
+        "viewpoint": row["viewpoint"],
+        "status": "success",
+        "filepath": "",
+        "zenpen_chars": "",
+        "kohen_chars": "",
+        "elapsed_sec": 0.0,
+        "cost_usd": 0.0,
+        "rewrite": "",
+        "similar_to": "",
+        "similarity": "",
+        "error": "",
+    }
+    metrics = []
+    try:
+        prompt_asset = get_master_prompt_asset()
+        final_scenario, plan = run_scenario_pipeline(
+            api_key, row["theme"], story_format, row["tone"], row["additional_notes"], row["viewpoint"],
+            cache_mode=cache_mode, prompt_asset=prompt_asset, metrics=metrics, draft_candidates=draft_candidates,
+            rewrite_policy=rewrite_policy
+        )
+        report["rewrite"] = plan["action"]
+        similar = find_similar_histories(final_scenario, limit=1)
+        if similar:
+            report["similar_to"], report["similarity"] = similar[0]["id"], similar[0]["similarity"]
+        report["filepath"] = save_history(
+            row["theme"],
+            story_format,
+            row["tone"],
+            final_scenario,
+            additional_notes=row["additional_notes"],
+            prompt_version=PROMPT_VERSION,
+            viewpoint=row["viewpoint"],
+            prompt_hash=prompt_asset.sha256,
+            metrics=metrics,
+            rewrite=plan
+        )
+        document = parse_scenario(final_scenario)
+        report["zenpen_chars"], report["kohen_chars"] = document.zenpen_count, document.kohen_count
+    except Exception as e:
+        report["status"] = "error"
+        report["error"] = str(e)
+    report["elapsed_sec"] = round(time.time() - started, 1)
+    report["cost_usd"] = round(sum(metric["cost_usd"] for metric in metrics), 4)
+    return report
+
+def iter_batch_generation(api_key, rows, concurrency=4, story_format=STORY_FORMAT, cache_mode=CACHE_OFF, draft_candidates=1, rewrite_policy=REWRITE_ADAPTIVE):
+    """
+    テーマリストを並列に生成し、完了した順に状況レポートを返す
+
+    同時実行数はconcurrencyで制限する（共有クライアントの接続プールを使い回す）。
+    各結果はsave_historyで履歴に保存される。
+
     Args:
         api_key: Anthropic APIキー
-        theme: テーマ/ネタ
-        story_format: ストーリー形式（前後編など）
-        tone: トーン/雰囲気
-        additional_notes: 追加の要望
-        viewpoint: 視点の選択
-        
-    Returns:
-        生成されたシナリオのテキスト
+        rows: parse_batch_rows の戻り値
+        concurrency: 同時に実行するパイプライン数
+        story_format: ストーリー形式
+        cache_mode: レスポンスキャッシュの利用方法
+        draft_candidates: 1行あたりの初稿の候補数
+        rewrite_policy: リライトの方針（REWRITE_POLICIES）
+
+    Yields:
+        行ごとの状況レポート（辞書）
     """
-    client = anthropic.Anthropic(api_key=api_key)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="batch") as executor:
+        futures = [
+            executor.submit(_run_batch_row, api_key, index, row, story_format, cache_mode, draft_candidates, rewrite_policy)
+            for index, row in enumerate(rows, 1)
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+def run_batch_generation(api_key, rows, concurrency=4, story_format=STORY_FORMAT, cache_mode=CACHE_OFF, draft_candidates=1, rewrite_policy=REWRITE_ADAPTIVE):
+    """一括生成を実行し、行番号順の状況レポートを返す"""
+    reports = list(iter_batch_generation(api_key, rows, concurrency, story_format, cache_mode, draft_candidates, rewrite_policy))
+    return sorted(reports, key=lambda r: r["row"])
+
+def batch_report_to_csv(reports):
+    """状況レポートをCSV文字列に変換"""
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=list(reports[0].keys()) if reports else ["row"])
+    writer.writeheader()
+    writer.writerows(reports)
+    return output.getvalue()
 
-    master_prompt = load_master_prompt()
+# ============================================================================
+# 履歴のエクスポート（ZIP / CSV / JSONL）
+# ============================================================================
+# 索引から少しずつ読み、1件ずつ書き出すジェネレーターで返すため、
+# 何件エクスポートしても全件をメモリに載せない。
+
+EXPORT_BATCH_SIZE = 200
+EXPORT_RETENTION_SEC = 24 * 3600  # 画面から作ったエクスポートファイルを残す時間
+EXPORT_CSV_FIELDS = [
+    "timestamp", "theme", "tone", "viewpoint", "story_format", "prompt_version",
+    "additional_notes", "zenpen_chars", "kohen_chars", "is_edited", "favorite", "result",
+]
+# 形式 → (拡張子, MIMEタイプ)
+EXPORT_FORMATS = {
+    "zip": ("zip", "application/zip"),
+    "csv": ("csv", "text/csv"),
+    "jsonl": ("jsonl", "application/x-ndjson"),
+}
+
+def format_history_markdown(hist):
+    """履歴1件をダウンロード用のMarkdownにする（TXT/MDのダウンロードとZIPの各ファイル）"""
+    content = f"""# 恋愛漫画シナリオ
 
-    # 視点変更の指示を生成
-    viewpoint_instruction = generate_viewpoint_instruction(viewpoint, theme)
-    
-    # ユーザー入力を構造化
-    # 文字数ガイドライン設定
-    if "前後編" in story_format:
-        char_limit = """
-【必須】文字数制限【より厳格に】：
-- **前編：最大500文字以内（推奨400〜500文字）**
-- **後編：最大500文字以内（推奨400〜500文字）**
-- **合計：最大1000文字以内（推奨800〜1000文字）**
-- **絶対に上限を超えないこと**
-- **物語を膨らませすぎず、簡潔でインパクトのある展開を心がけること**
+## 生成情報
+- 日時: {hist['timestamp'][:19]}
+- 形式: {hist['story_format']}
+- トーン: {hist['tone']}
 
-【厳密】文字数カウント方法：
-- 改行、記号（※、「」、『』、■、（）、…、！、？、〜など）、スペースを除いた純粋なテキスト文字のみカウント
-- 登場人物セクションは文字数に含めない（シナリオ本文のみカウント）
-- カウント例：
-  - `A子「こんにちは」※笑顔` → カウント「A子こんにちは笑顔」= 9文字
-  - `※夜、仕事から帰宅したA子` → カウント「夜仕事から帰宅したA子」= 12文字
+## テーマ
+{hist['theme']}
 
-【重要】簡潔性と面白さのバランス：
-- 制限内で最高の面白さを実現すること
-- **冗長な表現は徹底的に削る**
-- **文字数を増やすために物語を不必要に膨らませない**
-- **簡潔でインパクトのある展開を優先すること**
-- ストーリーの面白さ、キャラクターの魅力、感情の盛り上がりを大切に
-- 簡潔かつインパクトのある表現を心がける
+"""
+    if hist.get('additional_notes'):
+        content += f"""## 追加の要望
+{hist['additional_notes']}
 
-【必須】シナリオ出力時の文字数表記：
-- シナリオ本文の最後に、必ず以下の形式で実際の文字数を明記してください
-- 例：`文字数：前編482文字 / 後編518文字 / 合計1000文字`
-- 出力前に必ず文字数を実測し、制限内に収めること
 """
-    else:
-        char_limit = ""
 
-    user_prompt = f"""
-以下の条件で恋愛漫画のシナリオを生成してください。
+    content += f"""## 生成されたシナリオ
+
+{hist['result']}
+"""
+    return content
+
+def iter_history_records(search_query="", date_from=None, date_to=None, tones=None, favorites_only=False, ids=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    条件に合う履歴を新しい順に1件ずつ返す（batch_size 件ずつ索引から読む）
+
+    Args:
+        search_query: load_history と同じ検索語
+        date_from / date_to: 作成日の範囲（date。両端を含む）
+        tones: トーンのリスト（空なら全トーン）
+        favorites_only: お気に入りだけに絞る
+        ids: 履歴idのリスト（指定すればその履歴だけ）
+    """
+    if not os.path.exists(_history_dir()):
+        return
+
+    only_ids = None
+    if favorites_only:
+        only_ids = set(get_favorites())
+    if ids is not None:
+        only_ids = set(ids) if only_ids is None else only_ids & set(ids)
+    created_range = (
+        date_from.isoformat() if date_from else None,
+        (date_to + timedelta(days=1)).isoformat() if date_to else None,
+    )
+
+    cursor = None
+    conn = _connect_history_db()
+    try:
+        while True:
+            rows = search_history_rows(
+                conn, search_query, batch_size, columns=f"h.id, h.created_at, {HISTORY_DATA_COLUMNS}",
+                cursor=cursor, only_ids=only_ids, created_range=created_range, tones=tones or None,
+            )
+            for row in rows:
+                hist = _history_row_data(row)
+                if hist is not None:
+                    yield hist
+            if len(rows) < batch_size:
+                return
+            cursor = (rows[-1]["created_at"], rows[-1]["id"])
+    finally:
+        conn.close()
+
+def _export_basename(hist):
+    """ZIP内のファイル名（idの日時＋テーマの先頭。idは一意なので重複しない）"""
+    stamp = re.sub(r"\D", "", hist.get("timestamp", ""))
+    theme = re.sub(r'[\\/:*?"<>|\s]+', "_", hist.get("theme", ""))[:20].strip("_")
+    return f"scenario_{stamp[:8]}_{stamp[8:]}_{theme}.md" if theme else f"scenario_{stamp[:8]}_{stamp[8:]}.md"
+
+class _ExportBuffer(io.RawIOBase):
+    """書き込まれたバイト列を溜め、ジェネレーターが取り出すたびに空にする（シーク不可のストリーム）"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def _iter_export_zip(records):
+    buffer = _ExportBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for hist in records:
+            archive.writestr(_export_basename(hist), format_history_markdown(hist))
+            yield buffer.drain()
+    yield buffer.drain()  # 末尾の目次（central directory）
+
+def _iter_export_csv(records, favorites):
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=EXPORT_CSV_FIELDS, extrasaction="ignore")
+    output.write("\ufeff")  # Excelで文字化けしないようBOMを付ける
+    writer.writeheader()
+    for hist in records:
+        zenpen_chars, kohen_chars = _history_char_counts(hist.get("result", ""))
+        writer.writerow(dict(
+            hist, zenpen_chars=zenpen_chars, kohen_chars=kohen_chars,
+            is_edited=1 if hist.get("is_edited") else 0,
+            favorite=1 if hist.get("timestamp") in favorites else 0,
+        ))
+        yield output.getvalue().encode("utf-8")
+        output.seek(0)
+        output.truncate()
+
+def _iter_export_jsonl(records):
+    for hist in records:
+        yield (json.dumps(hist, ensure_ascii=False) + "\n").encode("utf-8")
+
+def _iter_export(export_format, records):
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"未対応のエクスポート形式です: {export_format}")
+    if export_format == "zip":
+        return _iter_export_zip(records)
+    if export_format == "csv":
+        return _iter_export_csv(records, set(get_favorites()))
+    return _iter_export_jsonl(records)
+
+def iter_history_export(export_format, **filters):
+    """
+    条件に合う履歴を指定の形式で書き出すバイト列を少しずつ返す
+
+    Args:
+        export_format: "zip"（1件1ファイルのMarkdown）/ "csv" / "jsonl"
+        **filters: iter_history_records の条件
+
+    Raises:
+        ValueError: 未対応の形式
+    """
+    return _iter_export(export_format, iter_history_records(**filters))
+
+def _exports_dir():
+    return os.path.join(_output_dir(), "exports")
+
+def date_input_range(value):
+    """
+    範囲指定の st.date_input の値を (date_from, date_to) にする
 
-{viewpoint_instruction}
+    終了日を選ぶ前は1要素のタプルになるため、その場合は開始日以降（date_to=None）とする
+    """
+    dates = tuple(value) if isinstance(value, (list, tuple)) else (value,) if value else ()
+    return (dates[0] if dates else None, dates[1] if len(dates) > 1 else None)
 
-【形式】
-{story_format}
+def create_export_file(export_format, **filters):
+    """
+    画面からのエクスポート用に output/exports/ に書き出す（1日より古いエクスポートは消す）
 
-【テーマ/ネタ】
-{theme}
+    Returns:
+        (ファイルパス, 件数)
+    """
+    exports_dir = _exports_dir()
+    os.makedirs(exports_dir, exist_ok=True)
+    for filename in os.listdir(exports_dir):
+        path = os.path.join(exports_dir, filename)
+        try:
+            if time.time() - os.path.getmtime(path) > EXPORT_RETENTION_SEC:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
 
-【トーン/雰囲気】
-{tone}
+    extension, _ = EXPORT_FORMATS.get(export_format, ("", ""))
+    path = os.path.join(exports_dir, f"history_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.{extension}")
+    return path, export_history(path, export_format, **filters)
 
-【追加の要望】
-{additional_notes if additional_notes else "特になし"}
+def export_history(path, export_format, **filters):
+    """
+    iter_history_export の出力を path に書き出す（書き終えてから置き換える）
 
-【最重要】テーマ/ネタに忠実であること：
-- 上記のテーマ/ネタに記載されている内容のみを使用すること
-- テーマに記載されていない設定・情報・要素（警察、裁判所、会社、学校、病院など）は一切追加しない
-- テーマから大きく逸脱した展開は絶対に避けること
-- テーマに記載されている登場人物・場所・状況のみを使用すること
+    Returns:
+        書き出した件数
+    """
+    count = 0
 
-{char_limit}
-上記の【シナリオ生成のための統合ナレッジ】と【出力形式】に従って、バズる恋愛漫画のシナリオを生成してください。
-"""
+    def counted(records):
+        nonlocal count
+        for hist in records:
+            count += 1
+            yield hist
 
+    chunks = _iter_export(export_format, counted(iter_history_records(**filters)))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
     try:
-        # プロンプトキャッシュを使用してコスト削減
-        # temperature: 文字数制限など具体的な制約がある場合は低めに設定
-        message = client.messages.create(
-            model="claude-sonnet-4-5-20250929",
-            max_tokens=8000,
-            temperature=0.7,  # 1.0から0.7に変更（より指示に従いやすく）
-            system=[
-                {
-                    "type": "text",
-                    "text": master_prompt,
-                    "cache_control": {"type": "ephemeral"}
-                }
-            ],
-            messages=[
-                {"role": "user", "content": user_prompt}
-            ]
-        )
-
-        return message.content[0].text
-    except Exception as e:
-        return f"エラーが発生しました: {str(e)}"
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return count
 
-# 履歴を保存
-def save_history(theme, story_format, tone, result, additional_notes="", feasibility_check="", prompt_version="", viewpoint=""):
-    history_dir = os.path.join(os.path.dirname(__file__), "output")
-    os.makedirs(history_dir, exist_ok=True)
+# ============================================================================
+# バックグラウンド生成ジョブ
+# ============================================================================
+# 生成パイプラインはスクリプトの実行スレッドではなくサーバー共通のワーカーで動かす。
+# 画面はジョブidだけを st.session_state に持ち、進捗を定期的に読みに行く。
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"scenario_{timestamp}.json"
-    filepath = os.path.join(history_dir, filename)
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
 
-    data = {
-        "timestamp": datetime.now().isoformat(),
-        "theme": theme,
-        "story_format": story_format,
-        "tone": tone,
-        "additional_notes": additional_notes,
-        "feasibility_check": feasibility_check,
-        "prompt_version": prompt_version,  # プロンプトバージョンを追加
-        "viewpoint": viewpoint,  # 視点情報を追加
-        "result": result
-    }
+# 終了したジョブをメモリに残す時間（結果は履歴に保存済み）
+JOB_RETENTION_SEC = 24 * 3600
 
-    with open(filepath, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+@dataclass
+class GenerationJob:
+    """
+    生成ジョブの状態
 
-    return filepath
+    ワーカーが _update_job で書き換え、画面は get_job で取得したコピーを読む。
+    APIキーはジョブに保存しない
+    """
+    id: str
+    theme: str
+    story_format: str
+    tone: str
+    viewpoint: str
+    additional_notes: str = ""
+    status: str = JOB_QUEUED
+    step: str = "⏳ 順番待ち"
+    progress: float = 0.0
+    preview: str = ""
+    draft: str = ""
+    note: str = ""
+    filepath: str = ""
+    history_id: str = ""  # 保存した履歴のid（結果は履歴の詳細画面で開く）
+    error: str = ""
+    error_hint: str = ""
+    similar: list = field(default_factory=list)  # 似ている過去の履歴（find_similar_histories の結果）
+    batch_size: int = 0  # 一括生成のジョブなら行数（0なら1件の生成）
+    reports: list = field(default_factory=list)  # 一括生成の状況レポート（行番号順）
+    created_at: float = 0.0
+    started_at: float = 0.0
+    finished_at: float = 0.0
+
+    @property
+    def is_active(self):
+        return self.status in (JOB_QUEUED, JOB_RUNNING)
+
+    @property
+    def is_batch(self):
+        return self.batch_size > 0
+
+    @property
+    def elapsed_sec(self):
+        if not self.started_at:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+@st.cache_resource
+def _job_manager():
+    """
+    プロセス全体で共有するジョブ管理（ワーカーのスレッドプールとジョブ一覧）
 
-# 履歴を読み込む
-def load_history(limit=10, search_query=""):
-    history_dir = os.path.join(os.path.dirname(__file__), "output")
-    if not os.path.exists(history_dir):
-        return []
+    同時に実行するパイプライン数は環境変数 GENERATION_WORKERS（4）で変更できる。
+    それ以上のジョブは順番待ちになる
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, int(os.getenv("GENERATION_WORKERS", "4"))), thread_name_prefix="job")
+    atexit.register(executor.shutdown, wait=False, cancel_futures=True)
+    return {"lock": threading.Lock(), "executor": executor, "jobs": {}}
+
+def _update_job(job_id, **fields):
+    manager = _job_manager()
+    with manager["lock"]:
+        job = manager["jobs"].get(job_id)
+        if job is not None:
+            for name, value in fields.items():
+                setattr(job, name, value)
+
+def get_job(job_id):
+    """ジョブの現在の状態のコピーを取得（存在しなければNone）"""
+    manager = _job_manager()
+    with manager["lock"]:
+        job = manager["jobs"].get(job_id)
+        return replace(job) if job is not None else None
+
+def _prune_jobs(manager):
+    """保持期間を過ぎた終了済みジョブを捨てる（ロック取得済みで呼ぶ）"""
+    now = time.time()
+    expired = [
+        job_id for job_id, job in manager["jobs"].items()
+        if not job.is_active and now - job.finished_at > JOB_RETENTION_SEC
+    ]
+    for job_id in expired:
+        del manager["jobs"][job_id]
+
+def _job_progress_callback(job_id, step_label, progress_start, progress_end):
+    """ストリーミング受信中のテキストと進捗をジョブに書き込むコールバック"""
+    def on_progress(text, output_tokens):
+        ratio = min(output_tokens / EXPECTED_OUTPUT_TOKENS, 0.99)
+        zenpen_count, kohen_count = live_half_counts(text)
+        _update_job(
+            job_id,
+            progress=progress_start + (progress_end - progress_start) * ratio,
+            step=f"{step_label} 約{output_tokens}トークン受信 / 前編: {zenpen_count}文字 / 後編: {kohen_count}文字",
+            preview=text,
+        )
+    return on_progress
 
-    history_files = sorted(
-        [f for f in os.listdir(history_dir) if f.endswith('.json')],
-        reverse=True
-    )
+def _run_generation_job(job_id, api_key, cache_mode, draft_candidates, streaming, rewrite_policy=REWRITE_ADAPTIVE):
+    """ワーカースレッドで1件分のパイプラインを実行し、完成したら履歴に保存する"""
+    job = get_job(job_id)
+    _update_job(job_id, status=JOB_RUNNING, step="📝 ステップ1/2: シナリオ初稿を作成中...", progress=0.02, started_at=time.time())
+    metrics = []
+    try:
+        prompt_asset = get_master_prompt_asset()
+        scores = None
+        if draft_candidates > 1:
+            def on_candidate(done, total):
+                _update_job(job_id, progress=0.5 * done / total, step=f"📝 ステップ1/2: シナリオ初稿を作成中...（{done}/{total}案 完了）")
+
+            draft, scores = generate_best_draft(
+                api_key, job.theme, job.story_format, job.tone, job.additional_notes, job.viewpoint,
+                candidates=draft_candidates, cache_mode=cache_mode, prompt_asset=prompt_asset,
+                metrics=metrics, on_candidate=on_candidate
+            )
+        else:
+            draft = generate_scenario(
+                api_key, job.theme, job.story_format, job.tone, job.additional_notes, job.viewpoint,
+                on_progress=_job_progress_callback(job_id, "📝 ステップ1/2: シナリオ初稿を作成中...", 0.0, 0.5) if streaming else None,
+                cache_mode=cache_mode, prompt_asset=prompt_asset, metrics=metrics
+            )
+        _update_job(job_id, draft=draft, preview="", progress=0.5)
+
+        # 初稿をローカルで採点し、リライト・短縮が必要かを決める
+        plan = plan_rewrite(draft, rewrite_policy, scores[0] if scores else None)
+        note = f"🎲 {len(scores)}案から採点{scores[0]['score']}点の初稿を採用 / " if scores else ""
+        note += describe_rewrite_plan(plan)
+        step_label = {
+            REWRITE_ACTION_REWRITE: "✨ ステップ2/2: 品質チェック＆自動リライト中...",
+            REWRITE_ACTION_SHORTEN: "✂️ ステップ2/2: 文字数を調整中...",
+        }.get(plan["action"])
+        if step_label:
+            _update_job(job_id, step=step_label)
+        final_scenario = refine_draft(
+            api_key, draft, plan, job.viewpoint,
+            on_progress=_job_progress_callback(job_id, step_label, 0.5, 1.0) if streaming and step_label else None,
+            cache_mode=cache_mode, metrics=metrics
+        )
 
-    histories = []
-    for filename in history_files:
-        filepath = os.path.join(history_dir, filename)
+        # 保存する前に過去の履歴と比べる（自分自身と一致しないように）
+        similar = find_similar_histories(final_scenario)
+        filepath = save_history(
+            job.theme,
+            job.story_format,
+            job.tone,
+            final_scenario,
+            additional_notes=job.additional_notes,
+            prompt_version=PROMPT_VERSION,
+            viewpoint=job.viewpoint,
+            prompt_hash=prompt_asset.sha256,
+            metrics=metrics,
+            rewrite=plan
+        )
         with open(filepath, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            # 検索クエリがある場合、フィルタリング
-            if search_query:
-                if (search_query.lower() in data.get('theme', '').lower() or
-                    search_query.lower() in data.get('tone', '').lower() or
-                    search_query.lower() in data.get('result', '').lower()):
-                    histories.append(data)
-            else:
-                histories.append(data)
-        
-        # 制限数に達したら終了
-        if len(histories) >= limit:
-            break
-
-    return histories
-
-# お気に入り管理
-def get_favorites():
-    """お気に入りリストを取得"""
-    favorites_file = os.path.join(os.path.dirname(__file__), "output", "favorites.json")
-    if os.path.exists(favorites_file):
-        with open(favorites_file, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return []
+            history_id = json.load(f)["timestamp"]
+        _update_job(
+            job_id, status=JOB_DONE, step="✅ シナリオ生成が完了しました！", progress=1.0, preview="",
+            note=note, filepath=filepath, history_id=history_id, similar=similar, finished_at=time.time()
+        )
+    except ScenarioGenerationError as e:
+        _update_job(job_id, status=JOB_FAILED, step="❌ 失敗", preview="", error=str(e), error_hint=e.hint, finished_at=time.time())
+    except Exception as e:
+        _update_job(
+            job_id, status=JOB_FAILED, step="❌ 失敗", preview="",
+            error=f"予期しないエラーが発生しました: {e}\n\n{traceback.format_exc()}",
+            error_hint=ERROR_HINTS["unknown"], finished_at=time.time()
+        )
 
-def save_favorites(favorites):
-    """お気に入りリストを保存"""
-    favorites_file = os.path.join(os.path.dirname(__file__), "output", "favorites.json")
-    with open(favorites_file, "w", encoding="utf-8") as f:
-        json.dump(favorites, f, ensure_ascii=False, indent=2)
+def submit_generation_job(api_key, theme, story_format, tone, additional_notes="", viewpoint=DEFAULT_VIEWPOINT, cache_mode=CACHE_OFF, draft_candidates=1, streaming=True, rewrite_policy=REWRITE_ADAPTIVE):
+    """
+    生成ジョブを登録してワーカーに渡す（すぐに戻る）
 
-def toggle_favorite(timestamp):
-    """お気に入りの追加/削除を切り替え"""
-    favorites = get_favorites()
-    if timestamp in favorites:
-        favorites.remove(timestamp)
-    else:
-        favorites.append(timestamp)
-    save_favorites(favorites)
-    return timestamp in favorites
+    Returns:
+        ジョブid（st.session_state に保存して get_job で進捗を読む）
+    """
+    job = GenerationJob(
+        id=uuid.uuid4().hex[:12],
+        theme=theme,
+        story_format=story_format,
+        tone=tone,
+        viewpoint=viewpoint,
+        additional_notes=additional_notes,
+        created_at=time.time(),
+    )
+    manager = _job_manager()
+    with manager["lock"]:
+        _prune_jobs(manager)
+        manager["jobs"][job.id] = job
+    manager["executor"].submit(_run_generation_job, job.id, api_key, cache_mode, draft_candidates, streaming, rewrite_policy)
+    return job.id
+
+def _run_batch_job(job_id, api_key, rows, concurrency, story_format, cache_mode, draft_candidates, rewrite_policy):
+    """ワーカースレッドで一括生成を実行し、行ごとの状況レポートをジョブに書き込む"""
+    _update_job(job_id, status=JOB_RUNNING, step=f"📦 0/{len(rows)}件完了", started_at=time.time())
+    reports = []
+    try:
+        for report in iter_batch_generation(api_key, rows, concurrency, story_format, cache_mode, draft_candidates, rewrite_policy):
+            reports.append(report)
+            mark = "✅" if report["status"] == "success" else "❌"
+            _update_job(job_id, progress=len(reports) / len(rows), step=f"{mark} {len(reports)}/{len(rows)}件完了: {report['theme']}")
+        failed = sum(1 for r in reports if r["status"] != "success")
+        _update_job(
+            job_id, status=JOB_DONE, step="🎉 一括生成が完了しました", progress=1.0,
+            note=f"（成功 {len(reports) - failed}件 / 失敗 {failed}件）",
+            reports=sorted(reports, key=lambda r: r["row"]), finished_at=time.time()
+        )
+    except Exception as e:
+        _update_job(
+            job_id, status=JOB_FAILED, step="❌ 失敗",
+            error=f"予期しないエラーが発生しました: {e}\n\n{traceback.format_exc()}",
+            error_hint=ERROR_HINTS["unknown"], reports=sorted(reports, key=lambda r: r["row"]), finished_at=time.time()
+        )
 
-def is_favorite(timestamp):
-    """お気に入りかどうかを確認"""
-    favorites = get_favorites()
-    return timestamp in favorites
+def submit_batch_job(api_key, rows, label, concurrency=4, story_format=STORY_FORMAT, cache_mode=CACHE_OFF, draft_candidates=1, rewrite_policy=REWRITE_ADAPTIVE):
+    """
+    一括生成をジョブとして登録してワーカーに渡す（すぐに戻る）
 
-# 統計情報を取得
-def get_statistics():
-    """生成統計情報を取得"""
-    history_dir = os.path.join(os.path.dirname(__file__), "output")
-    if not os.path.exists(history_dir):
-        return {
-            "total_count": 0,
-            "by_tone": {},
-            "by_date": {}
-        }
-    
-    history_files = [f for f in os.listdir(history_dir) if f.endswith('.json')]
-    
-    stats = {
-        "total_count": len(history_files),
-        "by_tone": {},
-        "by_date": {}
-    }
-    
-    for filename in history_files:
-        filepath = os.path.join(history_dir, filename)
-        try:
-            with open(filepath, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                
-                # トーン別の集計
-                tone = data.get('tone', '不明')
-                stats["by_tone"][tone] = stats["by_tone"].get(tone, 0) + 1
-                
-                # 日付別の集計
-                if 'timestamp' in data:
-                    date = data['timestamp'][:10]  # YYYY-MM-DD形式
-                    stats["by_date"][date] = stats["by_date"].get(date, 0) + 1
-        except:
-            continue
-    
-    return stats
+    一括生成のジョブはワーカーを1つ使い、その中で concurrency 件ずつ並列に生成する
 
-# シナリオを編集して保存
-def update_history(timestamp, updated_result):
-    """履歴のシナリオを更新"""
-    history_dir = os.path.join(os.path.dirname(__file__), "output")
-    history_files = [f for f in os.listdir(history_dir) if f.endswith('.json')]
-    
-    for filename in history_files:
-        filepath = os.path.join(history_dir, filename)
-        with open(filepath, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            if data.get('timestamp', '') == timestamp:
-                data['result'] = updated_result
-                data['updated_at'] = datetime.now().isoformat()
-                data['is_edited'] = True
-                with open(filepath, "w", encoding="utf-8") as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-                return True
-    return False
+    Args:
+        rows: parse_batch_rows の戻り値
+        label: ジョブ一覧に表示する名前（アップロードしたファイル名など）
 
-# 履歴を削除
-def delete_history(timestamp):
-    """指定されたtimestampの履歴を削除"""
-    history_dir = os.path.join(os.path.dirname(__file__), "output")
-    history_files = [f for f in os.listdir(history_dir) if f.endswith('.json')]
-    
-    for filename in history_files:
-        filepath = os.path.join(history_dir, filename)
-        try:
-            with open(filepath, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if data.get('timestamp', '') == timestamp:
-                    # お気に入りからも削除
-                    favorites = get_favorites()
-                    if timestamp in favorites:
-                        favorites.remove(timestamp)
-                        save_favorites(favorites)
-                    # ファイルを削除
-                    os.remove(filepath)
-                    return True
-        except Exception as e:
-            continue
-    return False
+    Returns:
+        ジョブid
+    """
+    job = GenerationJob(
+        id=uuid.uuid4().hex[:12],
+        theme=label,
+        story_format=story_format,
+        tone="",
+        viewpoint="",
+        batch_size=len(rows),
+        created_at=time.time(),
+    )
+    manager = _job_manager()
+    with manager["lock"]:
+        _prune_jobs(manager)
+        manager["jobs"][job.id] = job
+    manager["executor"].submit(
+        _run_batch_job, job.id, api_key, list(rows), concurrency, story_format, cache_mode, draft_candidates, rewrite_policy
+    )
+    return job.id
 
 # APIキーを保存
 def save_api_key(api_key):
@@ -817,8 +4674,200 @@ def save_api_key(api_key):
         st.error(f"APIキーの保存に失敗しました: {str(e)}")
         return False
 
+def setup_page():
+    """ページ設定とカスタムCSSを適用（Streamlit実行時のみ呼び出す）"""
+    # ページ設定
+    st.set_page_config(
+        page_title="恋愛漫画シナリオ生成ツールv2 | 愛カツ",
+        page_icon="💙",
+        layout="wide",
+        initial_sidebar_state="expanded"
+    )
+
+    # カスタムCSS（最小限）
+    st.markdown("""
+    <style>
+        /* メインヘッダー */
+        .main-header {
+            font-size: 2.5rem;
+            font-weight: bold;
+            color: #333;
+            text-align: center;
+            margin-bottom: 1rem;
+            padding: 1rem;
+        }
+    
+        /* サブヘッダー */
+        .sub-header {
+            font-size: 1.2rem;
+            color: #666;
+            text-align: center;
+            margin-bottom: 2rem;
+        }
+    
+        /* バージョン表示 */
+        .version-badge {
+            display: inline-block;
+            background: #f0f0f0;
+            color: #333;
+            font-size: 0.9rem;
+            font-weight: normal;
+            padding: 0.3rem 0.8rem;
+            border-radius: 5px;
+            margin-left: 1rem;
+            vertical-align: middle;
+        }
+    
+        /* 出力セクション */
+        .output-section {
+            background: #f9f9f9;
+            padding: 1rem;
+            margin-top: 1rem;
+            border: 1px solid #e0e0e0;
+        }
+    </style>
+    """, unsafe_allow_html=True)
+
+def render_char_counts(scenario_text):
+    """シナリオの実測文字数と上限チェックの結果を表示"""
+    document = parse_scenario(scenario_text)
+    if not document.has_halves:
+        return
+
+    # 文字数表示
+    st.info(f"""
+**📊 実測文字数**（改行・記号・括弧を除く）
+前編: {document.zenpen_count}文字 / 後編: {document.kohen_count}文字 / 合計: {document.total_count}文字
+    """)
+
+    # 文字数オーバーの警告
+    if not document.is_within_limit:
+        st.warning("⚠️ 文字数が制限を超えています")
+    elif document.total_count < RECOMMENDED_MIN_TOTAL_CHARS:
+        st.info(f"ℹ️ 推奨文字数（{RECOMMENDED_MIN_TOTAL_CHARS}-{TOTAL_CHAR_LIMIT}文字）より少なめです")
+
+    # シーンごとの文字数
+    with st.expander(f"🎞️ シーン別文字数（前編{len(document.zenpen.scenes)}シーン / 後編{len(document.kohen.scenes)}シーン）"):
+        for half in (document.zenpen, document.kohen):
+            st.markdown(f"**{half.name}** {half.title}")
+            for number, scene in enumerate(half.scenes, 1):
+                direction = scene.direction.split("\n", 1)[0] if scene.direction else scene.lines[0]
+                st.text(f"{number:>2}. {scene.char_count:>3}文字  {direction[:30]}")
+
+def open_selected_history(timestamp, index=None):
+    """
+    履歴を開く（本文は表示するときに読み、セッションにはidだけを持つ）
+
+    index は履歴一覧での番号（生成ジョブの結果から開く場合はNone）
+    """
+    close_selected_history()
+    st.session_state.selected_history_id = timestamp
+    st.session_state.selected_history_index = index
+
+def close_selected_history():
+    for key in ("selected_history_id", "selected_history_index", "selected_history_revision"):
+        st.session_state.pop(key, None)
+
+def _render_job(job):
+    """生成ジョブ1件分の状態を表示"""
+    mark = {JOB_QUEUED: "⏳", JOB_RUNNING: "🧵", JOB_DONE: "✅", JOB_FAILED: "❌"}[job.status]
+    with st.container(border=True):
+        if job.is_batch:
+            st.markdown(f"{mark} 📦 **{job.theme[:40]}**　{job.batch_size}件の一括生成")
+        else:
+            st.markdown(f"{mark} **{job.theme[:40]}**　{job.tone} / {job.viewpoint}")
+        if job.is_active:
+            st.progress(job.progress)
+            st.caption(f"{job.step}（{job.elapsed_sec:.0f}秒経過）")
+            if job.preview:
+                with st.expander("👀 受信中のシナリオ"):
+                    st.markdown(job.preview)
+            return
+
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            if job.is_batch:
+                _render_batch_job_result(job)
+            elif job.status == JOB_DONE:
+                st.caption(f"{job.step}（{job.elapsed_sec:.0f}秒）{job.note}")
+                for item in job.similar:
+                    st.warning(f"⚠️ 過去のシナリオと似ています（類似度{item['similarity']:.0%}）: {item['theme'][:30]}")
+                if st.button("📖 結果を表示", key=f"job_show_{job.id}"):
+                    # 結果は保存済みの履歴として開き、編集・お気に入りも履歴に反映させる
+                    open_selected_history(job.history_id)
+                    st.rerun()
+            else:
+                st.error(f"❌ {job.error}")
+                st.info(f"💡 {job.error_hint}")
+                if job.draft:
+                    # リライト以降で失敗した場合も、生成済みの初稿は確認できるようにする
+                    with st.expander("📝 リライト前の初稿"):
+                        st.markdown(job.draft)
+        with col2:
+            if st.button("🗑️ 一覧から外す", key=f"job_remove_{job.id}"):
+                st.session_state.job_ids.remove(job.id)
+                st.rerun()
+
+def _render_batch_job_result(job):
+    """終了した一括生成ジョブの結果（状況レポート）を表示"""
+    if job.status == JOB_DONE:
+        st.caption(f"{job.step}（{job.elapsed_sec:.0f}秒）{job.note}")
+    else:
+        st.error(f"❌ {job.error}")
+        st.info(f"💡 {job.error_hint}")
+    if not job.reports:
+        return
+    with st.expander(f"📋 状況レポート（{len(job.reports)}件）"):
+        st.dataframe(job.reports, use_container_width=True)
+    st.download_button(
+        label="📄 状況レポート（CSV）",
+        data=batch_report_to_csv(job.reports),
+        file_name=f"batch_report_{datetime.fromtimestamp(job.created_at).strftime('%Y%m%d_%H%M%S')}.csv",
+        mime="text/csv",
+        key=f"batch_report_dl_{job.id}"
+    )
+
+def _render_job_list(jobs):
+    st.subheader("🧵 生成ジョブ")
+    for job in reversed(jobs):
+        _render_job(job)
+
+@st.fragment(run_every=1.0)
+def _poll_generation_jobs():
+    """
+    実行中のジョブがある間だけ1秒ごとに再実行される部分
+
+    ジョブが新たに終わったら画面全体を再実行し、履歴一覧や統計にも反映させる
+    """
+    jobs = [job for job in map(get_job, st.session_state.get("job_ids", [])) if job is not None]
+    notified = st.session_state.setdefault("notified_job_ids", set())
+    finished = [job for job in jobs if not job.is_active and job.id not in notified]
+    if finished:
+        for job in finished:
+            notified.add(job.id)
+            st.toast(f"{'✅' if job.status == JOB_DONE else '❌'} {job.theme[:20]}")
+        st.rerun()
+    _render_job_list(jobs)
+
+def render_generation_jobs():
+    """このセッションで登録した生成ジョブの一覧を表示（実行中なら自動で更新）"""
+    job_ids = st.session_state.get("job_ids", [])
+    jobs = [job for job in map(get_job, job_ids) if job is not None]
+    # サーバー再起動などで消えたジョブはセッションからも外す
+    st.session_state.job_ids = [job.id for job in jobs]
+    if not jobs:
+        return
+
+    if any(job.is_active for job in jobs):
+        _poll_generation_jobs()
+    else:
+        st.session_state.setdefault("notified_job_ids", set()).update(job.id for job in jobs)
+        _render_job_list(jobs)
+
 # メイン画面
 def main():
+    setup_page()
+
     # .envファイルを読み込む
     load_dotenv()
 
@@ -862,23 +4911,79 @@ def main():
         st.divider()
 
         # 形式は前後編のみに固定（プロンプトv2.0に対応）
-        story_format = "前後編2話完結（前編5〜7ページ・後編5〜7ページ）"
+        story_format = STORY_FORMAT
         st.info(f"📖 **形式**: {story_format}")
 
+        # ストリーミング表示
+        use_streaming = st.checkbox(
+            "⚡ 生成中の文章をリアルタイム表示",
+            value=True,
+            help="生成中のシナリオと前編/後編の文字数を受信しながら表示します"
+        )
+
+        # 初稿の候補数（Best-of-N）
+        draft_candidates = st.slider(
+            "🎲 初稿の候補数",
+            min_value=1,
+            max_value=MAX_DRAFT_CANDIDATES,
+            value=min(max(int(os.getenv("DRAFT_CANDIDATES", "1")), 1), MAX_DRAFT_CANDIDATES),
+            help="2以上にすると初稿を同時に複数作り、文字数・構成・エンディングの採点が最も良いものを使います。基準を満たしていればリライトを省略します（2案以上ではリアルタイム表示は行いません）"
+        )
+
+        # リライトの方針
+        rewrite_policy = st.selectbox(
+            "✨ 自動リライト",
+            list(REWRITE_POLICIES),
+            index=list(REWRITE_POLICIES).index(default_rewrite_policy()),
+            format_func=REWRITE_POLICIES.get,
+            help="「必要なときだけ」は初稿の文字数・構成・エンディングをローカルで確認し、基準を満たしていればリライトを省略、文字数の超過だけなら短縮のみ行います（API呼び出しが減ります）"
+        )
+
+        # レスポンスキャッシュ
+        with st.expander("🗄️ レスポンスキャッシュ"):
+            use_response_cache = st.checkbox(
+                "同じ条件の生成結果を再利用する",
+                value=os.getenv("RESPONSE_CACHE_ENABLED", "") == "1",
+                help="テーマ・トーン・視点・プロンプトが同じ場合、前回のAPI応答を再利用します（短縮処理も含む）"
+            )
+            bypass_response_cache = st.checkbox(
+                "今回はキャッシュを使わずに再生成",
+                value=False,
+                disabled=not use_response_cache,
+                help="キャッシュを読まずにAPIを呼び出し、結果でキャッシュを更新します"
+            )
+            cache_stats = get_response_cache_stats()
+            st.caption(
+                f"保存数: {cache_stats['entries']}件（{cache_stats['total_bytes'] / 1024:.0f}KB） / "
+                f"ヒット: {cache_stats['hits']} / ミス: {cache_stats['misses']} / ヒット率: {cache_stats['hit_rate']:.0%}"
+            )
+            if st.button("🧹 キャッシュを削除", key="clear_response_cache"):
+                clear_response_cache()
+                st.rerun()
+
+            # プロンプトキャッシュ（API側）の効き具合
+            usage_stats = get_api_usage_stats()
+            if usage_stats:
+                st.markdown("**プロンプトキャッシュ（API）**")
+                for stage, usage in usage_stats.items():
+                    st.caption(
+                        f"{stage}: {usage['calls']}回 / 入力 {usage['input_tokens']:,} / "
+                        f"キャッシュ作成 {usage['cache_creation_input_tokens']:,} / "
+                        f"キャッシュ読込 {usage['cache_read_input_tokens']:,}（{usage['cache_hit_rate']:.0%}）"
+                    )
+
+        if not use_response_cache:
+            cache_mode = CACHE_OFF
+        elif bypass_response_cache:
+            cache_mode = CACHE_REFRESH
+        else:
+            cache_mode = CACHE_ON
+
         # トーン選択
         st.subheader("🎭 トーン/雰囲気")
         tone = st.selectbox(
             "雰囲気を選択",
-            [
-                "甘々・胸キュン全開",
-                "切ない・号泣系",
-                "コメディ・笑える恋愛",
-                "ドロドロ・三角関係",
-                "純愛・初恋系",
-                "大人の恋愛・切実",
-                "すれ違い・じれったい",
-                "逆転・スカッと系"
-            ]
+            TONE_OPTIONS
         )
 
         st.divider()
@@ -927,20 +5032,49 @@ def main():
 
         # 統計情報表示
         st.subheader("📊 統計情報")
-        stats = get_statistics()
+        stats = get_statistics_cached()
         if stats["total_count"] > 0:
             col1, col2 = st.columns(2)
             with col1:
                 st.metric("総生成数", stats["total_count"])
             with col2:
-                favorites_count = len(get_favorites())
+                favorites_count = len(get_favorites_cached())
                 st.metric("お気に入り", favorites_count)
             
-            # トーン別の統計
-            if stats["by_tone"]:
-                with st.expander("📈 トーン別統計"):
-                    for tone, count in sorted(stats["by_tone"].items(), key=lambda x: x[1], reverse=True):
-                        st.progress(count / stats["total_count"], text=f"{tone}: {count}件")
+            # トーン別・視点別・プロンプトバージョン別の統計
+            for title, breakdown in [
+                ("📈 トーン別統計", stats["by_tone"]),
+                ("👁️ 視点別統計", stats["by_viewpoint"]),
+                ("🔧 プロンプトバージョン別統計", stats["by_prompt_version"]),
+            ]:
+                if breakdown:
+                    with st.expander(title):
+                        for key, count in sorted(breakdown.items(), key=lambda x: x[1], reverse=True):
+                            st.progress(count / stats["total_count"], text=f"{key}: {count}件")
+
+            st.caption(f"✏️ 編集済み: {stats['by_edited']['edited']}件 / 未編集: {stats['by_edited']['unedited']}件")
+
+            # ステージ別の所要時間・コスト（保存済みの計測値から集計）
+            with st.expander("⏱️ 所要時間・コスト"):
+                metrics_group = st.radio(
+                    "集計単位",
+                    ["stage", "day", "prompt_version"],
+                    format_func={"stage": "ステージ別", "day": "日別", "prompt_version": "プロンプトバージョン別"}.get,
+                    horizontal=True,
+                    key="metrics_group"
+                )
+                metrics_days = st.selectbox("期間", [7, 30, None], format_func=lambda d: f"直近{d}日" if d else "全期間", key="metrics_days")
+                metrics_summary = get_call_metrics_summary_cached(metrics_group, metrics_days)
+                if metrics_summary:
+                    columns = ("group",) * (metrics_group != "stage") + ("stage", "calls", "p50_sec", "p95_sec", "retries", "cost_usd")
+                    st.dataframe(
+                        [{k: item[k] for k in columns} for item in metrics_summary],
+                        use_container_width=True,
+                        hide_index=True
+                    )
+                    st.caption("p50/p95はレスポンスキャッシュを使わなかった呼び出しの所要時間（秒）、コストはUSDの概算です")
+                else:
+                    st.info("まだ計測データがありません")
         else:
             st.info("まだ統計情報がありません")
 
@@ -963,37 +5097,48 @@ def main():
         if st.button("🔄 履歴を更新", type="primary"):
             st.rerun()
 
-        histories = load_history(limit=20, search_query=search_query)
-        
-        # お気に入りフィルター
-        if filter_type == "お気に入りのみ":
-            favorites = get_favorites()
-            histories = [h for h in histories if h.get('timestamp', '') in favorites]
-        
+        # 一覧はサマリー（本文なし）をページ単位で読み、セッションにはページの位置（カーソル）だけを持つ
+        favorites_only = filter_type == "お気に入りのみ"
+        list_key = (search_query, favorites_only)
+        if st.session_state.get("history_list_key") != list_key:
+            st.session_state.history_list_key = list_key
+            st.session_state.history_cursors = [None]
+
+        histories = []
+        next_cursor = None
+        for cursor in st.session_state.history_cursors:
+            page, next_cursor = load_history_page_cached(
+                limit=HISTORY_PAGE_SIZE, cursor=cursor, search_query=search_query, favorites_only=favorites_only
+            )
+            histories.extend(page)
+            if next_cursor is None:
+                break
+
         if histories:
             st.caption(f"表示中: {len(histories)}件")
-            for i, hist in enumerate(histories, 1):
-                timestamp = hist.get('timestamp', '')
-                theme_preview = hist['theme'][:20]
-                is_fav = is_favorite(timestamp) if timestamp else False
-                
+            for i, summary in enumerate(histories, 1):
+                timestamp = summary['id']
+                is_fav = summary['favorite']
+
                 col1, col2 = st.columns([5, 1])
                 with col1:
                     if st.button(
-                        f"{'⭐' if is_fav else '📄'} {theme_preview}",
-                        key=f"hist_link_{i}",
+                        f"{'⭐' if is_fav else '📄'} {summary['theme_preview']}",
+                        key=f"hist_link_{timestamp}",
                         type="secondary",
-                        use_container_width=True
+                        use_container_width=True,
+                        help=f"{summary['timestamp'][:16]} / {summary['tone']} / {summary['total_chars']}文字"
                     ):
-                        st.session_state.selected_history = hist
-                        st.session_state.selected_history_index = i
+                        open_selected_history(timestamp, i)
                         st.rerun()
                 with col2:
-                    if timestamp:
-                        fav_key = f"fav_{i}_{timestamp}"
-                        if st.button("⭐" if is_fav else "☆", key=fav_key, help="お気に入り"):
-                            toggle_favorite(timestamp)
-                            st.rerun()
+                    if st.button("⭐" if is_fav else "☆", key=f"fav_{timestamp}", help="お気に入り"):
+                        toggle_favorite(timestamp)
+                        st.rerun()
+            if next_cursor is not None:
+                if st.button("⬇️ もっと見る", key="history_load_more", use_container_width=True):
+                    st.session_state.history_cursors.append(next_cursor)
+                    st.rerun()
         else:
             st.info("まだ生成履歴がありません" if not search_query and filter_type == "すべて" else "検索結果がありません")
 
@@ -1016,7 +5161,7 @@ def main():
                         if st.button("復元", key=f"restore_{version_file}"):
                             restore_prompt_version(version_file)
                             st.success(f"✅ {version_file}に復元しました！")
-                            st.info("アプリを再起動すると反映されます")
+                            st.info("次の生成から反映されます")
                             st.rerun()
         else:
             st.info("保存されたバージョンはありません")
@@ -1051,12 +5196,14 @@ def main():
 - ✅ 不要な形式（1話完結・10話連載）を削除
 - ✅ バズる要素と胸キュンに集中
 - ✅ 自動文字数カウント機能追加
-
-**生成時間**
-- 初稿生成：約30〜60秒
-- 自動リライト：約20〜40秒
-- 合計：約1〜2分
             """)
+            # 生成時間は固定の目安ではなく、保存済みの計測値（直近30日）から表示する
+            timing = [item for item in get_call_metrics_summary_cached("stage", 30) if item["calls"] > item["cached_calls"]]
+            if timing:
+                st.markdown("**生成時間（直近30日の実測）**\n" + "\n".join(
+                    f"- {STAGE_LABELS.get(item['stage'], item['stage'])}：中央値 約{item['p50_sec']:.0f}秒（p95 {item['p95_sec']:.0f}秒）"
+                    for item in timing
+                ))
 
     # メインコンテンツ
     col1, col2 = st.columns([2, 1])
@@ -1111,81 +5258,106 @@ def main():
         st.warning("⚠️ テーマ/ネタを入力してください")
     else:
         if st.button("🎬 シナリオを生成する", type="primary"):
+            # 生成はバックグラウンドで動かし、この画面では履歴の閲覧や次のテーマの登録を続けられる
+            job_id = submit_generation_job(
+                api_key, theme, story_format, tone, additional_notes, viewpoint,
+                cache_mode=cache_mode,
+                draft_candidates=draft_candidates,
+                streaming=use_streaming,
+                rewrite_policy=rewrite_policy
+            )
+            st.session_state.setdefault("job_ids", []).append(job_id)
+            st.toast(f"🚀 生成ジョブを登録しました: {theme[:20]}")
+
+    render_generation_jobs()
+
+    # 一括生成
+    with st.expander("📦 一括生成（CSV/JSONL）", expanded=False):
+        st.caption(f"列: theme（必須）, tone, viewpoint, additional_notes ／ tone・viewpointが空欄の行は「{TONE_OPTIONS[0]}」「{DEFAULT_VIEWPOINT}」で生成します")
+        batch_file = st.file_uploader("テーマリストを選択", type=["csv", "jsonl"], key="batch_file")
+        batch_concurrency = st.slider("同時実行数", min_value=1, max_value=8, value=4, key="batch_concurrency")
+
+        if batch_file is not None:
+            batch_errors = []
             try:
-                # 進捗表示用のプレースホルダー
-                progress_container = st.container()
-                
-                with progress_container:
-                    st.info("🚀 シナリオ生成を開始します...")
-                    
-                    # ステップ1: シナリオ生成
-                    progress_bar = st.progress(0)
-                    status_text = st.empty()
-                    
-                    status_text.text("📝 ステップ1/2: シナリオ初稿を作成中... (約30-60秒)")
-                    progress_bar.progress(25)
-                    
-                    draft_scenario = generate_scenario(api_key, theme, story_format, tone, additional_notes, viewpoint)
-                    
-                    # エラーチェック
-                    if draft_scenario.startswith("エラーが発生しました"):
-                        st.error(f"❌ シナリオ生成中にエラーが発生しました: {draft_scenario}")
-                        st.info("💡 解決方法:\n- APIキーが正しいか確認してください\n- インターネット接続を確認してください\n- しばらく待ってから再試行してください")
-                    else:
-                        progress_bar.progress(50)
-                        
-                        # ステップ2: 自動チェック＆リライト
-                        status_text.text("✨ ステップ2/2: 品質チェック＆自動リライト中... (約20-40秒)")
-                        progress_bar.progress(75)
-                        
-                        final_scenario = check_and_fix_scenario(api_key, draft_scenario, viewpoint)
-                        
-                        progress_bar.progress(100)
-                        status_text.text("✅ シナリオ生成が完了しました！")
-                        
-                        # セッションステートに保存
-                        st.session_state.result = final_scenario
-                        st.session_state.theme = theme
-                        st.session_state.story_format = story_format
-                        st.session_state.tone = tone
-                        st.session_state.viewpoint = viewpoint
-
-                        # 履歴に保存（プロンプトバージョンと視点も記録）
-                        save_history(
-                            theme,
-                            story_format,
-                            tone,
-                            final_scenario,
-                            additional_notes=additional_notes,
-                            feasibility_check="",  # 空文字列にする
-                            prompt_version=PROMPT_VERSION,  # プロンプトバージョンを記録
-                            viewpoint=viewpoint  # 視点情報を記録
-                        )
-                        
-                        # 成功メッセージ
-                        st.success("🎉 シナリオが生成されました！")
-                        st.balloons()
-                        
-                        # 少し待ってからリロード
-                        time.sleep(1)
-                        st.rerun()
-                        
-            except anthropic.APIError as e:
-                st.error(f"❌ APIエラーが発生しました: {str(e)}")
-                st.info("💡 解決方法:\n- APIキーとクレジット残高を確認してください\n- APIの利用制限を確認してください")
-            except Exception as e:
-                st.error(f"❌ 予期しないエラーが発生しました: {str(e)}")
-                st.info("💡 エラーが続く場合は、開発者にお問い合わせください")
-                import traceback
-                with st.expander("🔍 詳細なエラー情報"):
-                    st.code(traceback.format_exc())
+                batch_rows = parse_batch_rows(decode_batch_file(batch_file.getvalue()), batch_file.name, errors=batch_errors)
+            except ValueError as e:
+                st.error(f"❌ {e}")
+                batch_rows = []
+            if batch_errors:
+                st.error("❌ 次の行は読み込めなかったため飛ばします\n\n" + "\n".join(f"- {message}" for message in batch_errors))
+            st.info(f"📋 {len(batch_rows)}件のテーマを読み込みました")
+
+            if not api_key:
+                st.warning("⚠️ サイドバーでAnthropic API Keyを入力してください")
+            elif batch_rows and st.button("🚀 一括生成を開始", key="batch_start"):
+                # 行ごとの進捗と状況レポートは「🧵 生成ジョブ」に表示する
+                job_id = submit_batch_job(
+                    api_key, batch_rows, batch_file.name,
+                    concurrency=batch_concurrency,
+                    story_format=story_format,
+                    cache_mode=cache_mode,
+                    draft_candidates=draft_candidates,
+                    rewrite_policy=rewrite_policy
+                )
+                st.session_state.setdefault("job_ids", []).append(job_id)
+                st.toast(f"🚀 一括生成ジョブを登録しました: {len(batch_rows)}件")
+                st.rerun()
+
+    # 履歴のエクスポート
+    with st.expander("📤 履歴のエクスポート（ZIP/CSV/JSONL）", expanded=False):
+        st.caption("条件に合う履歴をまとめて書き出します（ZIPは1件1ファイルのMarkdown）")
+        export_col1, export_col2 = st.columns(2)
+        with export_col1:
+            export_dates = st.date_input("作成日（範囲）", value=(), key="export_dates")
+            export_tones = st.multiselect("トーン（空欄ならすべて）", TONE_OPTIONS, key="export_tones")
+        with export_col2:
+            export_query = st.text_input("検索語（空欄ならすべて）", key="export_query")
+            export_favorites = st.checkbox("お気に入りのみ", key="export_favorites")
+        export_format = st.radio("形式", list(EXPORT_FORMATS), horizontal=True, key="export_format")
+
+        if st.button("📤 エクスポートを作成", key="export_start"):
+            date_from, date_to = date_input_range(export_dates)
+            with st.spinner("書き出し中..."):
+                export_path, export_count = create_export_file(
+                    export_format,
+                    search_query=export_query,
+                    date_from=date_from,
+                    date_to=date_to,
+                    tones=export_tones,
+                    favorites_only=export_favorites,
+                )
+            st.session_state.export_file = (export_path, export_count, export_format)
+
+        if st.session_state.get("export_file"):
+            export_path, export_count, exported_format = st.session_state.export_file
+            if os.path.exists(export_path):
+                st.success(f"✅ {export_count}件を書き出しました")
+                with open(export_path, "rb") as f:
+                    st.download_button(
+                        label=f"⬇️ {os.path.basename(export_path)}",
+                        data=f,
+                        file_name=os.path.basename(export_path),
+                        mime=EXPORT_FORMATS[exported_format][1],
+                        key="export_dl"
+                    )
 
     # 右カラム: 結果表示（新規生成 or 履歴選択）
-    if "selected_history" in st.session_state:
+    hist = None
+    if "selected_history_id" in st.session_state:
+        # 選択中の履歴の本文はここで初めて読む（セッションにはidだけを持つ）
+        hist = read_history_cached(st.session_state.selected_history_id)
+        if hist is None:
+            close_selected_history()
+            st.warning("⚠️ 選択した履歴が見つかりません（別のセッションで削除された可能性があります）")
+        else:
+            st.session_state.setdefault("selected_history_revision", hist.get('revision', 1))
+
+    if hist is not None:
         # 履歴が選択された場合
         st.divider()
-        hist = st.session_state.selected_history
-        st.header(f"📝 履歴 #{st.session_state.selected_history_index}")
+        history_index = st.session_state.selected_history_index
+        st.header(f"📝 履歴 #{history_index}" if history_index is not None else "📝 生成されたシナリオ")
 
         # 履歴情報の表示
         prompt_ver = hist.get('prompt_version', '不明')
@@ -1196,13 +5368,27 @@ def main():
 **トーン**: {hist['tone']}
 **視点**: {viewpoint_info}
 **日時**: {hist['timestamp'][:19]}
-**プロンプトバージョン**: v{prompt_ver}
+**プロンプトバージョン**: v{prompt_ver}{f" ({hist['prompt_hash'][:12]})" if hist.get('prompt_hash') else ""}
         """)
 
         if hist.get('additional_notes'):
             with st.expander("📌 追加の要望"):
                 st.write(hist['additional_notes'])
 
+        if hist.get('rewrite'):
+            st.caption(f"✨ {describe_rewrite_plan(hist['rewrite'])}")
+
+        if hist.get('metrics'):
+            with st.expander("⏱️ API呼び出しの記録"):
+                st.dataframe(
+                    [{k: m.get(k) for k in ("stage", "model", "wall_sec", "input_tokens", "output_tokens", "cache_read_input_tokens", "retries", "stop_reason", "cost_usd")} for m in hist['metrics']],
+                    use_container_width=True
+                )
+                st.caption(
+                    f"合計: {sum(m.get('wall_sec', 0) for m in hist['metrics']):.1f}秒 / "
+                    f"${sum(m.get('cost_usd', 0) for m in hist['metrics']):.4f}"
+                )
+
         # シナリオ表示
         st.markdown('<div class="output-section">', unsafe_allow_html=True)
         st.markdown(hist['result'])
@@ -1210,32 +5396,7 @@ def main():
 
         # 文字数カウント表示（前後編の場合）
         if "前後編" in hist['story_format']:
-            scenario_text = hist['result']
-            # 登場人物セクションを除外
-            if "■前編" in scenario_text:
-                scenario_only = scenario_text.split("■前編", 1)[1] if "■前編" in scenario_text else scenario_text
-
-                # 前編と後編を分割
-                if "■後編" in scenario_only:
-                    parts = scenario_only.split("■後編")
-                    zenpen_text = parts[0]
-                    kohen_text = parts[1] if len(parts) > 1 else ""
-
-                    zenpen_count = count_characters(zenpen_text)
-                    kohen_count = count_characters(kohen_text)
-                    total_count = zenpen_count + kohen_count
-
-                    # 文字数表示
-                    st.info(f"""
-**📊 実測文字数**（改行・記号・括弧を除く）
-前編: {zenpen_count}文字 / 後編: {kohen_count}文字 / 合計: {total_count}文字
-                    """)
-
-                    # 文字数オーバーの警告
-                    if zenpen_count > 500 or kohen_count > 500 or total_count > 1000:
-                        st.warning("⚠️ 文字数が制限を超えています")
-                    elif total_count < 800:
-                        st.info("ℹ️ 推奨文字数（800-1000文字）より少なめです")
+            render_char_counts(hist['result'])
 
         # 編集機能
         with st.expander("✏️ シナリオを編集", expanded=False):
@@ -1249,14 +5410,25 @@ def main():
             col_edit1, col_edit2 = st.columns(2)
             with col_edit1:
                 if st.button("💾 保存", key=f"save_edit_{hist.get('timestamp', '')}"):
-                    if update_history(hist.get('timestamp', ''), edited_scenario):
-                        st.success("✅ シナリオを更新しました！")
-                        # 履歴を再読み込み
-                        hist['result'] = edited_scenario
-                        st.session_state.selected_history = hist
-                        st.rerun()
+                    try:
+                        updated = update_history(
+                            hist.get('timestamp', ''), edited_scenario,
+                            expected_revision=st.session_state.selected_history_revision
+                        )
+                    except HistoryConflictError as e:
+                        # 最新の版を読み込み直す。編集中の内容は残るので、確認してからもう一度保存すれば上書きできる
+                        st.error(f"❌ {e}")
+                        st.info("💡 最新の内容を下に表示しました。確認してからもう一度保存すると上書きします")
+                        with st.expander("📄 現在保存されている内容", expanded=True):
+                            st.markdown(e.latest.get('result', ''))
+                        st.session_state.selected_history_revision = e.latest.get('revision', 1)
                     else:
-                        st.error("❌ 保存に失敗しました")
+                        if updated:
+                            st.success("✅ シナリオを更新しました！")
+                            st.session_state.selected_history_revision = updated['revision']
+                            st.rerun()
+                        else:
+                            st.error("❌ 保存に失敗しました")
             
             with col_edit2:
                 if st.button("↩️ キャンセル", key=f"cancel_edit_{hist.get('timestamp', '')}"):
@@ -1268,27 +5440,7 @@ def main():
         timestamp_str = hist['timestamp'][:19].replace(":", "").replace("-", "").replace(" ", "_")
 
         # 完全な内容を作成
-        full_content = f"""# 恋愛漫画シナリオ
-
-## 生成情報
-- 日時: {hist['timestamp'][:19]}
-- 形式: {hist['story_format']}
-- トーン: {hist['tone']}
-
-## テーマ
-{hist['theme']}
-
-"""
-        if hist.get('additional_notes'):
-            full_content += f"""## 追加の要望
-{hist['additional_notes']}
-
-"""
-
-        full_content += f"""## 生成されたシナリオ
-
-{hist['result']}
-"""
+        full_content = format_history_markdown(hist)
 
         with col1:
             st.download_button(
@@ -1320,120 +5472,17 @@ def main():
             col_close, col_delete = st.columns(2)
             with col_close:
                 if st.button("✖️ 閉じる"):
-                    del st.session_state.selected_history
-                    del st.session_state.selected_history_index
+                    close_selected_history()
                     st.rerun()
             with col_delete:
                 if st.button("🗑️ 削除", type="secondary"):
                     if delete_history(hist.get('timestamp', '')):
                         st.success("✅ 履歴を削除しました")
-                        del st.session_state.selected_history
-                        del st.session_state.selected_history_index
+                        close_selected_history()
                         time.sleep(0.5)
                         st.rerun()
                     else:
                         st.error("❌ 削除に失敗しました")
 
-    elif "result" in st.session_state:
-        # 新規生成された場合
-        st.divider()
-        st.header("📝 生成されたシナリオ")
-
-        # 結果表示エリア
-        st.markdown('<div class="output-section">', unsafe_allow_html=True)
-        st.markdown(st.session_state.result)
-        st.markdown('</div>', unsafe_allow_html=True)
-
-        # 文字数カウント表示（前後編の場合）
-        if "前後編" in st.session_state.story_format:
-            scenario_text = st.session_state.result
-            # 登場人物セクションを除外
-            if "■前編" in scenario_text:
-                scenario_only = scenario_text.split("■前編", 1)[1] if "■前編" in scenario_text else scenario_text
-
-                # 前編と後編を分割
-                if "■後編" in scenario_only:
-                    parts = scenario_only.split("■後編")
-                    zenpen_text = parts[0]
-                    kohen_text = parts[1] if len(parts) > 1 else ""
-
-                    zenpen_count = count_characters(zenpen_text)
-                    kohen_count = count_characters(kohen_text)
-                    total_count = zenpen_count + kohen_count
-
-                    # 文字数表示
-                    st.info(f"""
-**📊 実測文字数**（改行・記号・括弧を除く）
-前編: {zenpen_count}文字 / 後編: {kohen_count}文字 / 合計: {total_count}文字
-                    """)
-
-                    # 文字数オーバーの警告
-                    if zenpen_count > 500 or kohen_count > 500 or total_count > 1000:
-                        st.warning("⚠️ 文字数が制限を超えています")
-                    elif total_count < 800:
-                        st.info("ℹ️ 推奨文字数（800-1000文字）より少なめです")
-
-        # 編集機能
-        with st.expander("✏️ シナリオを編集", expanded=False):
-            edited_scenario_new = st.text_area(
-                "シナリオを編集してください",
-                value=st.session_state.result,
-                height=400,
-                key="edit_new_scenario"
-            )
-            
-            col_edit1, col_edit2 = st.columns(2)
-            with col_edit1:
-                if st.button("💾 保存", key="save_edit_new"):
-                    # セッションステートを更新
-                    st.session_state.result = edited_scenario_new
-                    st.success("✅ シナリオを更新しました！")
-                    st.rerun()
-            
-            with col_edit2:
-                if st.button("↩️ キャンセル", key="cancel_edit_new"):
-                    st.rerun()
-
-        # アクションボタン
-        col1, col2, col3, col4 = st.columns(4)
-
-        with col1:
-            # テキストファイルダウンロード
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"scenario_{timestamp}.txt"
-
-            st.download_button(
-                label="📄 テキストでダウンロード",
-                data=st.session_state.result,
-                file_name=filename,
-                mime="text/plain"
-            )
-
-        with col2:
-            # Markdownファイルダウンロード
-            md_filename = f"scenario_{timestamp}.md"
-
-            st.download_button(
-                label="📋 Markdownでダウンロード",
-                data=st.session_state.result,
-                file_name=md_filename,
-                mime="text/markdown"
-            )
-        
-        with col3:
-            # お気に入りボタン（新規生成の場合は履歴に保存後にお気に入り可能）
-            st.info("💡 履歴に保存されるとお気に入り機能が利用できます")
-        
-        with col4:
-            if st.button("🔄 新しいシナリオを生成"):
-                del st.session_state.result
-                if "theme" in st.session_state:
-                    del st.session_state.theme
-                if "story_format" in st.session_state:
-                    del st.session_state.story_format
-                if "tone" in st.session_state:
-                    del st.session_state.tone
-                st.rerun()
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,331 @@
+"""
+ベンチマーク用のMessages API互換サーバー（ローカルで動くスタブ）
+
+APIクレジットを使わずにパイプラインの所要時間を測るため、
+/v1/messages に対して固定のシナリオ本文を返す。ストリーミングにも対応する。
+
+単体で起動する場合:
+    python bench/fake_anthropic.py --port 8765 --latency 0.5 --error-rate 0.05
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8765 streamlit run app.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 既定の応答本文（後編が上限を少し超える、実際の出力に近い形。短縮の工程まで通る）
+DEFAULT_SCENARIO_BODY = """【登場人物】
+A子：主人公、会社員
+B男：同期、無口だが優しい
+
+■前編
+
+※月曜の朝、オフィス
+A子「おはよう…また残業続きで眠い」
+B男「これ、飲む？」※缶コーヒーを差し出す
+A子「え、いいの？」
+※A子の好きな銘柄
+A子（なんで知ってるんだろう）
+※昼休み、A子がデスクで資料を広げる
+B男「それ、手伝おうか」
+A子「大丈夫、自分でやるから」
+B男「…そっか」※少し寂しそうな顔
+※夜、誰もいないオフィス
+A子「終わらない…」
+※机の上にメモと付箋の束
+B男のメモ『前に言ってた資料、まとめておいた』
+A子（いつの間に…）
+※A子が振り返ると、B男が帰り支度をしている
+A子「待って、これ全部B男くんがやってくれたの？」
+B男「別に、ついでだから」
+A子「ついでで三十ページもまとめないでしょ」
+※B男が目をそらす
+A子（前にも、コピー機が壊れたときに直してくれたっけ）
+A子（風邪をひいた日には、机にのど飴が置いてあった）
+A子（あれも全部、B男くんだったの？）
+A子「ねえ、なんでいつも助けてくれるの？」
+B男「…それは」
+※B男が言葉に詰まる
+
+後編タイトル『無口な同期の本音』
+
+■後編
+
+※翌朝、エレベーター前
+B男「昨日の続き、話してもいい？」
+A子「うん」
+B男「入社したとき、迷子になってた俺に道を教えてくれたの覚えてる？」
+A子「え…あれB男くんだったの？」
+B男「あの日からずっと、恩返ししたかった」
+※A子の顔が赤くなる
+A子「恩返しだけ？」
+B男「…それだけじゃない」
+※エレベーターの扉が開く
+B男「今度、ちゃんとご飯に誘ってもいい？」
+A子「缶コーヒーじゃなくて？」
+B男「缶コーヒーも付ける」
+※二人で笑う
+※金曜の夜、駅前の小さな定食屋
+A子「ここ、B男くんの行きつけ？」
+B男「うん。A子が好きそうだと思って、ずっと連れてきたかった」
+A子「ずっとって、いつから？」
+B男「入社式の帰りから」
+A子「そんなに前から！？」
+※店主がにやにやしながら焼き魚を置く
+店主「やっと連れてきたねえ」
+B男「…余計なこと言わないでください」
+A子（耳まで真っ赤になってる）
+A子「ねえ、また来ようね」
+B男「毎週でもいい」
+※帰り道、二人の歩幅がそろっていく
+A子「缶コーヒー、明日は私がおごるね」
+B男「じゃあ、明日も一緒に残業する」
+A子「残業はしなくていいの！」
+B男「じゃあ、残業しない日は毎日一緒に帰る」
+A子「それ、もう付き合ってるみたいじゃない？」
+B男「…そのつもりだったけど」
+A子「えっ」
+※A子が立ち止まり、B男が振り返って笑う
+※一週間後、A子のデスクに缶コーヒーが二本
+A子「今日はどこ行く？」
+B男「A子が行きたいところ」
+A子（無口な同期は、意外と甘い）
+
+文字数：前編480文字 / 後編495文字 / 合計975文字
+"""
+
+# 短縮の依頼に返す本文（前編/後編の片方、上限内）
+DEFAULT_SHORT_HALF_BODY = """
+※月曜の朝、オフィス
+A子「また残業で眠い」
+B男「これ、飲む？」※缶コーヒー
+A子（好きな銘柄…なんで知ってるの）
+※夜、机の上にB男のメモ
+B男のメモ『資料、まとめておいた』
+A子「なんでいつも助けてくれるの？」
+B男「…それは」
+
+後編タイトル『無口な同期の本音』
+"""
+
+
+@dataclass
+class FakeServerConfig:
+    """スタブサーバーの応答設定"""
+    latency: float = 0.0              # 最初の応答までの待ち時間（秒）
+    chunk_delay: float = 0.0          # ストリーミング時のチャンク間隔（秒）
+    chunk_chars: int = 40             # ストリーミング1チャンクあたりの文字数
+    error_rate: float = 0.0           # 529（過負荷）を返す割合
+    input_tokens: int = 0             # 0ならリクエスト本文の文字数で近似
+    cache_read_input_tokens: int = 0  # 毎回返すキャッシュ読み込みトークン数
+    body: str = DEFAULT_SCENARIO_BODY
+    short_half_body: str = DEFAULT_SHORT_HALF_BODY
+    seed: int = 0
+    requests: list = field(default_factory=list)  # 受け付けたリクエストの記録（model, stream, status）
+
+    def __post_init__(self):
+        self._random = random.Random(self.seed)
+        self._lock = threading.Lock()
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def choose_body(self, request):
+        """短縮の依頼（【目標文字数】を含むユーザー入力）には片方の本文だけを返す"""
+        user_text = json.dumps(request.get("messages", []), ensure_ascii=False)
+        return self.short_half_body if "目標文字数" in user_text else self.body
+
+
+def _apply_stop_conditions(text, request):
+    """
+    stop_sequences と max_tokens（1文字=1トークンとして扱う）を実際のAPIと同じように適用する
+
+    Returns:
+        (本文, stop_reason, stop_sequence)
+    """
+    earliest = None
+    for sequence in request.get("stop_sequences") or []:
+        position = text.find(sequence)
+        if position >= 0 and (earliest is None or position < earliest[0]):
+            earliest = (position, sequence)
+    stop_reason, stop_sequence = "end_turn", None
+    if earliest:
+        text, stop_reason, stop_sequence = text[:earliest[0]], "stop_sequence", earliest[1]
+    max_tokens = request.get("max_tokens")
+    if max_tokens and len(text) > max_tokens:
+        text, stop_reason, stop_sequence = text[:max_tokens], "max_tokens", None
+    return text, stop_reason, stop_sequence
+
+
+def _make_handler(config):
+    class FakeMessagesHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass  # 計測の邪魔になるためアクセスログは出さない
+
+        def _send_json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_event(self, event_type, data):
+            payload = f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(payload):x}\r\n".encode("ascii") + payload + b"\r\n")
+            self.wfile.flush()
+
+        def do_POST(self):
+            try:
+                self._respond()
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # クライアント側がタイムアウト・ヘッジで接続を切った
+
+        def _respond(self):
+            length = int(self.headers.get("content-length", 0))
+            raw_request = self.rfile.read(length)
+            request = json.loads(raw_request)
+            stream = bool(request.get("stream"))
+
+            if config.latency:
+                time.sleep(config.latency)
+
+            if config.should_fail():
+                config.requests.append({"model": request.get("model", ""), "stream": stream, "status": 529})
+                self._send_json(
+                    529,
+                    {"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded (fake)"}},
+                    headers={"retry-after-ms": "10"},
+                )
+                return
+            config.requests.append({"model": request.get("model", ""), "stream": stream, "status": 200})
+
+            text, stop_reason, stop_sequence = _apply_stop_conditions(config.choose_body(request), request)
+            usage = {
+                "input_tokens": config.input_tokens or len(raw_request.decode("utf-8")),
+                "output_tokens": len(text),
+                "cache_creation_input_tokens": 0,
+                "cache_read_input_tokens": config.cache_read_input_tokens,
+            }
+            message = {
+                "id": f"msg_fake_{len(config.requests)}",
+                "type": "message",
+                "role": "assistant",
+                "model": request.get("model", ""),
+                "content": [{"type": "text", "text": text}],
+                "stop_reason": stop_reason,
+                "stop_sequence": stop_sequence,
+                "usage": usage,
+            }
+
+            if not stream:
+                self._send_json(200, message)
+                return
+
+            self.send_response(200)
+            self.send_header("content-type", "text/event-stream")
+            self.send_header("transfer-encoding", "chunked")
+            self.end_headers()
+            self._send_event("message_start", {
+                "type": "message_start",
+                "message": dict(message, content=[], stop_reason=None, usage=dict(usage, output_tokens=1)),
+            })
+            self._send_event("content_block_start", {
+                "type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""},
+            })
+            for start in range(0, len(text), config.chunk_chars):
+                if config.chunk_delay:
+                    time.sleep(config.chunk_delay)
+                self._send_event("content_block_delta", {
+                    "type": "content_block_delta", "index": 0,
+                    "delta": {"type": "text_delta", "text": text[start:start + config.chunk_chars]},
+                })
+            self._send_event("content_block_stop", {"type": "content_block_stop", "index": 0})
+            self._send_event("message_delta", {
+                "type": "message_delta",
+                "delta": {"stop_reason": stop_reason, "stop_sequence": stop_sequence},
+                "usage": {"output_tokens": usage["output_tokens"]},
+            })
+            self._send_event("message_stop", {"type": "message_stop"})
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+    return FakeMessagesHandler
+
+
+class FakeAnthropicServer:
+    """
+    別スレッドで動かすスタブサーバー
+
+    with FakeAnthropicServer(FakeServerConfig(latency=0.2)) as server:
+        os.environ["ANTHROPIC_BASE_URL"] = server.base_url
+    """
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.config = config or FakeServerConfig()
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(self.config))
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-anthropic", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Messages API互換のスタブサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="応答までの待ち時間（秒）")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="ストリーミングのチャンク間隔（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="529を返す割合（0〜1）")
+    parser.add_argument("--cache-read-tokens", type=int, default=0, help="毎回返すキャッシュ読み込みトークン数")
+    parser.add_argument("--body-file", default="", help="応答本文として返すテキストファイル")
+    args = parser.parse_args()
+
+    config = FakeServerConfig(
+        latency=args.latency,
+        chunk_delay=args.chunk_delay,
+        error_rate=args.error_rate,
+        cache_read_input_tokens=args.cache_read_tokens,
+    )
+    if args.body_file:
+        with open(args.body_file, "r", encoding="utf-8") as f:
+            config.body = f.read()
+
+    server = FakeAnthropicServer(config, args.host, args.port)
+    print(f"Fake Messages API: {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+"""
+恋愛漫画シナリオ生成ツールv2 ベンチマーク
+
+APIクレジットを使わずに、スタブサーバー（fake_anthropic.py）相手の生成パイプラインと、
+合成した履歴データ上の保存・検索処理の所要時間を測ってJSONに書き出す。
+結果のJSONを --baseline に渡すと、前回からの変化率を表示する。
+
+使い方:
+    python bench/run_bench.py
+    python bench/run_bench.py --sizes 1000,10000 --pipeline-runs 20 --concurrency 4 --latency 0.3
+    python bench/run_bench.py --skip-storage --error-rate 0.1 --baseline bench/results/前回.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+# Streamlitを起動せずに st.cache_resource を使うと出る警告（No runtime found）を抑える。
+# Streamlitのロガーは作られるたびに設定のログレベルに戻されるため、
+# 個別に setLevel するのではなく、import 前に設定のほうをerrorにしておく
+os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")
+
+import streamlit.logger  # noqa: E402
+
+streamlit.logger.set_log_level("error")
+
+import app  # noqa: E402
+from fake_anthropic import DEFAULT_SCENARIO_BODY, FakeAnthropicServer, FakeServerConfig  # noqa: E402
+
+SYNTHETIC_THEMES = [
+    "冷たい上司が私にだけ優しい理由",
+    "10年ぶりに再会した初恋の人",
+    "幼馴染に突然告白されたけど",
+    "婚約破棄されたのに逆にモテ始めた",
+    "片思いの相手が実は同じマンションに住んでいた",
+    "無口な同期が毎朝缶コーヒーをくれる",
+]
+SYNTHETIC_NAMES = ["A子", "B子", "C美", "D香", "E奈"]
+
+
+def summarize(samples):
+    """所要時間（秒）のリストを ミリ秒の統計値にまとめる"""
+    ordered = sorted(samples)
+    return {
+        "runs": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": round(app._percentile(ordered, 0.50) * 1000, 3),
+        "p95_ms": round(app._percentile(ordered, 0.95) * 1000, 3),
+        "min_ms": round(ordered[0] * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def time_calls(func, repeat):
+    """func を repeat 回呼んで所要時間をまとめる"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+# ============================================================================
+# パイプライン（初稿生成 → リライト → 文字数制限）
+# ============================================================================
+
+def bench_pipeline(args):
+    """スタブサーバー相手に generate_scenario → refine_draft（plan_rewrite の判定に従う）を計測"""
+    config = FakeServerConfig(
+        latency=args.latency,
+        chunk_delay=args.chunk_delay,
+        error_rate=args.error_rate,
+        cache_read_input_tokens=args.cache_read_tokens,
+        seed=args.seed,
+    )
+    on_progress = (lambda text, output_tokens: None) if args.streaming else None
+
+    def run_once(index):
+        metrics = []
+        started = time.perf_counter()
+        try:
+            return _run_pipeline_once(index, metrics, started)
+        except app.ScenarioGenerationError as e:
+            return {"failed": e.kind, "total_sec": time.perf_counter() - started, "metrics": metrics, "rewrite": ""}
+
+    def _run_pipeline_once(index, metrics, started):
+        theme = SYNTHETIC_THEMES[index % len(SYNTHETIC_THEMES)]
+        if args.draft_candidates > 1:
+            draft, scores = app.generate_best_draft(
+                "bench-key", theme, app.STORY_FORMAT, app.TONE_OPTIONS[0],
+                candidates=args.draft_candidates, metrics=metrics
+            )
+        else:
+            draft = app.generate_scenario(
+                "bench-key", theme, app.STORY_FORMAT, app.TONE_OPTIONS[0],
+                on_progress=on_progress, metrics=metrics
+            )
+            scores = None
+        draft_sec = time.perf_counter() - started
+        plan = app.plan_rewrite(draft, args.rewrite, scores[0] if scores else None)
+        final = app.refine_draft("bench-key", draft, plan, on_progress=on_progress, metrics=metrics)
+        total_sec = time.perf_counter() - started
+        return {
+            "draft_sec": draft_sec,
+            "rewrite_sec": total_sec - draft_sec,
+            "total_sec": total_sec,
+            "metrics": metrics,
+            "rewrite": plan["action"],
+            "within_limit": app.parse_scenario(final).is_within_limit,
+            "failed": "",
+        }
+
+    with FakeAnthropicServer(config) as server:
+        os.environ["ANTHROPIC_BASE_URL"] = server.base_url
+        app.close_anthropic_clients()  # 以前のbase_urlのクライアントを使い回さない
+        run_once(0)  # 接続確立分を除くためのウォームアップ
+        server.config.requests.clear()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+            runs = list(executor.map(run_once, range(args.pipeline_runs)))
+        elapsed = time.perf_counter() - started
+        requests = list(server.config.requests)
+        app.close_anthropic_clients()
+
+    succeeded = [run for run in runs if not run["failed"]] or [{"total_sec": 0, "draft_sec": 0, "rewrite_sec": 0, "within_limit": False}]
+    stage_samples = {}
+    for run in runs:
+        for metric in run["metrics"]:
+            stage_samples.setdefault(metric["stage"], []).append(metric["wall_sec"])
+
+    return {
+        "config": {
+            "runs": args.pipeline_runs,
+            "concurrency": args.concurrency,
+            "latency": args.latency,
+            "chunk_delay": args.chunk_delay,
+            "error_rate": args.error_rate,
+            "streaming": args.streaming,
+            "draft_candidates": args.draft_candidates,
+            "rewrite_policy": args.rewrite,
+        },
+        "runs_per_second": round(len(runs) / elapsed, 3),
+        "total": summarize([run["total_sec"] for run in succeeded]),
+        "draft": summarize([run["draft_sec"] for run in succeeded]),
+        "rewrite_and_shorten": summarize([run["rewrite_sec"] for run in succeeded]),
+        "failed_runs": {kind: sum(1 for run in runs if run["failed"] == kind) for kind in {run["failed"] for run in runs} if kind},
+        "rewrite_actions": {action: sum(1 for run in runs if run["rewrite"] == action) for action in {run["rewrite"] for run in runs} if action},
+        "api_calls_by_stage": {stage: summarize(samples) for stage, samples in stage_samples.items()},
+        "retries": sum(metric["retries"] for run in runs for metric in run["metrics"]),
+        "truncated_calls": sum(
+            1 for run in runs for metric in run["metrics"] if metric.get("stop_reason") in (app.STOP_REASON_OVERRUN, "max_tokens")
+        ),
+        "server_requests": len(requests),
+        "server_errors": sum(1 for r in requests if r["status"] != 200),
+        "within_limit_ratio": round(sum(run["within_limit"] for run in succeeded) / len(runs), 3),
+    }
+
+
+# ============================================================================
+# 履歴の保存・検索（合成データ）
+# ============================================================================
+
+def write_synthetic_corpus(output_dir, size, seed):
+    """save_history と同じ形式の履歴JSONを size 件書き出す"""
+    rng = random.Random(seed)
+    base_time = datetime(2025, 1, 1)
+    os.makedirs(output_dir, exist_ok=True)
+
+    history_ids = []
+    for index in range(size):
+        created = base_time + timedelta(seconds=index * 311)  # 約1年に分散、秒単位で重複しない
+        name = rng.choice(SYNTHETIC_NAMES)
+        data = {
+            "timestamp": created.isoformat(),
+            "theme": f"{rng.choice(SYNTHETIC_THEMES)}（{index}）",
+            "story_format": app.STORY_FORMAT,
+            "tone": rng.choice(app.TONE_OPTIONS),
+            "additional_notes": "",
+            "feasibility_check": "",
+            "prompt_version": rng.choice(["1.0", "2.0"]),
+            "viewpoint": rng.choice([app.DEFAULT_VIEWPOINT, "親友・友人目線", "第三者の視点"]),
+            "prompt_hash": "",
+            "metrics": [
+                {"stage": stage, "model": "", "started_at": created.isoformat(), "wall_sec": rng.uniform(2, 40),
+                 "input_tokens": 3000, "output_tokens": 900, "cache_creation_input_tokens": 0,
+                 "cache_read_input_tokens": 2500, "retries": 0, "response_cached": False, "cost_usd": 0.01, "error": ""}
+                for stage in ("draft", "rewrite")
+            ],
+            "result": DEFAULT_SCENARIO_BODY.replace("A子", name),
+        }
+        filename = f"scenario_{created.strftime('%Y%m%d_%H%M%S')}.json"
+        with open(os.path.join(output_dir, filename), "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        history_ids.append(data["timestamp"])
+    return history_ids
+
+
+def bench_storage(size, args):
+    """size 件の履歴で load_history / get_statistics / update_history などを計測"""
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory(prefix=f"bench_{size}_") as output_dir:
+        os.environ["SCENARIO_OUTPUT_DIR"] = output_dir
+        started = time.perf_counter()
+        history_ids = write_synthetic_corpus(output_dir, size, args.seed)
+        write_sec = time.perf_counter() - started
+
+        # 初回は索引の作成とJSONの取り込みが走る
+        started = time.perf_counter()
+        app.load_history(limit=20)
+        import_sec = time.perf_counter() - started
+
+        repeat = args.repeat
+        results = {
+            "size": size,
+            "write_corpus_sec": round(write_sec, 3),
+            "initial_import_sec": round(import_sec, 3),
+            "load_history": time_calls(lambda: app.load_history(limit=20), repeat),
+            "load_history_page": time_calls(lambda: app.load_history_page(limit=20), repeat),
+            "load_history_search_fts": time_calls(lambda: app.load_history(limit=20, search_query="缶コーヒー"), repeat),
+            "load_history_search_short": time_calls(lambda: app.load_history(limit=20, search_query="残業"), max(1, repeat // 5)),
+            "get_statistics": time_calls(app.get_statistics, repeat),
+            "get_call_metrics_summary": time_calls(lambda: app.get_call_metrics_summary("stage"), max(1, repeat // 5)),
+            "update_history": time_calls(
+                lambda: app.update_history(rng.choice(history_ids), DEFAULT_SCENARIO_BODY + "\n（編集）"), repeat
+            ),
+        }
+        os.environ.pop("SCENARIO_OUTPUT_DIR", None)
+    return results
+
+
+def bench_count_characters(args):
+    """count_characters を合成シナリオで繰り返し呼んで1回あたりの時間を測る"""
+    texts = [DEFAULT_SCENARIO_BODY.replace("A子", name) for name in SYNTHETIC_NAMES]
+    iterations = args.repeat * 200
+
+    started = time.perf_counter()
+    for index in range(iterations):
+        app.count_characters(texts[index % len(texts)])
+    elapsed = time.perf_counter() - started
+    return {
+        "calls": iterations,
+        "text_chars": len(DEFAULT_SCENARIO_BODY),
+        "per_call_us": round(elapsed / iterations * 1_000_000, 3),
+        "parse_scenario_uncached": time_calls(lambda: app.build_scenario_document(DEFAULT_SCENARIO_BODY), args.repeat),
+    }
+
+
+# ============================================================================
+# 結果の保存と比較
+# ============================================================================
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def _flatten_timings(results, prefix=""):
+    """比較用に p50_ms / *_sec / per_call_us の値を "a.b.c" 形式のキーで取り出す"""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten_timings(value, f"{name}."))
+        elif isinstance(value, (int, float)) and (key == "p50_ms" or key.endswith("_sec") or key == "per_call_us"):
+            flat[name] = value
+    return flat
+
+
+def print_comparison(results, baseline):
+    current = _flatten_timings(results)
+    previous = _flatten_timings(baseline)
+    print(f"\n前回（{baseline.get('app_version', '?')} / {baseline.get('git_commit', '?')}）との比較:")
+    for name in sorted(current.keys() & previous.keys()):
+        if previous[name]:
+            ratio = current[name] / previous[name]
+            mark = "  ⚠️" if ratio > 1.2 else ""
+            print(f"  {name}: {previous[name]} → {current[name]} ({ratio:.2f}x){mark}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="生成パイプラインと履歴処理のベンチマーク")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="合成する履歴件数（カンマ区切り）")
+    parser.add_argument("--repeat", type=int, default=50, help="各マイクロベンチマークの繰り返し回数")
+    parser.add_argument("--pipeline-runs", type=int, default=10, help="パイプラインの実行回数")
+    parser.add_argument("--concurrency", type=int, default=1, help="パイプラインの同時実行数")
+    parser.add_argument("--latency", type=float, default=0.05, help="スタブサーバーの応答待ち時間（秒）")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="ストリーミングのチャンク間隔（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="スタブサーバーが529を返す割合")
+    parser.add_argument("--cache-read-tokens", type=int, default=0, help="スタブサーバーが返すキャッシュ読み込みトークン数")
+    parser.add_argument("--streaming", action="store_true", help="ストリーミングで受信する")
+    parser.add_argument("--draft-candidates", type=int, default=1, help="初稿の候補数（Best-of-N）")
+    parser.add_argument("--rewrite", choices=list(app.REWRITE_POLICIES), default=app.default_rewrite_policy(),
+                        help="リライトの方針（always / adaptive / never。デフォルト: 環境変数 REWRITE_POLICY か adaptive）")
+    parser.add_argument("--skip-pipeline", action="store_true", help="パイプラインの計測を省く")
+    parser.add_argument("--skip-storage", action="store_true", help="履歴処理の計測を省く")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="", help="結果JSONの保存先（省略時は bench/results/ に保存）")
+    parser.add_argument("--baseline", default="", help="比較する前回の結果JSON")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    results = {
+        "app_version": app.VERSION,
+        "prompt_version": app.PROMPT_VERSION,
+        "git_commit": _git_commit(),
+        "created_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "count_characters": bench_count_characters(args),
+    }
+    print(f"count_characters: {results['count_characters']['per_call_us']}µs/回")
+
+    if not args.skip_pipeline:
+        with tempfile.TemporaryDirectory(prefix="bench_pipeline_") as output_dir:
+            os.environ["SCENARIO_OUTPUT_DIR"] = output_dir
+            results["pipeline"] = bench_pipeline(args)
+            os.environ.pop("SCENARIO_OUTPUT_DIR", None)
+        pipeline = results["pipeline"]
+        print(f"pipeline: p50 {pipeline['total']['p50_ms']}ms / p95 {pipeline['total']['p95_ms']}ms "
+              f"/ {pipeline['runs_per_second']}件/秒 / リトライ {pipeline['retries']}回 "
+              f"/ リライト判定 {pipeline['rewrite_actions']}（{args.rewrite}）")
+
+    if not args.skip_storage:
+        results["storage"] = {}
+        for size in (int(s) for s in args.sizes.split(",") if s.strip()):
+            storage = bench_storage(size, args)
+            results["storage"][str(size)] = storage
+            print(f"storage[{size}]: 取り込み {storage['initial_import_sec']}秒 / "
+                  f"load_history p50 {storage['load_history']['p50_ms']}ms / "
+                  f"get_statistics p50 {storage['get_statistics']['p50_ms']}ms / "
+                  f"update_history p50 {storage['update_history']['p50_ms']}ms")
+
+    output_path = args.output or os.path.join(
+        BENCH_DIR, "results", f"bench_{app.VERSION}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"結果を保存しました: {output_path}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            print_comparison(results, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,243 @@
+"""
+恋愛漫画シナリオ生成ツールv2 コマンドライン版
+
+Streamlitを起動せずに、サーバー上やcronからツールの機能を実行する
+
+使い方:
+    python cli.py batch themes.csv --concurrency 4 --report report.csv
+    python cli.py batch themes.csv --candidates 3
+    python cli.py import-history
+    python cli.py rebuild-stats
+    python cli.py check-index
+    python cli.py scan-endings --processes 4
+    python cli.py duplicates --threshold 0.6 --report duplicates.csv
+    python cli.py compact --older-than 30
+    python cli.py export history.zip --from 2025-11-01 --to 2025-11-30 --tone 切ない・号泣系
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+from datetime import date
+
+from dotenv import load_dotenv
+
+import app
+
+
+def cmd_batch(args):
+    """テーマリスト（CSV/JSONL）から一括生成する"""
+    api_key = os.getenv("ANTHROPIC_API_KEY", "")
+    if not api_key:
+        print("ANTHROPIC_API_KEY が設定されていません", file=sys.stderr)
+        return 1
+
+    with open(args.input, "rb") as f:
+        data = f.read()
+    errors = []
+    try:
+        rows = app.parse_batch_rows(app.decode_batch_file(data), args.input, errors=errors)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    for message in errors:
+        print(f"読み込めない行を飛ばしました: {message}", file=sys.stderr)
+    print(f"{len(rows)}件のテーマを読み込みました（同時実行数: {args.concurrency}）")
+
+    reports = []
+    cache_mode = app.CACHE_ON if args.cache else app.CACHE_OFF
+    for report in app.iter_batch_generation(api_key, rows, concurrency=args.concurrency, cache_mode=cache_mode, draft_candidates=args.candidates, rewrite_policy=args.rewrite):
+        reports.append(report)
+        mark = "OK " if report["status"] == "success" else "NG "
+        rewrite = app.REWRITE_ACTION_LABELS.get(report["rewrite"], "")
+        print(f"[{len(reports)}/{len(rows)}] {mark}#{report['row']} {report['theme']} ({report['elapsed_sec']}秒{' / ' + rewrite if rewrite else ''}) {report['error']}")
+
+    reports.sort(key=lambda r: r["row"])
+    if args.report:
+        with open(args.report, "w", encoding="utf-8", newline="") as f:
+            f.write(app.batch_report_to_csv(reports))
+        print(f"状況レポートを保存しました: {args.report}")
+
+    failed = sum(1 for r in reports if r["status"] != "success")
+    print(f"完了: 成功 {len(reports) - failed}件 / 失敗 {failed}件")
+    return 1 if failed else 0
+
+
+def cmd_import_history(args):
+    """output/ のJSONファイルを履歴データベース（検索索引）に取り込む"""
+    count = app.import_history_files()
+    print(f"{count}件の履歴を取り込みました")
+    return 0
+
+
+def cmd_rebuild_stats(args):
+    """統計情報を履歴から再集計する（集計のずれを直す）"""
+    stats = app.rebuild_statistics()
+    print(f"総生成数: {stats['total_count']}件")
+    for tone, count in sorted(stats["by_tone"].items(), key=lambda x: x[1], reverse=True):
+        print(f"  {tone}: {count}件")
+    return 0
+
+
+def cmd_check_index(args):
+    """履歴の索引とJSONファイルの整合性を確認・修復する"""
+    report = app.check_history_index(repair=not args.dry_run, full=args.full)
+    print(f"索引にないファイル: {report['missing']}件 / ファイルがない索引: {report['stale']}件 / 読み直し: {report['reindexed']}件")
+    return 0
+
+
+def _print_pattern_counts(patterns, total, indent="  "):
+    for name, count in sorted(patterns.items(), key=lambda x: x[1], reverse=True):
+        print(f"{indent}{name}: {count}件（{count / total:.1%}）")
+
+
+def cmd_scan_endings(args):
+    """履歴全体のエンディングパターンをトーン別・プロンプトバージョン別に集計する"""
+    report = app.scan_ending_patterns(processes=args.processes, chunk_size=args.chunk_size)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return 0
+
+    if not report["total"]:
+        print("履歴がありません")
+        return 0
+    print(f"{report['total']}件中 {report['matched']}件がよくあるエンディングに該当（{report['matched'] / report['total']:.1%}）")
+    _print_pattern_counts(report["by_pattern"], report["total"])
+    for title, dimension in (("トーン別", "by_tone"), ("プロンプトバージョン別", "by_prompt_version")):
+        print(f"\n■{title}")
+        for key, group in sorted(report[dimension].items()):
+            print(f"  {key}（{group['total']}件）")
+            _print_pattern_counts(group["patterns"], group["total"], indent="    ")
+    return 0
+
+
+def cmd_duplicates(args):
+    """履歴の中で本文が似ているシナリオのまとまりを一覧にする"""
+    clusters = app.find_duplicate_clusters(threshold=args.threshold)
+    if not clusters:
+        print(f"類似度{args.threshold:.0%}以上のシナリオはありません")
+        return 0
+
+    print(f"{len(clusters)}組（計{sum(c['size'] for c in clusters)}件）が類似度{args.threshold:.0%}以上です")
+    for number, cluster in enumerate(clusters, 1):
+        print(f"\n#{number} {cluster['size']}件（最大類似度 {cluster['max_similarity']:.0%}）")
+        for member in cluster["members"]:
+            print(f"  {member['id']}  [{member['tone']} / v{member['prompt_version']}] {member['theme'][:30]}")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["cluster", "size", "max_similarity", "id", "theme", "tone", "prompt_version"])
+            for number, cluster in enumerate(clusters, 1):
+                for member in cluster["members"]:
+                    writer.writerow([number, cluster["size"], cluster["max_similarity"], member["id"],
+                                     member["theme"], member["tone"], member["prompt_version"]])
+        print(f"\nレポートを保存しました: {args.report}")
+    return 0
+
+
+def cmd_compact(args):
+    """古い履歴のJSONファイルをアーカイブのセグメントにまとめる"""
+    report = app.compact_history(
+        older_than_days=args.older_than, segment_records=args.segment_size, seal=args.seal,
+    )
+    print(f"アーカイブ: {report['archived']}件（{report['bytes_before'] / 1024:.0f}KB分のJSONファイルを削除）")
+    if report["skipped"]:
+        print(f"スキップ: {report['skipped']}件（読み込めない、または移動中に編集された）")
+    for segment in report["sealed"]:
+        print(f"封印: {segment}")
+    print(f"セグメント数: {report['segments']}（合計{report['archive_bytes'] / 1024:.0f}KB）")
+    print(f"history.db: {report['db_bytes_before'] / 1024:.0f}KB → {report['db_bytes_after'] / 1024:.0f}KB")
+    return 0
+
+
+def _parse_date(value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"日付は YYYY-MM-DD で指定してください: {value}")
+
+
+def cmd_export(args):
+    """条件に合う履歴をZIP/CSV/JSONLに書き出す（形式は --format か拡張子で決める）"""
+    export_format = args.format or os.path.splitext(args.output)[1].lstrip(".").lower()
+    if export_format not in app.EXPORT_FORMATS:
+        print(f"形式を --format で指定してください（{' / '.join(app.EXPORT_FORMATS)}）", file=sys.stderr)
+        return 1
+
+    count = app.export_history(
+        args.output, export_format,
+        search_query=args.search, date_from=args.date_from, date_to=args.date_to,
+        tones=args.tone, favorites_only=args.favorites, ids=args.id or None,
+    )
+    print(f"{count}件を書き出しました: {args.output}")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="恋愛漫画シナリオ生成ツールv2 コマンドライン版")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    batch = subparsers.add_parser("batch", help="CSV/JSONLのテーマリストから一括生成")
+    batch.add_argument("input", help="テーマリスト（列: theme, tone, viewpoint, additional_notes）")
+    batch.add_argument("--concurrency", type=int, default=4, help="同時実行数（デフォルト: 4）")
+    batch.add_argument("--report", default="", help="状況レポートの保存先CSV")
+    batch.add_argument("--cache", action="store_true", help="レスポンスキャッシュを使う")
+    batch.add_argument("--candidates", type=int, default=1, help=f"1行あたりの初稿の候補数（1〜{app.MAX_DRAFT_CANDIDATES}、デフォルト: 1）")
+    batch.add_argument("--rewrite", choices=list(app.REWRITE_POLICIES), default=app.default_rewrite_policy(),
+                       help="リライトの方針（always: 常に / adaptive: 初稿の採点で必要なときだけ / never: 短縮のみ。デフォルト: 環境変数 REWRITE_POLICY か adaptive）")
+    batch.set_defaults(func=cmd_batch)
+
+    import_history = subparsers.add_parser("import-history", help="既存の履歴JSONを検索索引に取り込む")
+    import_history.set_defaults(func=cmd_import_history)
+
+    rebuild_stats = subparsers.add_parser("rebuild-stats", help="統計情報を再集計する")
+    rebuild_stats.set_defaults(func=cmd_rebuild_stats)
+
+    check_index = subparsers.add_parser("check-index", help="履歴の索引とファイルの整合性を確認・修復する")
+    check_index.add_argument("--dry-run", action="store_true", help="確認のみで修復しない")
+    check_index.add_argument("--full", action="store_true", help="全ファイルを読み直す")
+    check_index.set_defaults(func=cmd_check_index)
+
+    scan_endings = subparsers.add_parser("scan-endings", help="履歴全体のエンディングパターンを集計する")
+    scan_endings.add_argument("--processes", type=int, default=None, help="ワーカープロセス数（デフォルト: CPU数）")
+    scan_endings.add_argument("--chunk-size", type=int, default=200, help="1タスクで検出するシナリオ数（デフォルト: 200）")
+    scan_endings.add_argument("--json", action="store_true", help="集計結果をJSONで出力する")
+    scan_endings.set_defaults(func=cmd_scan_endings)
+
+    duplicates = subparsers.add_parser("duplicates", help="本文が似ている履歴のまとまりを一覧にする")
+    duplicates.add_argument("--threshold", type=float, default=app.NEAR_DUPLICATE_THRESHOLD,
+                            help=f"推定類似度の下限（デフォルト: {app.NEAR_DUPLICATE_THRESHOLD}）")
+    duplicates.add_argument("--report", default="", help="一覧の保存先CSV")
+    duplicates.set_defaults(func=cmd_duplicates)
+
+    compact = subparsers.add_parser("compact", help="古い履歴をアーカイブのセグメントにまとめる")
+    compact.add_argument("--older-than", type=int, default=30, help="この日数より古い履歴を移す（デフォルト: 30）")
+    compact.add_argument("--segment-size", type=int, default=app.DEFAULT_SEGMENT_RECORDS,
+                         help=f"1セグメントの件数。達したら圧縮して封印する（デフォルト: {app.DEFAULT_SEGMENT_RECORDS}）")
+    compact.add_argument("--seal", action="store_true", help="最後の追記中のセグメントも圧縮して封印する")
+    compact.set_defaults(func=cmd_compact)
+
+    export = subparsers.add_parser("export", help="履歴をZIP（Markdown）/CSV/JSONLに書き出す")
+    export.add_argument("output", help="出力ファイル（拡張子 .zip / .csv / .jsonl で形式を判定）")
+    export.add_argument("--format", choices=list(app.EXPORT_FORMATS), default="", help="出力形式（省略時は拡張子から判定）")
+    export.add_argument("--from", dest="date_from", type=_parse_date, default=None, help="作成日の開始（YYYY-MM-DD）")
+    export.add_argument("--to", dest="date_to", type=_parse_date, default=None, help="作成日の終了（YYYY-MM-DD、当日を含む）")
+    export.add_argument("--tone", action="append", default=[], help="トーン（複数指定可）")
+    export.add_argument("--favorites", action="store_true", help="お気に入りのみ")
+    export.add_argument("--search", default="", help="検索語")
+    export.add_argument("--id", action="append", default=[], help="履歴id（複数指定可）")
+    export.set_defaults(func=cmd_export)
+
+    return parser
+
+
+def main():
+    load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+    args = build_parser().parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,56 @@
+"""
+テスト共通のフィクスチャ
+
+- output_dir: 一時ディレクトリを SCENARIO_OUTPUT_DIR にして、プロセス内のキャッシュを空にする
+- fake_api: bench/fake_anthropic のスタブサーバーを起動し、ANTHROPIC_BASE_URL を向ける
+"""
+import os
+import sys
+from dataclasses import dataclass, field
+
+import pytest
+import streamlit as st
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "bench"))
+
+import app  # noqa: E402
+from fake_anthropic import FakeAnthropicServer, FakeServerConfig  # noqa: E402
+
+
+@pytest.fixture
+def output_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("SCENARIO_OUTPUT_DIR", str(tmp_path))
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    yield tmp_path
+    st.cache_data.clear()
+    st.cache_resource.clear()
+
+
+@dataclass
+class RecordingConfig(FakeServerConfig):
+    """受け付けたリクエスト本文も残すスタブサーバーの設定"""
+    bodies: list = field(default_factory=list)
+
+    def choose_body(self, request):
+        self.bodies.append(request)
+        return super().choose_body(request)
+
+
+@pytest.fixture
+def fake_api(output_dir, monkeypatch):
+    config = RecordingConfig()
+    with FakeAnthropicServer(config) as server:
+        monkeypatch.setenv("ANTHROPIC_BASE_URL", server.base_url)
+        app.close_anthropic_clients()
+        yield config
+    app.close_anthropic_clients()
+
+
+@pytest.fixture
+def corpus(output_dir):
+    """2025年の日時で合成した履歴JSONを30件書き出し、履歴idのリストを返す（古い順）"""
+    from run_bench import write_synthetic_corpus
+    return write_synthetic_corpus(str(output_dir), 30, seed=1)
@@ -0,0 +1,90 @@
+"""古い履歴のアーカイブ（JSONLセグメント）（user-021）"""
+import os
+import sqlite3
+
+import streamlit as st
+
+import app
+
+
+def _db_row(history_id):
+    conn = sqlite3.connect(app._history_db_path())
+    conn.row_factory = sqlite3.Row
+    try:
+        return conn.execute(
+            "SELECT filename, segment, result, data FROM histories WHERE id = ?", (history_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+
+
+def test_compact_moves_bodies_out_of_the_index(corpus, output_dir):
+    report = app.compact_history(older_than_days=30, segment_records=20)
+
+    assert report["archived"] == len(corpus)
+    assert report["sealed"] == ["segment_000001.jsonl.gz"]
+    assert report["segments"] == 2
+    assert report["db_bytes_after"] < report["db_bytes_before"]
+    assert not [f for f in os.listdir(output_dir) if app.HISTORY_FILE_PATTERN.match(f)]
+    row = _db_row(corpus[0])
+    assert row["segment"] and row["result"] == "" and row["data"] == ""
+
+
+def test_archived_histories_are_readable(corpus):
+    originals = {hist["timestamp"]: hist for hist in app.load_history(limit=len(corpus))}
+    app.compact_history(older_than_days=30, segment_records=20, seal=True)
+
+    assert app.read_history(corpus[0]) == originals[corpus[0]]
+    assert app.load_history(limit=len(corpus)) == list(originals.values())
+    assert sorted(hist["timestamp"] for hist in app.iter_history_records()) == sorted(corpus)
+    # 本文以外（テーマ）の検索はアーカイブ後も使える
+    theme = originals[corpus[3]]["theme"]
+    assert corpus[3] in [hist["timestamp"] for hist in app.load_history(limit=5, search_query=theme)]
+
+
+def test_edit_and_delete_of_archived_history(corpus):
+    app.compact_history(older_than_days=30, seal=True)
+
+    edited = app.update_history(corpus[0], "編集後の本文", expected_revision=1)
+    assert edited["revision"] == 2
+    row = _db_row(corpus[0])
+    assert row["segment"] == "" and row["filename"] and row["result"] == "編集後の本文"
+    assert app.read_history(corpus[0])["result"] == "編集後の本文"
+
+    assert app.delete_history(corpus[1])
+    assert app.read_history(corpus[1]) is None
+    # 索引を作り直しても、削除した履歴はセグメントから復活しない
+    os.remove(app._history_db_path())
+    app.import_history_files()
+    assert app.read_history(corpus[1]) is None
+    assert app.read_history(corpus[0])["result"] == "編集後の本文"
+    assert app.read_history(corpus[2]) is not None
+
+
+def test_check_history_index_full_rebuilds_archived_rows(corpus):
+    app.compact_history(older_than_days=30, segment_records=20)
+    conn = sqlite3.connect(app._history_db_path())
+    with conn:
+        conn.execute("DELETE FROM histories WHERE id IN (?, ?)", (corpus[0], corpus[-1]))
+    conn.close()
+
+    report = app.check_history_index(repair=True, full=True)
+
+    assert report["reindexed"] >= 2
+    assert app.read_history(corpus[0]) is not None
+    assert _db_row(corpus[-1])["data"] == ""
+
+
+def test_migration_v7_drops_bodies_of_rows_archived_before_it(corpus):
+    app.compact_history(older_than_days=30)
+    conn = sqlite3.connect(app._history_db_path())
+    with conn:
+        conn.execute("UPDATE histories SET result = 'x', data = '{}' WHERE id = ?", (corpus[0],))
+        conn.execute("PRAGMA user_version = 6")
+    conn.close()
+    st.cache_resource.clear()
+
+    app.load_history(limit=1)
+
+    assert _db_row(corpus[0])["data"] == ""
+    assert app.read_history(corpus[0])["timestamp"] == corpus[0]
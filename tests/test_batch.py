@@ -0,0 +1,62 @@
+"""一括生成のテーマリストの読み込みとバックグラウンドジョブ（user-003）"""
+import time
+
+import pytest
+
+import app
+
+CSV_TEXT = (
+    "theme,tone,viewpoint,additional_notes\n"
+    "幼なじみと再会,切ない・号泣系,,\n"
+    "存在しないトーン,ホラー,,\n"
+    ",甘々・胸キュン全開,,\n"
+    "職場の先輩,,相手目線,雨の日\n"
+)
+
+
+def test_csv_rows_with_unknown_tone_are_skipped_with_line_number():
+    errors = []
+    rows = app.parse_batch_rows(CSV_TEXT, "themes.csv", errors=errors)
+
+    assert [row["theme"] for row in rows] == ["幼なじみと再会", "職場の先輩"]
+    assert rows[1]["tone"] == app.TONE_OPTIONS[0]
+    assert rows[1]["viewpoint"] == "相手目線"
+    assert len(errors) == 1 and errors[0].startswith("3行目")
+
+
+def test_broken_jsonl_lines_are_skipped_with_line_number():
+    content = "\n".join([
+        '{"theme": "文化祭の準備"}',
+        '{"theme": "壊れた行"',
+        '["配列の行"]',
+        "",
+        '{"theme": "卒業式", "tone": "純愛・初恋系"}',
+    ])
+    errors = []
+    rows = app.parse_batch_rows(content, "themes.jsonl", errors=errors)
+
+    assert [row["theme"] for row in rows] == ["文化祭の準備", "卒業式"]
+    assert [message.split(":")[0] for message in errors] == ["2行目", "3行目"]
+
+
+@pytest.mark.parametrize("data", [
+    "theme\n夏祭り\n".encode("utf-8-sig"),
+    "theme\n夏祭り\n".encode("cp932"),
+])
+def test_batch_file_is_decoded_as_utf8_or_cp932(data):
+    rows = app.parse_batch_rows(app.decode_batch_file(data), "themes.csv")
+    assert [row["theme"] for row in rows] == ["夏祭り"]
+
+
+def test_batch_runs_as_background_job(fake_api):
+    rows = app.parse_batch_rows(CSV_TEXT, "themes.csv")
+    job_id = app.submit_batch_job("sk-test", rows, "themes.csv", concurrency=2)
+
+    deadline = time.monotonic() + 30
+    while (job := app.get_job(job_id)).is_active and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    assert job.status == app.JOB_DONE
+    assert [report["row"] for report in job.reports] == [1, 2]
+    assert all(report["status"] == "success" for report in job.reports)
+    assert len(app.load_history()) == 2
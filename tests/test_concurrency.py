@@ -0,0 +1,61 @@
+"""同時に保存・編集するセッションがあっても履歴・お気に入りが壊れない（user-017）"""
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fake_anthropic import DEFAULT_SCENARIO_BODY
+
+import app
+
+
+def _save(number):
+    return app.save_history(f"テーマ{number}", app.STORY_FORMAT, app.TONE_OPTIONS[0], DEFAULT_SCENARIO_BODY)
+
+
+def _try_update(history_id, text):
+    try:
+        return app.update_history(history_id, text, expected_revision=1)
+    except app.HistoryConflictError as e:
+        return e
+
+
+def test_update_with_stale_revision_raises_conflict(output_dir):
+    _save(0)
+    history_id = app.load_history(limit=1)[0]["timestamp"]
+    app.update_history(history_id, "先に保存した本文", expected_revision=1)
+
+    with pytest.raises(app.HistoryConflictError) as excinfo:
+        app.update_history(history_id, "後から保存した本文", expected_revision=1)
+
+    assert excinfo.value.latest["revision"] == 2
+    assert excinfo.value.latest["result"] == "先に保存した本文"
+    assert app.read_history(history_id)["result"] == "先に保存した本文"
+
+
+def test_concurrent_saves_get_distinct_ids(output_dir):
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        paths = list(executor.map(_save, range(24)))
+
+    assert len(set(paths)) == 24
+    assert len({hist["timestamp"] for hist in app.load_history(limit=100)}) == 24
+    assert app.get_statistics()["total_count"] == 24
+
+
+def test_concurrent_edits_of_one_history_keep_exactly_one(output_dir):
+    _save(0)
+    history_id = app.load_history(limit=1)[0]["timestamp"]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(_try_update, [history_id] * 8, [f"本文{n}" for n in range(8)]))
+
+    saved = [result for result in results if isinstance(result, dict)]
+    assert len(saved) == 1
+    assert all(isinstance(result, app.HistoryConflictError) for result in results if result is not saved[0])
+    assert app.read_history(history_id)["result"] == saved[0]["result"]
+
+
+def test_concurrent_favorites_are_not_lost(output_dir):
+    ids = [f"2025-01-01T00:00:{second:02d}" for second in range(16)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(app.toggle_favorite, ids))
+
+    assert sorted(app.get_favorites()) == ids
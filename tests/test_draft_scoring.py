@@ -0,0 +1,34 @@
+"""初稿のローカル採点とリライト判定（user-014 / user-024）"""
+from fake_anthropic import DEFAULT_SCENARIO_BODY
+
+import app
+
+_DOCUMENT = app.build_scenario_document(DEFAULT_SCENARIO_BODY)
+_KOHEN_START = DEFAULT_SCENARIO_BODY.index("■後編")
+
+
+def test_footer_is_not_scored():
+    without_footer = DEFAULT_SCENARIO_BODY[:DEFAULT_SCENARIO_BODY.index(_DOCUMENT.footer)]
+    assert app.score_scenario_draft(without_footer) == app.score_scenario_draft(DEFAULT_SCENARIO_BODY)
+
+
+def test_truncated_draft_fails_and_is_finished_by_shortening():
+    cut = DEFAULT_SCENARIO_BODY[:_KOHEN_START + 60]
+    draft = app.complete_scenario_footer(cut.rstrip() + "\n" + app.TRUNCATION_NOTE + "\n")
+
+    score = app.score_scenario_draft(draft)
+
+    assert score["truncated"] and score["within_limit"] and not score["passes"]
+    assert "途中で打ち切り" in score["issues"]
+    # 上限内でも、打ち切られた話は短縮の工程で書き切らせる
+    assert app.plan_rewrite(draft, app.REWRITE_ADAPTIVE, score)["action"] == app.REWRITE_ACTION_SHORTEN
+    assert app.plan_rewrite(draft, app.REWRITE_NEVER, score)["action"] == app.REWRITE_ACTION_SHORTEN
+
+
+def test_half_without_scenes_is_rewritten():
+    draft = app.complete_scenario_footer(DEFAULT_SCENARIO_BODY[:_KOHEN_START] + "■後編\n")
+
+    score = app.score_scenario_draft(draft)
+
+    assert not score["structure_ok"] and not score["passes"]
+    assert app.plan_rewrite(draft, app.REWRITE_ADAPTIVE, score)["action"] == app.REWRITE_ACTION_REWRITE
@@ -0,0 +1,52 @@
+"""履歴のエクスポート（ZIP / CSV / JSONL）（user-023）"""
+import csv
+import json
+import zipfile
+from datetime import date
+
+import pytest
+from fake_anthropic import DEFAULT_SCENARIO_BODY
+
+import app
+
+
+@pytest.mark.parametrize("value, expected", [
+    ((), (None, None)),
+    ((date(2025, 1, 1),), (date(2025, 1, 1), None)),
+    ((date(2025, 1, 1), date(2025, 1, 31)), (date(2025, 1, 1), date(2025, 1, 31))),
+    (date(2025, 1, 1), (date(2025, 1, 1), None)),
+])
+def test_date_input_range(value, expected):
+    assert app.date_input_range(value) == expected
+
+
+def test_date_filters_include_both_ends(corpus, output_dir):
+    app.save_history("今日のテーマ", app.STORY_FORMAT, app.TONE_OPTIONS[0], DEFAULT_SCENARIO_BODY)
+    corpus_day = date.fromisoformat(corpus[0][:10])
+
+    # 開始日だけ（終了日を選ぶ前）は開始日以降すべて
+    assert len(list(app.iter_history_records(date_from=corpus_day))) == len(corpus) + 1
+    assert len(list(app.iter_history_records(date_from=corpus_day, date_to=corpus_day))) == len(corpus)
+    assert [hist["theme"] for hist in app.iter_history_records(date_from=date.today())] == ["今日のテーマ"]
+
+
+@pytest.mark.parametrize("export_format", list(app.EXPORT_FORMATS))
+def test_export_formats_contain_every_matching_record(corpus, output_dir, export_format):
+    tone = app.read_history(corpus[0])["tone"]
+    expected = {hist["timestamp"] for hist in app.iter_history_records(tones=[tone])}
+    path = output_dir / f"export.{export_format}"
+
+    count = app.export_history(str(path), export_format, tones=[tone], batch_size=4)
+
+    assert count == len(expected) > 0
+    if export_format == "zip":
+        with zipfile.ZipFile(path) as archive:
+            assert len(archive.namelist()) == count
+    elif export_format == "csv":
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            rows = list(csv.DictReader(f))
+        assert {row["timestamp"] for row in rows} == expected
+        assert {row["tone"] for row in rows} == {tone}
+    else:
+        with open(path, encoding="utf-8") as f:
+            assert {json.loads(line)["timestamp"] for line in f} == expected
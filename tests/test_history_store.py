@@ -0,0 +1,98 @@
+"""履歴データベース（SQLite + FTS5）とシナリオの解析（user-006 / user-007）"""
+import json
+import os
+import sqlite3
+
+import streamlit as st
+from fake_anthropic import DEFAULT_SCENARIO_BODY
+
+import app
+
+
+def _user_version():
+    conn = sqlite3.connect(app._history_db_path())
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _page_ids(**kwargs):
+    """load_history_page を最後のページまで読み、idを順に返す"""
+    ids, cursor = [], None
+    while True:
+        summaries, cursor = app.load_history_page(cursor=cursor, **kwargs)
+        ids.extend(summary["id"] for summary in summaries)
+        if cursor is None:
+            return ids
+
+
+def test_parsed_halves_join_back_to_the_same_scenario():
+    document = app.build_scenario_document(DEFAULT_SCENARIO_BODY)
+    assert document.has_halves and document.characters[0][0] == "A子"
+
+    joined = app.join_scenario_halves(document.head, document.zenpen.text, document.kohen.text)
+    rejoined = app.build_scenario_document(joined)
+
+    assert (rejoined.zenpen_count, rejoined.kohen_count) == (document.zenpen_count, document.kohen_count)
+    assert rejoined.footer.strip() == (
+        f"文字数：前編{document.zenpen_count}文字 / 後編{document.kohen_count}文字 / 合計{document.total_count}文字"
+    )
+    assert app.join_scenario_halves(rejoined.head, rejoined.zenpen.text, rejoined.kohen.text) == joined
+
+
+def test_new_database_imports_existing_files(corpus):
+    assert len(app.load_history(limit=100)) == len(corpus)
+    assert _user_version() == len(app.HISTORY_DB_MIGRATIONS)
+    assert app.get_statistics()["total_count"] == len(corpus)
+
+
+def test_migration_from_v1_backfills_new_columns_and_search(corpus, output_dir):
+    # v1 のテーブルだけの索引を作る（全文索引は移行後に既存の行から作られる）
+    conn = sqlite3.connect(app._history_db_path())
+    with conn:
+        app._migrate_history_db_v1(conn)
+        for filename in sorted(f for f in os.listdir(output_dir) if app.HISTORY_FILE_PATTERN.match(f)):
+            with open(os.path.join(output_dir, filename), encoding="utf-8") as f:
+                data = json.load(f)
+            conn.execute(
+                "INSERT INTO histories (id, filename, created_at, theme, tone, result, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (data["timestamp"], filename, data["timestamp"], data["theme"], data["tone"], data["result"], json.dumps(data, ensure_ascii=False)),
+            )
+        conn.execute("PRAGMA user_version = 1")
+    conn.close()
+    st.cache_resource.clear()
+
+    summaries, _ = app.load_history_page(limit=len(corpus))
+
+    assert _user_version() == len(app.HISTORY_DB_MIGRATIONS)
+    assert len(summaries) == len(corpus)
+    assert all(summary["zenpen_chars"] > 0 for summary in summaries)
+    assert app.get_statistics()["total_count"] == len(corpus)
+    # 移行前からある行も本文の全文検索で見つかる
+    target = app.read_history(corpus[5])
+    phrase = target["result"].split("■前編", 1)[1].strip().split("\n")[0][:6]
+    assert corpus[5] in [hist["timestamp"] for hist in app.load_history(limit=len(corpus), search_query=phrase)]
+    assert corpus[5] in [item["id"] for item in app.find_similar_histories(target["result"])]
+
+
+def test_save_search_and_paginate(output_dir):
+    saved = [
+        app.save_history(f"テーマ{number} 雨の日の告白" if number % 2 else f"テーマ{number} 文化祭", app.STORY_FORMAT, app.TONE_OPTIONS[number % 3], DEFAULT_SCENARIO_BODY)
+        for number in range(7)
+    ]
+    ids = [hist["timestamp"] for hist in app.load_history(limit=10)]
+    assert len(saved) == len(ids) == 7
+
+    # 3文字以上は全文索引、2文字以下は部分一致
+    assert len(app.load_history(limit=10, search_query="雨の日の告白")) == 3
+    assert len(app.load_history(limit=10, search_query="文化")) == 4
+    assert app.load_history(limit=10, search_query="存在しない語句") == []
+
+    # カーソルでのページ送りは重複も抜けもない
+    assert _page_ids(limit=3) == ids
+    assert _page_ids(limit=2, search_query="文化祭") == [i for i in ids if "文化祭" in app.read_history(i)["theme"]]
+
+    app.toggle_favorite(ids[1])
+    app.toggle_favorite(ids[4])
+    assert _page_ids(limit=1, favorites_only=True) == [ids[1], ids[4]]
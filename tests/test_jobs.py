@@ -0,0 +1,22 @@
+"""バックグラウンド生成ジョブ（user-016）"""
+import time
+
+import app
+
+
+def _wait(job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while (job := app.get_job(job_id)).is_active and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return job
+
+
+def test_finished_job_points_at_the_saved_history(fake_api):
+    job = _wait(app.submit_generation_job("sk-test", "テーマ", app.STORY_FORMAT, app.TONE_OPTIONS[0], streaming=False))
+
+    assert job.status == app.JOB_DONE
+    hist = app.read_history(job.history_id)
+    assert hist["theme"] == "テーマ"
+    # 結果の編集・お気に入りは保存済みの履歴に対して行う
+    assert app.update_history(job.history_id, "編集後の本文", expected_revision=1)["revision"] == 2
+    assert app.toggle_favorite(job.history_id)
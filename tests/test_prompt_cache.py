@@ -0,0 +1,31 @@
+"""固定指示のシステムプロンプトとプロンプトキャッシュ（user-011）"""
+from fake_anthropic import DEFAULT_SCENARIO_BODY
+
+import app
+
+SOURCE_HALF = "\n※朝\n" + "A子「おはようございます、今日もよろしくね」\n" * 20
+
+
+def test_shorten_system_prompt_is_not_marked_for_caching(fake_api):
+    app.shorten_scenario("sk-test", SOURCE_HALF, "前編")
+
+    system = fake_api.bodies[0]["system"]
+    assert system == app.SHORTEN_SYSTEM_PROMPT
+    assert "cache_control" not in str(system)
+
+
+def test_rewrite_system_prompt_is_not_marked_for_caching(fake_api):
+    app.check_and_fix_scenario("sk-test", DEFAULT_SCENARIO_BODY)
+
+    system = fake_api.bodies[0]["system"]
+    assert system == app.REWRITE_SYSTEM_PROMPT
+    assert "cache_control" not in str(system)
+    # 2,068文字で1,884トークン（最小長2048未満）。これより伸ばす場合は count_tokens で測り直し、
+    # 2048トークンを超えていれば cache_control を付ける
+    assert len(app.REWRITE_SYSTEM_PROMPT) <= 2100
+
+
+def test_master_prompt_is_marked_for_caching(fake_api):
+    app.generate_scenario("sk-test", "テーマ", app.STORY_FORMAT, app.TONE_OPTIONS[0])
+
+    assert fake_api.bodies[0]["system"][0]["cache_control"] == {"type": "ephemeral"}
@@ -0,0 +1,61 @@
+"""プロンプトのバージョン保存（内容のハッシュで本文を共有）（user-010）"""
+import json
+import os
+
+import pytest
+
+import app
+
+PROMPT = "# マスタープロンプト\n\n---\n\n## 命令書\n恋愛漫画のシナリオを作る\n"
+
+
+@pytest.fixture
+def prompts_dir(output_dir, monkeypatch):
+    directory = output_dir / "prompts"
+    (directory / "versions").mkdir(parents=True)
+    (directory / app.MASTER_PROMPT_FILENAME).write_text(PROMPT, encoding="utf-8")
+    monkeypatch.setattr(app, "_prompts_dir", lambda: str(directory))
+    return directory
+
+
+def _manifest(prompts_dir):
+    return json.loads((prompts_dir / "versions" / "index.json").read_text(encoding="utf-8"))
+
+
+def _objects(prompts_dir):
+    return os.listdir(prompts_dir / "versions" / "objects")
+
+
+def test_unchanged_content_is_recorded_as_a_new_version_sharing_the_body(prompts_dir):
+    first = app.save_prompt_version("2.1", "初回")
+    second = app.save_prompt_version("2.2", "説明だけ変更")
+
+    manifest = _manifest(prompts_dir)
+    assert [(e["name"], e["version"], e["description"]) for e in manifest] == [
+        (first, "2.1", "初回"), (second, "2.2", "説明だけ変更"),
+    ]
+    assert len(_objects(prompts_dir)) == 1
+    assert {first, second} <= set(app.get_available_prompt_versions())
+    assert app.load_prompt_version(second) == PROMPT
+
+
+def test_content_of_a_legacy_copy_is_not_stored_again(prompts_dir):
+    legacy = prompts_dir / "versions" / "v2.0_20251115_131749.md"
+    legacy.write_text(f"# プロンプトバージョン: v2.0\n# 説明: 旧形式\n\n---\n\n{PROMPT}\n", encoding="utf-8")
+    app.restore_prompt_version(legacy.name)  # 旧形式から復元した本文（前後の空白なし）
+
+    name = app.save_prompt_version("2.1", "復元したもの")
+
+    assert _manifest(prompts_dir)[0]["source"] == legacy.name
+    assert _objects(prompts_dir) == []
+    assert app.load_prompt_version(name) == PROMPT.strip()
+
+
+def test_changed_content_gets_its_own_object(prompts_dir):
+    app.save_prompt_version("2.1")
+    (prompts_dir / app.MASTER_PROMPT_FILENAME).write_text(PROMPT + "追記\n", encoding="utf-8")
+
+    name = app.save_prompt_version("2.2")
+
+    assert len(_objects(prompts_dir)) == 2
+    assert app.load_prompt_version(name) == PROMPT + "追記\n"
@@ -0,0 +1,34 @@
+"""API呼び出しの期限（user-015）"""
+import time
+
+import pytest
+
+import app
+
+SOURCE_HALF = "\n※朝\n" + "A子「おはようございます、今日もよろしくね」\n" * 20
+
+
+@pytest.mark.parametrize("latency, chunk_delay", [(0, 0.2), (0, 5), (5, 0)])
+def test_streaming_call_is_bounded_by_stage_deadline(fake_api, monkeypatch, latency, chunk_delay):
+    monkeypatch.setenv("ANTHROPIC_DEADLINE_SHORTEN", "1")
+    fake_api.latency, fake_api.chunk_delay, fake_api.chunk_chars = latency, chunk_delay, 5
+
+    started = time.monotonic()
+    with pytest.raises(app.ScenarioGenerationError) as excinfo:
+        app.shorten_scenario("sk-test", SOURCE_HALF, "前編")
+
+    assert excinfo.value.kind == "timeout"
+    assert time.monotonic() - started < 2.5
+
+
+def test_overloaded_responses_are_retried(fake_api, monkeypatch):
+    monkeypatch.setenv("ANTHROPIC_BACKOFF_BASE", "0.01")
+    fake_api.error_rate, fake_api.seed = 0.5, 1
+    fake_api.__post_init__()
+    metrics = []
+
+    app.shorten_scenario("sk-test", SOURCE_HALF, "前編", metrics=metrics)
+
+    statuses = [request["status"] for request in fake_api.requests]
+    assert statuses == [529, 200]  # seed=1 では1回目だけ失敗する
+    assert metrics[0]["retries"] == len(statuses) - 1
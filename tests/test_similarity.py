@@ -0,0 +1,59 @@
+"""本文の似ている履歴の検出（MinHash/LSH）（user-020）"""
+from fake_anthropic import DEFAULT_SCENARIO_BODY
+
+import app
+
+VARIANT_BODY = DEFAULT_SCENARIO_BODY.replace("缶コーヒー", "温かい紅茶").replace("三十ページ", "五十ページ")
+UNRELATED_BODY = """■前編
+※放課後の図書室
+C美「この本、先に借りてもいい？」
+D太「いいよ。俺はもう三回読んだから」
+※窓の外では吹奏楽部が練習している
+C美（返却期限まで、あと一週間）
+■後編
+※卒業式の前日、図書室の貸出カード
+C美「D太くんの名前ばっかり並んでる」
+D太「最後のページに、伝えたいことを書いておいた」
+"""
+
+
+def _save(body, theme="テーマ"):
+    app.save_history(theme, app.STORY_FORMAT, app.TONE_OPTIONS[0], body)
+    return app.load_history(limit=1)[0]["timestamp"]
+
+
+def test_signature_estimates_jaccard_similarity():
+    a, b = app._shingle_hashes(DEFAULT_SCENARIO_BODY), app._shingle_hashes(VARIANT_BODY)
+    exact = len(a & b) / len(a | b)
+
+    estimate = app.estimate_similarity(app.minhash_signature(DEFAULT_SCENARIO_BODY), app.minhash_signature(VARIANT_BODY))
+
+    assert abs(estimate - exact) < 0.1
+    assert app.minhash_signature("短い") is None
+
+
+def test_near_duplicate_is_found_among_unrelated_histories(output_dir):
+    _save(UNRELATED_BODY, "無関係なシナリオ")
+    original_id = _save(DEFAULT_SCENARIO_BODY, "元のシナリオ")
+
+    similar = app.find_similar_histories(VARIANT_BODY)
+
+    assert [item["id"] for item in similar] == [original_id]
+    assert similar[0]["theme"] == "元のシナリオ" and similar[0]["similarity"] >= app.NEAR_DUPLICATE_THRESHOLD
+    assert app.find_similar_histories(VARIANT_BODY, exclude_id=original_id) == []
+
+
+def test_index_follows_edits_and_deletes(output_dir):
+    _save(UNRELATED_BODY)
+    original_id = _save(DEFAULT_SCENARIO_BODY)
+    variant_id = _save(VARIANT_BODY)
+
+    clusters = app.find_duplicate_clusters()
+    assert [{member["id"] for member in cluster["members"]} for cluster in clusters] == [{original_id, variant_id}]
+
+    # 別の内容に編集すると似ている扱いではなくなる
+    app.update_history(variant_id, UNRELATED_BODY)
+    assert variant_id not in [item["id"] for item in app.find_similar_histories(DEFAULT_SCENARIO_BODY)]
+
+    app.delete_history(original_id)
+    assert app.find_similar_histories(DEFAULT_SCENARIO_BODY) == []
@@ -0,0 +1,81 @@
+"""長すぎる出力の打ち切りと、途中で切れた前編/後編の短縮（user-025）"""
+import json
+
+import app
+from fake_anthropic import DEFAULT_SCENARIO_BODY
+
+# 後編が STREAM_OVERRUN_CHARS を大きく超える初稿
+_HEAD, _SEP, _TAIL = DEFAULT_SCENARIO_BODY.partition("※一週間後")
+RUNAWAY_BODY = _HEAD + "※場面転換\nA子「今日もいい天気だね、明日もきっと晴れるよ」\n" * 20 + _SEP + _TAIL
+
+# 短縮の依頼に対して目標文字数を大きく超えて返す本文
+LONG_HALF_BODY = "\n" + "※場面転換\nA子「ずっと一緒にいようね、約束だよ」\nB男「もちろん」\n" * 40
+
+
+def _truncated_scenario():
+    """後編の途中で切れた初稿（generate_scenario と同じ形）"""
+    cut = RUNAWAY_BODY[:RUNAWAY_BODY.index("※一週間後") - 20]
+    return app.complete_scenario_footer(cut.rstrip() + "\n" + app.TRUNCATION_NOTE + "\n")
+
+
+def _user_prompts(config):
+    return [json.dumps(body["messages"], ensure_ascii=False) for body in config.bodies]
+
+
+def test_strip_truncation_note_drops_partial_line():
+    text, truncated = app.strip_truncation_note("\n※朝\nA子「おはよう」\nB男「おは\n" + app.TRUNCATION_NOTE + "\n")
+    assert truncated
+    assert text.rstrip() == "\n※朝\nA子「おはよう」"
+    assert app.strip_truncation_note("本文\n") == ("本文\n", False)
+
+
+def test_draft_stream_stops_on_kohen_overrun(fake_api):
+    fake_api.body = RUNAWAY_BODY
+    metrics = []
+    draft = app.generate_scenario("sk-test", "テーマ", app.STORY_FORMAT, "胸キュン", metrics=metrics)
+
+    assert [m["stop_reason"] for m in metrics] == [app.STOP_REASON_OVERRUN]
+    assert app.TRUNCATION_NOTE in draft
+    document = app.parse_scenario(draft)
+    assert document.footer  # 実測の文字数表記を付け直している
+    assert document.kohen_count <= app.STREAM_OVERRUN_CHARS + len(app.TRUNCATION_NOTE) + 40
+
+
+def test_footer_is_cut_by_stop_sequence_and_remeasured(fake_api):
+    draft = app.generate_scenario("sk-test", "テーマ", app.STORY_FORMAT, "胸キュン")
+    document = app.parse_scenario(draft)
+    assert app.TRUNCATION_NOTE not in draft
+    assert document.declared_counts == {"前編": document.zenpen_count, "後編": document.kohen_count, "合計": document.total_count}
+    assert fake_api.bodies[0]["stop_sequences"] == app.FOOTER_STOP_SEQUENCES
+    assert fake_api.bodies[0]["max_tokens"] == app.output_token_budget(app.TOTAL_CHAR_LIMIT)
+
+
+def test_truncated_half_is_finished_by_shortening(fake_api):
+    final = app.enforce_char_limit("sk-test", _truncated_scenario())
+
+    assert app.TRUNCATION_NOTE not in final
+    assert app.parse_scenario(final).kohen_count <= app.HALF_CHAR_LIMIT
+    assert any("途中で打ち切っています" in prompt for prompt in _user_prompts(fake_api))
+
+
+def test_truncated_half_falls_back_when_shortening_runs_long(fake_api):
+    fake_api.short_half_body = LONG_HALF_BODY
+    scenario = _truncated_scenario()
+    stripped = app.strip_truncation_note(app.parse_scenario(scenario).kohen.text)[0]
+    metrics = []
+
+    final = app.enforce_char_limit("sk-test", scenario, max_retries=2, metrics=metrics)
+
+    # 打ち切られた短縮結果は使わず、印と書きかけの行を外した元の後編に戻す
+    assert app.TRUNCATION_NOTE not in final
+    assert app.parse_scenario(final).kohen_count == app.count_characters(stripped)
+    assert [m["stop_reason"] for m in metrics] == [app.STOP_REASON_OVERRUN] * 2
+    assert all(m["output_tokens"] <= app.HALF_CHAR_LIMIT * 2 for m in metrics)
+
+
+def test_rewrite_prompt_explains_truncation_instead_of_passing_note(fake_api):
+    app.check_and_fix_scenario("sk-test", _truncated_scenario())
+
+    rewrite_prompt = _user_prompts(fake_api)[0]
+    assert app.TRUNCATION_NOTE not in rewrite_prompt
+    assert "途中で打ち切っています" in rewrite_prompt